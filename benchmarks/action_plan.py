@@ -0,0 +1,47 @@
+"""Time and size an ActionPlan of a million mixed actions.
+
+Builds a plan of uploads, syncs and deletes, then lists and counts each
+type as Bucket does when executing it. Memory is the growth in max RSS.
+
+Usage: python benchmarks/action_plan.py [num_keys]
+
+"""
+import resource
+import sys
+import time
+
+from s3tup.rsync import ActionPlan
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    names = ['static/img/file{}.png'.format(r) for r in range(n)]
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.time()
+    plan = ActionPlan()
+    for r, name in enumerate(names):
+        if r % 3 == 0:
+            plan.add_upload(name, name)
+        elif r % 3 == 1:
+            plan.add_sync(name)
+        else:
+            plan.add_delete(name)
+    built = time.time() - start
+    grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+
+    start = time.time()
+    for _ in range(10):
+        len(list(plan.to_upload))
+        len(list(plan.to_sync))
+        len(list(plan.to_delete))
+        len(list(plan.to_redirect))
+    listed = (time.time() - start) / 10
+
+    print('{} actions: build {:.2f}s, list all types {:.3f}s, '
+          '{:.0f} bytes per action'.format(n, built, listed,
+                                           grown * 1024.0 / n))
+
+
+if __name__ == '__main__':
+    main()
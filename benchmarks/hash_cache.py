@@ -0,0 +1,81 @@
+"""Time rsync planning of an unchanged tree with and without HashCache.
+
+Builds a tree of small files plus a few multipart sized ones, a remote
+listing with matching etags, and plans it three times: without a cache,
+with a cold cache (which gets filled) and with the warm cache.
+
+Usage: python benchmarks/hash_cache.py [num_files] [file_kb]
+
+"""
+from collections import namedtuple
+from tempfile import mkdtemp
+import os
+import shutil
+import sys
+import time
+
+from s3tup.hashcache import HashCache
+from s3tup.rsync import RsyncConfig
+import s3tup.utils as utils
+
+KeyTuple = namedtuple('KeyTuple', ['name', 'md5', 'size', 'modified'])
+
+MULTIPART_FILES = 4
+MULTIPART_SIZE = 12 * 1048576
+PART_SIZE = 5242880
+
+
+def make_tree(src, num_files, file_kb):
+    remote = {}
+    old = time.time() - 60
+    for i in range(num_files + MULTIPART_FILES):
+        name = 'dir{}/file{}'.format(i % 20, i)
+        path = os.path.join(src, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        size = MULTIPART_SIZE if i >= num_files else file_kb * 1024
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        os.utime(path, (old, old))
+        with open(path, 'rb') as f:
+            if size > PART_SIZE:
+                md5 = utils.f_multipart_etag(f, PART_SIZE)
+            else:
+                md5 = utils.f_md5(f).encode('hex')
+        remote[name] = KeyTuple(name, md5, size, None)
+    return remote
+
+
+def timed(config, remote):
+    start = time.time()
+    plan = config.plan(remote)
+    elapsed = time.time() - start
+    assert len(list(plan.to_upload)) == 0
+    return elapsed
+
+
+def main():
+    num_files = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    file_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    tmp = mkdtemp()
+    try:
+        src = os.path.join(tmp, 'src')
+        remote = make_tree(src, num_files, file_kb)
+        total_mb = (num_files * file_kb / 1024.0 +
+                    MULTIPART_FILES * MULTIPART_SIZE / 1048576.0)
+        print('{} files, {:.0f} MB'.format(len(remote), total_mb))
+
+        print('no cache:   {:.2f}s'.format(timed(RsyncConfig(src), remote)))
+        cache = HashCache(os.path.join(tmp, 'hashes.sqlite'))
+        config = RsyncConfig(src, hash_cache=cache)
+        print('cold cache: {:.2f}s'.format(timed(config, remote)))
+        cache.close()
+        cache = HashCache(os.path.join(tmp, 'hashes.sqlite'))
+        config = RsyncConfig(src, hash_cache=cache)
+        print('warm cache: {:.2f}s'.format(timed(config, remote)))
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Time KeyFactory.make_key + Key.get_headers per million keys.
+
+Uses a factory with a handful of typical key configurators and key names
+spread over a few directories and extensions.
+
+Usage: python benchmarks/key_factory.py [num_keys]
+
+"""
+import sys
+import time
+
+from s3tup.key import KeyFactory, KeyConfigurator
+from s3tup.utils import Matcher
+
+EXTENSIONS = ('html', 'css', 'js', 'png', 'jpg', 'svg', 'json', 'txt',
+              'woff', 'map', 'tar.gz', '')
+DIRECTORIES = ('', 'static/', 'static/img/', 'assets/js/', 'docs/')
+
+
+def make_factory():
+    return KeyFactory([
+        KeyConfigurator(canned_acl='public-read', reduced_redundancy=True),
+        KeyConfigurator(Matcher(['static/*']),
+                        cache_control='max-age=32850000'),
+        KeyConfigurator(Matcher(['*.html', '*.css', '*.js']),
+                        content_encoding='gzip'),
+        KeyConfigurator(Matcher(['*.py']), content_type='text/plain'),
+        KeyConfigurator(Matcher(ignore_patterns=['docs/*']),
+                        metadata={'project': 'bench'}),
+        KeyConfigurator(Matcher(regexes=[r'\.(png|jpg|svg)$']),
+                        expires='Thu, 25 Dec 2015 16:00:00 GMT'),
+    ])
+
+
+def key_names(n):
+    for r in range(n):
+        d = DIRECTORIES[r % len(DIRECTORIES)]
+        ext = EXTENSIONS[r % len(EXTENSIONS)]
+        yield '{}file{}.{}'.format(d, r, ext) if ext else \
+              '{}file{}'.format(d, r)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    factory = make_factory()
+    names = list(key_names(n))
+    start = time.time()
+    for name in names:
+        factory.make_key(None, 'bucket', name).get_headers()
+    elapsed = time.time() - start
+    print('{} keys: {:.2f}s ({:.2f}s per million)'.format(
+        n, elapsed, elapsed * 1000000 / n))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Time Matcher.matches against the uncompiled fnmatch/re.search loop.
+
+Uses 50 patterns (plain, prefix, suffix and general globs, a few regexes
+and ignores) and checks that both give the same result for every path.
+
+Usage: python benchmarks/matcher.py [num_paths]
+
+"""
+from fnmatch import fnmatch
+import re
+import sys
+import time
+
+from s3tup.utils import Matcher
+
+EXTENSIONS = ('html', 'css', 'js', 'png', 'jpg', 'json', 'map', 'txt',
+              'py', 'pyc', 'md', 'woff')
+DIRECTORIES = ('', 'static/', 'static/img/', 'assets/js/', 'docs/api/',
+               'node_modules/lib/', 'build/tmp/', 'src/app/')
+
+
+def make_matcher():
+    patterns = ['static/*', 'assets/*', 'docs/*', 'src/app/*']
+    patterns += ['*.{}'.format(e) for e in EXTENSIONS[:8]]
+    patterns += ['index.html', 'robots.txt', 'favicon.ico', '404.html',
+                 'sitemap.xml', 'blog/*', 'media/*', '*.svg']
+    patterns += ['*/img/*.png', 'assets/js/*.min.js', 'static/[a-f]*.css',
+                 'docs/api/v?/*', '*/vendor/*', 'src/*/test_*.py']
+    patterns += ['page{}.html'.format(i) for i in range(10)]
+    ignore_patterns = ['node_modules/*', 'build/*', '*.pyc', '*.map',
+                       '*~', '.git/*', '*/.DS_Store', '*.swp']
+    regexes = [r'^data/\d+\.json$', r'\.(woff2?|ttf)$', r'^legacy/']
+    ignore_regexes = [r'/tmp/', r'\.bak$', r'(^|/)\.']
+    assert len(patterns + ignore_patterns + regexes + ignore_regexes) == 50
+    return Matcher(patterns, ignore_patterns, regexes, ignore_regexes)
+
+
+def legacy_matches(m, s):
+    matched = not m.patterns and not m.regexes
+    if not matched:
+        matched = any(fnmatch(s, p) for p in m.patterns)
+    if not matched:
+        matched = any(re.search(r, s) for r in m.regexes)
+    if matched:
+        if any(fnmatch(s, p) for p in m.ignore_patterns):
+            return False
+        if any(re.search(r, s) for r in m.ignore_regexes):
+            return False
+    return matched
+
+
+def paths(n):
+    for r in range(n):
+        d = DIRECTORIES[r % len(DIRECTORIES)]
+        e = EXTENSIONS[(r // len(DIRECTORIES)) % len(EXTENSIONS)]
+        yield '{}file{}.{}'.format(d, r, e)
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    m = make_matcher()
+    names = list(paths(n))
+
+    start = time.time()
+    legacy = [legacy_matches(m, s) for s in names]
+    legacy_elapsed = time.time() - start
+
+    start = time.time()
+    compiled = [m.matches(s) for s in names]
+    compiled_elapsed = time.time() - start
+
+    assert legacy == compiled
+    print('{} paths, {} matched'.format(n, sum(compiled)))
+    print('fnmatch/re.search loop: {:.2f}s'.format(legacy_elapsed))
+    print('compiled Matcher:       {:.2f}s'.format(compiled_elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""Time checking a local file against every etag form it could have.
+
+Hashes a file the way a modified multipart key is checked: the part md5s
+for each candidate part size plus the whole file md5. Compares hashing
+each of them in its own pass over the file (as s3tup used to) with
+utils.f_digests doing them all in one pass. Both are checked to agree.
+
+Usage: python benchmarks/multi_digest.py [size_mb] [num_candidates]
+
+"""
+from tempfile import NamedTemporaryFile
+import hashlib
+import sys
+import time
+
+import s3tup.constants as constants
+import s3tup.utils as utils
+
+
+def separate_passes(f, part_sizes):
+    def md5s(part_size):
+        f.seek(0)
+        out = []
+        while True:
+            m = hashlib.md5()
+            remaining = part_size
+            while remaining > 0:
+                buf = f.read(min(remaining, 8192))
+                if not buf:
+                    break
+                m.update(buf)
+                remaining -= len(buf)
+            if remaining == part_size:
+                return out
+            out.append(m.hexdigest())
+
+    part_md5s = dict((p, md5s(p)) for p in part_sizes)
+    f.seek(0)
+    m = hashlib.md5()
+    for buf in iter(lambda: f.read(8192), ''):
+        m.update(buf)
+    return m.hexdigest(), part_md5s
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    num_candidates = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    size = size_mb * 1048576
+    step = constants.MULTIPART_PART_SIZE_STEP
+    part_sizes = [constants.MULTIPART_PART_SIZE + i * step
+                  for i in range(num_candidates)]
+
+    with NamedTemporaryFile() as f:
+        block = ''.join(chr(i % 256) for i in range(1048576))
+        for _ in range(size_mb):
+            f.write(block)
+        f.flush()
+        separate_passes(f, part_sizes[:1])  # warm the page cache
+
+        start = time.time()
+        expected = separate_passes(f, part_sizes)
+        separate = time.time() - start
+
+        start = time.time()
+        digests = utils.f_digests(f, part_sizes)
+        single = time.time() - start
+        assert digests == expected
+
+    print('{} MB, {} part sizes + md5: separate passes {:.2f}s '
+          '({:.0f} MB/s), single pass {:.2f}s ({:.0f} MB/s)'.format(
+              size_mb, num_candidates, separate, size_mb / separate,
+              single, size_mb / single))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""Compare the old three-pass multipart pipeline against utils.f_parts.
+
+The old pipeline hashed every FChunk to build the completion manifest,
+hashed it again in make_request for Content-MD5 and then read it a third
+time to send it. The current one maps the file and hashes each part once
+as it is sent. Sending is simulated by writing to /dev/null so only local
+disk reads and CPU are measured.
+
+Usage: python benchmarks/multipart_upload.py [size_in_mb]
+
+"""
+from tempfile import NamedTemporaryFile
+import hashlib
+import os
+import resource
+import sys
+import time
+
+import s3tup.utils as utils
+
+PART_SIZE = 5242880
+
+
+def old_pipeline(f, devnull):
+    chunks = utils.f_chunk(f, PART_SIZE)
+    for chunk in chunks:
+        utils.f_md5(chunk)                    # completion manifest
+    for chunk in chunks:
+        utils.f_md5(chunk)                    # Content-MD5
+        chunk.seek(0)
+        while True:                           # send
+            buf = chunk.read(8192)
+            if not buf:
+                break
+            os.write(devnull, buf)
+        chunk.close()
+
+
+def new_pipeline(f, devnull):
+    for part in utils.f_parts(f, PART_SIZE):
+        hashlib.md5(part).digest()            # manifest and Content-MD5
+        os.write(devnull, part)               # send
+
+
+def read_bytes():
+    with open('/proc/self/io') as f:
+        for line in f:
+            if line.startswith('rchar:'):
+                return int(line.split()[1])
+    return 0
+
+
+def measure(pipeline, f, devnull):
+    before = resource.getrusage(resource.RUSAGE_SELF)
+    read_before = read_bytes()
+    start = time.time()
+    pipeline(f, devnull)
+    wall = time.time() - start
+    after = resource.getrusage(resource.RUSAGE_SELF)
+    cpu = (after.ru_utime - before.ru_utime) + \
+          (after.ru_stime - before.ru_stime)
+    faults = (after.ru_minflt - before.ru_minflt) + \
+             (after.ru_majflt - before.ru_majflt)
+    return wall, cpu, read_bytes() - read_before, faults
+
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    gb = size_mb / 1024.0
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    with NamedTemporaryFile() as f:
+        block = os.urandom(1048576)
+        for r in range(size_mb):
+            f.write(block)
+        f.flush()
+        print('{} MB file, {} byte parts'.format(size_mb, PART_SIZE))
+        for name, pipeline in (('old', old_pipeline), ('new', new_pipeline)):
+            wall, cpu, read, faults = measure(pipeline, f, devnull)
+            print('{}: {:.2f}s cpu/GB, {:.2f}s wall/GB, {:.2f} GB read()'
+                  ' per GB, {} page faults'.format(
+                      name, cpu / gb, wall / gb, read / 1073741824.0 / gb,
+                      faults))
+    os.close(devnull)
+
+
+if __name__ == '__main__':
+    main()
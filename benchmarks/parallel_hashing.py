@@ -0,0 +1,77 @@
+"""Time rsync planning of a tree that has to be hashed, across pools.
+
+Builds a tree of files of mixed sizes and a remote listing where every
+file has the right size but a different etag, so every file is hashed,
+then plans it with thread and process pools of increasing size. Every
+plan is checked against the serial one.
+
+Usage: python benchmarks/parallel_hashing.py [total_mb] [max_workers]
+
+"""
+from collections import namedtuple
+from tempfile import mkdtemp
+import multiprocessing
+import os
+import shutil
+import sys
+import time
+
+from s3tup.rsync import RsyncConfig
+
+KeyTuple = namedtuple('KeyTuple', ['name', 'md5', 'size', 'modified'])
+
+# Sizes (in KB) cycled through; a few big files among many small ones.
+SIZES_KB = (64, 64, 256, 1024, 64, 4096, 256, 32768)
+
+
+def make_tree(src, total_mb):
+    remote = {}
+    written = 0
+    i = 0
+    while written < total_mb * 1048576:
+        name = 'dir{}/file{}'.format(i % 10, i)
+        path = os.path.join(src, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        size = SIZES_KB[i % len(SIZES_KB)] * 1024
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+        remote[name] = KeyTuple(name, '0' * 32, size, None)
+        written += size
+        i += 1
+    return remote
+
+
+def summary(plan):
+    return sorted(plan.to_upload), sorted(plan.to_sync)
+
+
+def main():
+    total_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else \
+        multiprocessing.cpu_count()
+    tmp = mkdtemp()
+    try:
+        src = os.path.join(tmp, 'src')
+        remote = make_tree(src, total_mb)
+        print('{} files, {} MB, {} cpus'.format(
+            len(remote), total_mb, multiprocessing.cpu_count()))
+
+        expected = summary(RsyncConfig(src, hash_workers=1).plan(remote))
+        workers = 1
+        while workers <= max_workers:
+            for pool in ('thread', 'process'):
+                r = RsyncConfig(src, hash_workers=workers, hash_pool=pool)
+                start = time.time()
+                plan = r.plan(remote)
+                elapsed = time.time() - start
+                assert summary(plan) == expected
+                print('{:>7} x{:<3} {:.2f}s ({:.0f} MB/s)'.format(
+                    pool, workers, elapsed, total_mb / elapsed))
+            workers *= 2
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
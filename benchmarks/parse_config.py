@@ -0,0 +1,79 @@
+"""Time loading and parsing a large generated config.
+
+Writes a yaml config of num_buckets buckets, sharing num_redirects
+redirects between them, each with a few key configurators and an rsync,
+then times loading the yaml, parsing it into Buckets, and loading it
+through the compiled config cache, cold and warm.
+
+Usage: python benchmarks/parse_config.py [num_buckets] [num_redirects]
+
+"""
+from tempfile import mkdtemp
+import os
+import shutil
+import sys
+import time
+
+from s3tup import parse
+
+BUCKET = '''
+- bucket: bucket-{i}
+  canned_acl: public-read
+  rsync:
+    - src: sites/{i}/public
+      delete: true
+      ignore_patterns: ['*.tmp', '.git/*']
+    - src: sites/{i}/assets
+      dest: assets/
+      patterns: ['*.css', '*.js', '*.png']
+  key_config:
+    - canned_acl: public-read
+      cache_control: max-age=300
+    - patterns: ['*.html', '*.css', '*.js']
+      content_encoding: gzip
+    - regexes: ['^assets/.*[.][0-9a-f]{{8}}[.](css|js)$']
+      cache_control: max-age=31536000
+      metadata: {{owner: web, site: '{i}'}}
+  redirects:
+'''
+REDIRECT = "    - ['old/{i}/page{r}.html', '/new/page{r}.html']\n"
+
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return time.time() - start, result
+
+
+def main():
+    num_buckets = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+    num_redirects = int(sys.argv[2]) if len(sys.argv) > 2 else 80000
+    os.environ.setdefault('AWS_ACCESS_KEY_ID', 'access_key_id')
+    os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'secret_access_key')
+
+    tmp = mkdtemp()
+    try:
+        path = os.path.join(tmp, 's3tup.yml')
+        with open(path, 'w') as f:
+            per_bucket = num_redirects // num_buckets
+            for i in range(num_buckets):
+                f.write(BUCKET.format(i=i))
+                for r in range(per_bucket):
+                    f.write(REDIRECT.format(i=i, r=r))
+
+        elapsed, config = timed(parse.load_config, path)
+        print('load yaml    {:7.2f}s'.format(elapsed))
+        elapsed, buckets = timed(parse.parse_config, config)
+        print('parse        {:7.2f}s'.format(elapsed))
+
+        cache_dir = os.path.join(tmp, 'cache')
+        for name in ('cold cache', 'warm cache'):
+            elapsed, buckets = timed(parse.load_buckets, path, cache_dir)
+            print('{:<12} {:7.2f}s'.format(name, elapsed))
+        assert len(buckets) == num_buckets
+    finally:
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Compare executing a plan in plan order and longest first.
+
+Simulates uploading a mix of many small files, some medium sized ones
+and a couple of large multipart ones over a Connection whose requests
+just sleep for as long as the cost model says they take, scaled down by
+20. Prints the actual and predicted makespan of each ordering.
+
+Usage: python benchmarks/schedule.py [concurrency]
+
+"""
+import random
+import sys
+import time
+
+import gevent
+
+from s3tup.connection import Connection
+from s3tup.schedule import CostModel, lpt_order, predict_makespan
+
+SCALE = 0.05
+
+
+def upload(conn, costs):
+    gevent.sleep(costs[0] * SCALE)
+    conn.join([[gevent.sleep, c * SCALE] for c in costs[1:]])
+
+
+def run(conn, jobs):
+    start = time.time()
+    conn.join([action for costs, action in jobs])
+    return time.time() - start
+
+
+def main():
+    concurrency = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    conn = Connection('access_key_id', 'secret_access_key',
+                      concurrency=concurrency)
+    model = CostModel(latency=0.05, bandwidth=10485760)
+    random.seed(0)
+
+    sizes = [random.randint(1, 262144) for _ in range(300)]
+    sizes += [random.randint(1, 5) * 1048576 for _ in range(40)]
+    sizes += [random.randint(20, 200) * 1048576 for _ in range(2)]
+    random.shuffle(sizes)
+    jobs = []
+    for size in sizes:
+        costs = model.upload(size)
+        jobs.append((costs, [upload, conn, costs]))
+
+    for name, ordered in (('plan order', jobs),
+                          ('longest first', lpt_order(jobs))):
+        actual = run(conn, ordered) / SCALE
+        predicted = predict_makespan(ordered, concurrency)
+        print('{:<14} {:8.1f}s (predicted {:.1f}s)'.format(
+            name, actual, predicted))
+
+
+if __name__ == '__main__':
+    main()
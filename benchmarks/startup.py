@@ -0,0 +1,96 @@
+"""Time how long s3tup takes to start for commands that do little work.
+
+Runs, each in a fresh interpreter: s3tup --help, loading and parsing a
+config without touching s3, and a --dryrun of that config against a
+local stand-in for s3 that lists an empty bucket. Prints the best wall
+clock time of each over several runs.
+
+Usage: python benchmarks/startup.py [runs]
+
+"""
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from tempfile import mkdtemp
+from threading import Thread
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+EMPTY_LISTING = ('<?xml version="1.0" encoding="UTF-8"?>'
+                 '<ListBucketResult><IsTruncated>false</IsTruncated>'
+                 '</ListBucketResult>')
+
+CONFIG = '''
+- bucket: startup-benchmark
+  hostname: {hostname}
+  access_key_id: access_key_id
+  secret_access_key: secret_access_key
+  rsync: {src}
+  key_config:
+    - canned_acl: public-read
+    - patterns: ['*.html']
+      cache_control: max-age=60
+'''
+
+
+class EmptyBucketHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(EMPTY_LISTING)))
+        self.end_headers()
+        self.wfile.write(EMPTY_LISTING)
+
+    def log_message(self, *args):
+        pass
+
+
+def best_of(runs, args, env):
+    best = None
+    for _ in range(runs):
+        start = time.time()
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(args, stdout=devnull, stderr=devnull,
+                                  env=env)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    tmp = mkdtemp()
+    server = HTTPServer(('127.0.0.1', 0), EmptyBucketHandler)
+    thread = Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        src = os.path.join(tmp, 'src')
+        os.mkdir(src)
+        for i in range(10):
+            with open(os.path.join(src, 'file{}.html'.format(i)), 'w') as f:
+                f.write('file {}'.format(i))
+        config = os.path.join(tmp, 's3tup.yml')
+        with open(config, 'w') as f:
+            f.write(CONFIG.format(src=src, hostname='127.0.0.1:{}'.format(
+                server.server_address[1])))
+
+        env = dict(os.environ, S3TUP_STATE_DIR=os.path.join(tmp, 'state'))
+        cli = [sys.executable, '-c', 'from s3tup.cli import main; main()']
+        validate = [sys.executable, '-c',
+                    'import sys; from s3tup.parse import load_config, '
+                    'parse_config; parse_config(load_config(sys.argv[1]))',
+                    config]
+        for name, args in (('--help', cli + ['--help']),
+                           ('validate', validate),
+                           ('--dryrun', cli + [config, '--dryrun'])):
+            print('{:<10} {:6.1f}ms'.format(
+                name, best_of(runs, args, env) * 1000))
+    finally:
+        server.shutdown()
+        shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,541 @@
+from binascii import unhexlify
+from tempfile import mkdtemp
+from threading import Event, Thread
+from urlparse import parse_qs
+from xml.sax.saxutils import escape, unescape
+import hashlib
+import itertools
+import logging
+import os
+import platform
+import random
+import re
+import resource
+import shutil
+import sys
+import time
+
+from s3tup.connection import monkey_patch
+from s3tup.parse import parse_config
+import s3tup.constants as constants
+
+log = logging.getLogger('s3tup.bench')
+
+BUCKET = 's3tup-bench'
+XML = '<?xml version="1.0" encoding="UTF-8"?>'
+
+# Largest number of keys in a page of a bucket listing, as s3 has it.
+LIST_PAGE = 1000
+
+_SIZE_SUFFIXES = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+
+class StandIn(object):
+
+    """A local, in-memory stand-in for s3 serving a single bucket.
+
+    Answers the requests s3tup makes when syncing (listings, puts, copies,
+    multipart uploads, deletes, heads and bucket configuration) over http
+    on 127.0.0.1, from a gevent server running in a thread of its own.
+    Only the etag, size, last modified time and x-amz-* headers of keys
+    are kept, never their contents, and signatures aren't checked.
+
+    Every request waits latency seconds before it's answered, and request
+    bodies are read at bandwidth bytes per second (unlimited if None).
+    A fraction error_rate of requests, picked at random once their body
+    has been read, fail with a 500 InternalError.
+
+    """
+
+    def __init__(self, latency=0, bandwidth=None, error_rate=0, seed=0):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.keys = {}
+        self.uploads = {}
+        self._random = random.Random(seed)
+        self._upload_ids = itertools.count(1)
+        self._stopped = False
+        self._started = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'requests': 0, 'received_bytes': 0, 'errors': 0}
+
+    @property
+    def hostname(self):
+        return '127.0.0.1:{}'.format(self._server.server_port)
+
+    def start(self):
+        self._started = Event()
+        self._thread = Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+        self._started.wait()
+
+    # The server has a hub of its own in this thread, so that it keeps
+    # answering whether or not the connection making requests to it is
+    # concurrent.
+    def _serve(self):
+        import gevent
+        from gevent.pywsgi import WSGIServer
+        self._server = WSGIServer(('127.0.0.1', 0), self._app, log=None,
+                                  error_log=None)
+        self._server.start()
+        self._started.set()
+        while not self._stopped:
+            gevent.sleep(0.05)
+        self._server.stop()
+
+    def stop(self):
+        self._stopped = True
+        self._thread.join()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _app(self, environ, start_response):
+        import gevent
+        self.stats['requests'] += 1
+        gevent.sleep(self.latency)
+        body = self._read_body(environ)
+
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.stats['errors'] += 1
+            status, headers, data = _error('500 Internal Server Error',
+                                           'InternalError',
+                                           'Injected by s3tup bench.')
+        else:
+            status, headers, data = self._handle(environ, body)
+
+        # HEAD responses carry the Content-Length of the key, if any.
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            if not any(k == 'Content-Length' for k, v in headers):
+                headers.append(('Content-Length', '0'))
+            data = ''
+        else:
+            headers.append(('Content-Length', str(len(data))))
+        start_response(status, headers)
+        return [data]
+
+    def _read_body(self, environ):
+        import gevent
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        stream = environ['wsgi.input']
+        chunks = []
+        while length > 0:
+            chunk = stream.read(min(length, 65536))
+            if not chunk:
+                break
+            length -= len(chunk)
+            self.stats['received_bytes'] += len(chunk)
+            if self.bandwidth:
+                gevent.sleep(float(len(chunk)) / self.bandwidth)
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def _handle(self, environ, body):
+        method = environ['REQUEST_METHOD']
+        bucket, _, key = environ['PATH_INFO'].lstrip('/').partition('/')
+        query = parse_qs(environ.get('QUERY_STRING', ''),
+                         keep_blank_values=True)
+        params = dict((k, v[0]) for k, v in query.items())
+        headers = dict((k[5:].lower().replace('_', '-'), v)
+                       for k, v in environ.items() if k.startswith('HTTP_'))
+
+        if bucket != BUCKET:
+            return _error('404 Not Found', 'NoSuchBucket',
+                          'The specified bucket does not exist.')
+        if not key:
+            return self._handle_bucket(method, params, body)
+        return self._handle_key(method, key, params, headers, body)
+
+    def _handle_bucket(self, method, params, body):
+        if method == 'GET' and 'uploads' in params:
+            return self._list_uploads()
+        if method == 'GET' and not _subresource(params):
+            return self._list_keys(params.get('prefix', ''),
+                                   params.get('marker', ''))
+        if method == 'POST' and 'delete' in params:
+            for k in re.findall(r'<Key>(.*?)</Key>', body):
+                self.keys.pop(unescape(k), None)
+            return _ok(XML + '<DeleteResult/>')
+        # Creating the bucket and configuring it all go through.
+        return _ok()
+
+    def _list_keys(self, prefix, marker):
+        names = sorted(k for k in self.keys
+                       if k.startswith(prefix) and k > marker)
+        page, truncated = names[:LIST_PAGE], len(names) > LIST_PAGE
+        out = [XML, '<ListBucketResult><Name>', BUCKET, '</Name>']
+        for name in page:
+            k = self.keys[name]
+            out.append(
+                '<Contents><Key>{}</Key><LastModified>{}</LastModified>'
+                '<ETag>"{}"</ETag><Size>{}</Size></Contents>'.format(
+                    escape(name), k['modified'], k['etag'], k['size']))
+        out.append('<IsTruncated>{}</IsTruncated></ListBucketResult>'.format(
+            'true' if truncated else 'false'))
+        return _ok(''.join(out))
+
+    def _list_uploads(self):
+        out = [XML, '<ListMultipartUploadsResult>']
+        for upload_id, u in sorted(self.uploads.items()):
+            out.append(
+                '<Upload><Key>{}</Key><UploadId>{}</UploadId>'
+                '<Initiated>{}</Initiated></Upload>'.format(
+                    escape(u['key']), upload_id, u['initiated']))
+        out.append('<IsTruncated>false</IsTruncated>'
+                   '</ListMultipartUploadsResult>')
+        return _ok(''.join(out))
+
+    def _handle_key(self, method, key, params, headers, body):
+        upload_id = params.get('uploadId')
+        if method == 'PUT' and upload_id is not None:
+            return self._put_part(upload_id, int(params['partNumber']), body)
+        if method == 'POST' and 'uploads' in params:
+            return self._initiate_upload(key, headers)
+        if method == 'POST' and upload_id is not None:
+            return self._complete_upload(upload_id, body)
+        if method == 'DELETE' and upload_id is not None:
+            if self.uploads.pop(upload_id, None) is None:
+                return _no_such_upload()
+            return _ok(status='204 No Content')
+        if method == 'GET' and upload_id is not None:
+            return self._list_parts(upload_id)
+        if _subresource(params):
+            # Key acls.
+            return _ok()
+        if method == 'PUT' and 'x-amz-copy-source' in headers:
+            return self._copy_key(key, headers)
+        if method == 'PUT':
+            etag = hashlib.md5(body).hexdigest()
+            self._store(key, etag, len(body), headers)
+            return _ok(headers=[('ETag', '"{}"'.format(etag))])
+        if method == 'DELETE':
+            self.keys.pop(key, None)
+            return _ok(status='204 No Content')
+        if method == 'HEAD':
+            return self._head_key(key)
+        return _error('501 Not Implemented', 'NotImplemented',
+                      'The stand-in keeps no key contents to GET.')
+
+    def _store(self, key, etag, size, headers):
+        self.keys[key] = {
+            'etag': etag,
+            'size': size,
+            'modified': _timestamp(),
+            'headers': _amz_headers(headers),
+        }
+
+    def _copy_key(self, key, headers):
+        source = headers['x-amz-copy-source'].lstrip('/').partition('/')[2]
+        try:
+            k = self.keys[source]
+        except KeyError:
+            return _error('404 Not Found', 'NoSuchKey',
+                          'The specified key does not exist.')
+        if headers.get('x-amz-metadata-directive') != 'REPLACE':
+            headers = k['headers']
+        self._store(key, k['etag'], k['size'], headers)
+        return _ok(XML + '<CopyObjectResult><ETag>"{}"</ETag>'
+                   '</CopyObjectResult>'.format(k['etag']))
+
+    def _head_key(self, key):
+        try:
+            k = self.keys[key]
+        except KeyError:
+            return '404 Not Found', [], ''
+        headers = [('ETag', '"{}"'.format(k['etag'])),
+                   ('Last-Modified', k['modified'])]
+        headers += k['headers'].items()
+        headers.append(('Content-Length', str(k['size'])))
+        return '200 OK', headers, ''
+
+    def _initiate_upload(self, key, headers):
+        upload_id = str(next(self._upload_ids))
+        self.uploads[upload_id] = {
+            'key': key,
+            'headers': headers,
+            'initiated': _timestamp(),
+            'parts': {},
+        }
+        return _ok(XML + '<InitiateMultipartUploadResult>'
+                   '<Bucket>{}</Bucket><Key>{}</Key><UploadId>{}</UploadId>'
+                   '</InitiateMultipartUploadResult>'.format(
+                       BUCKET, escape(key), upload_id))
+
+    def _put_part(self, upload_id, part_num, body):
+        try:
+            upload = self.uploads[upload_id]
+        except KeyError:
+            return _no_such_upload()
+        md5 = hashlib.md5(body).hexdigest()
+        upload['parts'][part_num] = (md5, len(body))
+        return _ok(headers=[('ETag', '"{}"'.format(md5))])
+
+    def _complete_upload(self, upload_id, body):
+        try:
+            upload = self.uploads.pop(upload_id)
+        except KeyError:
+            return _no_such_upload()
+        part_nums = [int(n) for n in
+                     re.findall(r'<PartNumber>(\d+)</PartNumber>', body)]
+        try:
+            parts = [upload['parts'][n] for n in part_nums]
+        except KeyError:
+            return _error('400 Bad Request', 'InvalidPart',
+                          'One or more of the specified parts could not '
+                          'be found.')
+        digests = ''.join(unhexlify(md5) for md5, size in parts)
+        etag = '{}-{}'.format(hashlib.md5(digests).hexdigest(), len(parts))
+        self._store(upload['key'], etag, sum(size for md5, size in parts),
+                    upload['headers'])
+        return _ok(XML + '<CompleteMultipartUploadResult>'
+                   '<Key>{}</Key><ETag>"{}"</ETag>'
+                   '</CompleteMultipartUploadResult>'.format(
+                       escape(upload['key']), etag))
+
+    def _list_parts(self, upload_id):
+        try:
+            upload = self.uploads[upload_id]
+        except KeyError:
+            return _no_such_upload()
+        out = [XML, '<ListPartsResult>']
+        for part_num, (md5, size) in sorted(upload['parts'].items()):
+            out.append('<Part><PartNumber>{}</PartNumber><ETag>"{}"</ETag>'
+                       '<Size>{}</Size></Part>'.format(part_num, md5, size))
+        out.append('<IsTruncated>false</IsTruncated></ListPartsResult>')
+        return _ok(''.join(out))
+
+
+def _subresource(params):
+    return [p for p in params if p not in ('prefix', 'marker', 'max-keys')]
+
+
+def _amz_headers(headers):
+    return dict((k, v) for k, v in headers.items()
+                if k.startswith('x-amz-meta-') or
+                k == 'x-amz-website-redirect-location')
+
+
+def _timestamp():
+    return time.strftime('%Y-%m-%dT%H:%M:%S.000Z', time.gmtime())
+
+
+def _ok(data='', headers=None, status='200 OK'):
+    return status, headers or [], data
+
+
+def _error(status, code, message):
+    data = (XML + '<Error><Code>{}</Code><Message>{}</Message>'
+            '</Error>').format(code, message)
+    return status, [('Content-Type', 'application/xml')], data
+
+
+def _no_such_upload():
+    return _error('404 Not Found', 'NoSuchUpload',
+                  'The specified upload does not exist.')
+
+
+def parse_size(s):
+    """Return the bytes in a size like 4096, 512K, 8M or 1G."""
+    s = s.strip().upper()
+    suffix = s[-1:] if s[-1:] in _SIZE_SUFFIXES else ''
+    return int(float(s[:len(s) - len(suffix)]) * _SIZE_SUFFIXES[suffix])
+
+
+def parse_size_distribution(spec):
+    """Parse 'SIZE:WEIGHT,...' (e.g. '4K:90,8M:10') into (size, weight)s.
+
+    A size without a weight has a weight of 1.
+
+    """
+    dist = []
+    for item in spec.split(','):
+        size, _, weight = item.partition(':')
+        dist.append((parse_size(size), float(weight or 1)))
+    if not dist or any(w < 0 for s, w in dist) or \
+            sum(w for s, w in dist) <= 0:
+        raise ValueError('invalid size distribution: {}'.format(spec))
+    return dist
+
+
+def _write_random(path, size):
+    with open(path, 'wb') as f:
+        while size > 0:
+            chunk = min(size, 1048576)
+            f.write(os.urandom(chunk))
+            size -= chunk
+
+
+def make_tree(root, files, sizes, rng):
+    """Write files files of random contents under root.
+
+    Sizes are drawn from sizes, a list of (size, weight), and files are
+    spread over directories of 100. Returns the paths written.
+
+    """
+    total = sum(w for s, w in sizes)
+    paths = []
+    for i in range(files):
+        pick = rng.random() * total
+        for size, weight in sizes:
+            pick -= weight
+            if pick < 0:
+                break
+        directory = os.path.join(root, 'dir{:04d}'.format(i // 100))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, 'file{:06d}.bin'.format(i))
+        _write_random(path, size)
+        paths.append(path)
+    return paths
+
+
+def change_tree(paths, fraction, rng):
+    """Rewrite a random fraction of paths with new contents.
+
+    Returns the paths changed.
+
+    """
+    changed = rng.sample(paths, int(round(len(paths) * fraction)))
+    for path in changed:
+        _write_random(path, os.path.getsize(path))
+    return changed
+
+
+def peak_memory():
+    """Return the peak resident memory of this process so far, in MB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts in kilobytes, OS X in bytes.
+    if sys.platform == 'darwin':
+        return peak / 1048576.0
+    return peak / 1024.0
+
+
+def _version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('s3tup').version
+    except Exception:
+        return None
+
+
+def run_scenario(name, stand_in, src, concurrency, rsync, keys):
+
+    """Sync src to the stand-in's bucket and return how it went.
+
+    The bucket is parsed from a config, as the cli does, and synced with
+    Bucket.sync through a real Connection. keys is the number of keys
+    synced, to report keys per second by.
+
+    """
+    config = [{
+        'bucket': BUCKET,
+        'hostname': stand_in.hostname,
+        'access_key_id': 'access_key_id',
+        'secret_access_key': 'secret_access_key',
+        'rsync': {'src': src, 'delete': True},
+    }]
+    bucket = parse_config(config)[0]
+    bucket.conn.concurrency = concurrency
+    stand_in.reset_stats()
+
+    failed = None
+    start = time.time()
+    try:
+        bucket.sync(rsync=rsync)
+    except Exception as e:
+        failed = '{}: {}'.format(type(e).__name__, e)
+    seconds = time.time() - start
+
+    requests = sum(bucket.conn.stats.values())
+    sent = stand_in.stats['received_bytes']
+    result = {
+        'name': name,
+        'seconds': round(seconds, 3),
+        'keys': keys,
+        'keys_per_sec': round(keys / seconds, 1),
+        'bytes_sent': sent,
+        'mb_per_sec': round(sent / seconds / 1048576, 3),
+        'requests': requests,
+        'requests_by_method': bucket.conn.stats,
+        'requests_per_key': round(float(requests) / max(keys, 1), 3),
+        'errors_injected': stand_in.stats['errors'],
+        'peak_memory_mb': round(peak_memory(), 1),
+        'failed': failed,
+    }
+    log.info('{}: {} keys in {:.2f}s ({} keys/sec, {} MB/sec, {} requests)'
+             '{}'.format(name, keys, seconds, result['keys_per_sec'],
+                         result['mb_per_sec'], requests,
+                         ', failed' if failed else ''))
+    return result
+
+
+def run_bench(files=None, sizes=None, changed=None, latency=None,
+              bandwidth=None, error_rate=0, concurrency=5, seed=0,
+              directory=None):
+
+    """Benchmark syncing a synthetic tree to a local stand-in for s3.
+
+    Writes files files, with sizes drawn from sizes (a list of (size,
+    weight), see parse_size_distribution), and times three scenarios
+    against a StandIn with the given latency, bandwidth and error_rate:
+    uploading them all to an empty bucket (sync), syncing them all again
+    unchanged (resync), and rsyncing after a changed fraction of them has
+    been rewritten (rsync). Defaults are constants.BENCH_*.
+
+    The tree is written under directory, or a temporary directory that's
+    removed afterwards. Returns a json serializable report.
+
+    """
+    if files is None:
+        files = constants.BENCH_FILES
+    if sizes is None:
+        sizes = parse_size_distribution(constants.BENCH_SIZES)
+    if changed is None:
+        changed = constants.BENCH_CHANGED
+    if latency is None:
+        latency = constants.BENCH_LATENCY
+
+    if concurrency > 0:
+        monkey_patch()
+    rng = random.Random(seed)
+    tmp = None
+    if directory is None:
+        directory = tmp = mkdtemp(prefix='s3tup-bench-')
+    src = os.path.join(directory, 'src')
+
+    try:
+        log.info('writing {} files to {}...'.format(files, src))
+        paths = make_tree(src, files, sizes, rng)
+        report = {
+            's3tup': _version(),
+            'python': platform.python_version(),
+            'files': files,
+            'bytes': sum(os.path.getsize(p) for p in paths),
+            'sizes': [list(s) for s in sizes],
+            'changed': changed,
+            'latency': latency,
+            'bandwidth': bandwidth,
+            'error_rate': error_rate,
+            'concurrency': concurrency,
+            'seed': seed,
+            'scenarios': [],
+        }
+        with StandIn(latency, bandwidth, error_rate, seed) as stand_in:
+            for name, rsync in (('sync', False), ('resync', False)):
+                report['scenarios'].append(run_scenario(
+                    name, stand_in, src, concurrency, rsync, files))
+            change_tree(paths, changed, rng)
+            report['scenarios'].append(run_scenario(
+                'rsync', stand_in, src, concurrency, True, files))
+        return report
+    finally:
+        if tmp is not None:
+            shutil.rmtree(tmp)
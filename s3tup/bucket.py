@@ -1,11 +1,15 @@
 from collections import namedtuple
 import logging
+import os
+import time
 
-from bs4 import BeautifulSoup
-
+from s3tup.exception import S3ResponseError
 from s3tup.key import KeyFactory, delete_key
 from s3tup.rsync import RsyncPlanner
 import s3tup.constants as constants
+import s3tup.redirectcache as redirectcache
+import s3tup.schedule as schedule
+import s3tup.utils as utils
 
 log = logging.getLogger('s3tup.bucket')
 
@@ -20,6 +24,10 @@ class Bucket(object):
     delete, modify, and then sync to s3 using the various sync methods
     provided.
 
+    If redirect_cache is set to an s3tup.redirectcache.RedirectCache,
+    redirects are recorded in it as they're put, and planned redirects
+    that are still in place unchanged are skipped.
+
     """
 
     def __init__(self, conn, name, key_factory=None, rsync_planner=None,
@@ -29,6 +37,7 @@ class Bucket(object):
         self.key_factory = key_factory or KeyFactory()
         self.rsync_planner = rsync_planner or RsyncPlanner()
         self.redirects = kwargs.pop('redirects', {})
+        self.redirect_cache = None
 
         # Add all kwargs passed in that are named in
         # constants.BUCKET_ATTRS to this object instance
@@ -63,21 +72,77 @@ class Bucket(object):
         key = self.make_key(key_name)
         key.sync()
 
-    def upload_key_from_path(self, key_name, path):
+    def upload_key_from_path(self, key_name, path, descriptor=None):
+        key = self.make_key(key_name)
+        key.upload_from_path(path, descriptor)
+
+    def upload_key_from_file(self, key_name, f, descriptor=None):
         key = self.make_key(key_name)
-        key.upload_from_path(path)
+        key.upload_from_file(f, descriptor)
 
-    def upload_key_from_file(self, key_name, f):
+    def upload_key_from_stream(self, key_name, stream):
         key = self.make_key(key_name)
-        key.upload_from_file(f)
+        key.upload_from_stream(stream)
 
     def upload_key_from_string(self, key_name, string):
         key = self.make_key(key_name)
         key.upload_from_string(string)
 
-    def redirect_key(self, key_name, url):
+    def download_key_to_path(self, key_name, path, size=None, etag=None,
+                             modified=None, unverified=False):
         key = self.make_key(key_name)
-        key.redirect(url)
+        key.download_to_path(path, size, etag, modified, unverified)
+
+    def redirect_key(self, key_name, url):
+        self.put_redirect(self.make_key(key_name), url)
+
+    def put_redirect(self, key, url):
+        """Make key redirect to url, recording it in redirect_cache."""
+        resp = key.redirect(url)
+        if self.redirect_cache is not None:
+            # S3 doesn't send last-modified with PUT responses, but the
+            # date it responded at is as close.
+            put_time = None
+            if resp is not None:
+                put_time = utils.parse_http_date(
+                    resp.headers.get('last-modified') or
+                    resp.headers.get('date'))
+            self.redirect_cache.store(self._cache_name, key.name,
+                                      self._redirect_fingerprint(key, url),
+                                      put_time)
+
+    @property
+    def _cache_name(self):
+        return '{}/{}'.format(self.conn.hostname, self.name)
+
+    def _redirect_fingerprint(self, key, url):
+        return redirectcache.fingerprint(url, key.get_headers())
+
+    def skip_unchanged_redirects(self, plan, remote_keys):
+        """Remove the redirects in place unchanged from plan.
+
+        A redirect is unchanged if redirect_cache has it with the same
+        url and headers and its key, as listed in remote_keys, is still
+        the empty object that was put. Returns how many were removed.
+
+        """
+        if self.redirect_cache is None:
+            return 0
+        unchanged = []
+        for k, url in plan.to_redirect:
+            s3_key = remote_keys.get(k)
+            if s3_key is None or s3_key.size != 0:
+                continue
+            fingerprint = self._redirect_fingerprint(self.make_key(k), url)
+            if self.redirect_cache.matches(self._cache_name, k, fingerprint,
+                                           s3_key.modified):
+                unchanged.append(k)
+        self.redirect_cache.flush()
+        for k in unchanged:
+            plan.remove_key(k)
+        if unchanged:
+            log.info('skipping {} unchanged redirects'.format(len(unchanged)))
+        return len(unchanged)
 
     def delete_key(self, key_name):
         delete_key(self.conn, self.name, key_name)
@@ -127,10 +192,15 @@ class Bucket(object):
             params = {'marker': marker, 'prefix': prefix}
             resp = self.make_request('GET', params=params)
 
-            root = BeautifulSoup(resp.text).find('listbucketresult')
+            root = utils.soup(resp.text).find('listbucketresult')
             for c in root.find_all('contents'):
                 key = c.find('key').text
                 marker = key
+                # Shard barrier markers aren't part of the bucket proper.
+                if key.startswith(constants.SHARD_MARKER_PREFIX) and not \
+                        (prefix or '').startswith(
+                            constants.SHARD_MARKER_PREFIX):
+                    continue
                 modified = c.find('lastmodified').text
                 size = int(c.find('size').text)
                 md5 = c.find('etag').text.replace('"', '')
@@ -140,24 +210,101 @@ class Bucket(object):
 
         return keys
 
+    def get_remote_part_size(self, key_name):
+        """Return the part size recorded on a multipart key, or None."""
+        try:
+            resp = self.conn.make_request('HEAD', self.name, key_name)
+        except S3ResponseError:
+            return None
+        meta = 'x-amz-meta-' + constants.MULTIPART_PART_SIZE_META
+        try:
+            return int(resp.headers[meta])
+        except (KeyError, ValueError):
+            return None
+
+    def get_multipart_uploads(self, prefix=None):
+        """Return list of in-progress multipart uploads in this bucket.
+
+        Each namedtuple returned contains fields 'name', 'upload_id' and
+        'initiated' (in seconds since the epoch).
+
+        """
+        UploadTuple = namedtuple('UploadTuple',
+                                 ['name', 'upload_id', 'initiated'])
+        uploads = []
+        more = True
+        key_marker = None
+        upload_id_marker = None
+
+        while more:
+
+            params = {'key-marker': key_marker, 'prefix': prefix,
+                      'upload-id-marker': upload_id_marker}
+            resp = self.make_request('GET', 'uploads', params=params)
+
+            root = utils.soup(resp.text).find('listmultipartuploadsresult')
+            for u in root.find_all('upload'):
+                key_marker = u.find('key').text
+                upload_id_marker = u.find('uploadid').text
+                initiated = utils.parse_timestamp(u.find('initiated').text)
+                uploads.append(
+                    UploadTuple(key_marker, upload_id_marker, initiated))
+
+            more = root.find('istruncated').text == 'true'
+
+        return uploads
+
+    def abort_stale_uploads(self, max_age=None):
+        """Abort multipart uploads journaled here that were abandoned.
+
+        Uploads in the key factory's journal that were started over
+        max_age seconds (defaults to constants.UPLOAD_JOURNAL_MAX_AGE) ago
+        are aborted and dropped from it. Uploads this journal didn't start
+        (other tools', or other machines') are left alone. Only runs when
+        the key factory has a journal.
+
+        """
+        journal = self.key_factory.journal
+        if journal is None:
+            return
+        if max_age is None:
+            max_age = constants.UPLOAD_JOURNAL_MAX_AGE
+        cutoff = time.time() - max_age
+
+        reqs = []
+        for key_name, entry in journal.items(self.name):
+            if entry['time'] < cutoff:
+                reqs.append([self._abort_journaled_upload, key_name,
+                             entry['upload_id']])
+        self.conn.join(reqs)
+
+    def _abort_journaled_upload(self, key_name, upload_id):
+        log.info('abort upload: s3://{}/{}'.format(self.name, key_name))
+        self.make_key(key_name)._abort_multipart_upload(upload_id)
+        self.key_factory.journal.finish(self.name, key_name, upload_id)
+
     # SYNC METHODS
 
-    def sync(self, dryrun=False, rsync=False, create_bucket=False):
+    def sync(self, dryrun=False, rsync=False, create_bucket=False,
+             shard=None):
         """Sync all of this bucket's configurations.
 
         Takes every applicable attribute set on this Bucket object and
         configures its respective s3 bucket (defined by self.name) to match
         it. Optional rsync only mode will only run rsync (no setting bucket
         configuration, no syncing unmodified keys, no making redirects).
+        If shard (an s3tup.shard.Shard) is given, only that shard's keys
+        are synced, and the bucket itself is only configured by shard 0.
 
         """
         log.info("syncing bucket '{}'...".format(self.name))
 
-        if create_bucket:
-            self.create()
-        if not rsync:
-            self.sync_bucket(dryrun=dryrun)
-        self.sync_keys(dryrun=dryrun, rsync=rsync)
+        if shard is None or shard.deletes:
+            if create_bucket:
+                self.create()
+            if not rsync:
+                self.sync_bucket(dryrun=dryrun)
+        self.sync_keys(dryrun=dryrun, rsync=rsync, shard=shard)
 
         log.info("bucket '{}' sucessfully synced!\n".format(self.name))
 
@@ -198,54 +345,148 @@ class Bucket(object):
         if dryrun:
             self.make_request = tmp
 
-    def sync_keys(self, dryrun=False, rsync=False):
-        plan = self._create_action_plan(rsync)
+    def sync_keys(self, dryrun=False, rsync=False, shard=None):
+        plan = self.create_action_plan(rsync)
         if not dryrun:
-            self._execute_action_plan(plan)
-        else:
-            for k, path in plan.to_upload:
+            self.abort_stale_uploads()
+        self.execute_action_plan(plan, dryrun, shard)
+
+    def execute_action_plan(self, plan, dryrun=False, shard=None):
+        """Execute an s3tup.rsync.ActionPlan, or just log it if dryrun.
+
+        If shard (an s3tup.shard.Shard) is given, only its part of the
+        plan is executed.
+
+        """
+        if not dryrun:
+            try:
+                self._execute_action_plan(plan, shard)
+            finally:
+                if self.redirect_cache is not None:
+                    self.redirect_cache.flush()
+            return
+
+        def owned(k):
+            return shard is None or shard.owns(k)
+
+        for k, path in plan.to_upload:
+            if owned(k):
                 log.info("upload: {} <- {}".format(k, path))
-            for k in plan.to_sync:
+        for k, url in plan.to_redirect:
+            if owned(k):
+                log.info("redirect: {} -> {}".format(k, url))
+        for k in plan.to_sync:
+            if owned(k):
                 log.info("sync: {}".format(k))
+        if shard is None or shard.deletes:
             for k in plan.to_delete:
                 log.info("delete: {}".format(k))
 
-    def _create_action_plan(self, rsync=False):
+    def download_keys(self, dryrun=False, unverified=False):
+        """Rsync keys from this bucket down into the local rsync srcs.
+
+        The reverse of rsyncing: new and modified keys are downloaded, and
+        local files missing from the bucket are deleted for rsync configs
+        that have delete set. Nothing in the bucket is changed. unverified
+        is passed on to Key.download_to_path.
+
+        """
+        remote_keys = self.get_remote_keys()
+        plan = self.rsync_planner.plan_download(remote_keys, self)
+        if not dryrun:
+            self._execute_download_plan(plan, remote_keys, unverified)
+        else:
+            for k, path in plan.to_download:
+                log.info("download: {} -> {}".format(k, path))
+            for k, path in plan.to_local_delete:
+                log.info("delete: {}".format(path))
+
+    def create_action_plan(self, rsync=False):
 
         remote_keys = self.get_remote_keys()
-        plan = self.rsync_planner.plan(remote_keys)
+        plan = self.rsync_planner.plan(remote_keys, self)
+        # Only rsync's own actions (including redirects of symlinks).
+        if rsync:
+            plan.remove_actions('sync')
+            self.skip_unchanged_redirects(plan, remote_keys)
+            return plan
 
         # Add in redirects
         for key, url in self.redirects.items():
             plan.add_redirect(key, url)
 
         # Sync all keys with no action yet associated.
-        affected_keys = set(plan.affected_keys)
-        old_keys = set(remote_keys.keys())
-        for k in (old_keys-affected_keys):
-            plan.add_sync(k)
-
-        if rsync:
-            plan.remove_actions('sync', 'redirect')
+        for k in remote_keys:
+            if k not in plan:
+                plan.add_sync(k)
 
+        # After syncs are added, so that skipped redirects are left alone.
+        self.skip_unchanged_redirects(plan, remote_keys)
         return plan
 
-    def _execute_action_plan(self, plan):
-        actions = []
+    def _execute_action_plan(self, plan, shard=None):
+
+        """Execute plan, or just shard's slice of it.
+
+        Sharded deletes are left to shard 0, which only makes them once
+        every shard is done with the rest of the plan, so that nothing is
+        deleted while another shard still uploads what replaces it.
+
+        """
+        model = schedule.CostModel.from_connection(self.conn)
+        jobs = []
+
+        def owned(k):
+            return shard is None or shard.owns(k)
 
         for k, path in plan.to_upload:
-            actions.append([self.upload_key_from_path, k, path])
+            if owned(k):
+                descriptor = plan.get_descriptor(k)
+                costs = model.upload(_upload_size(path, descriptor))
+                jobs.append((costs, [self.upload_key_from_path, k, path,
+                                     descriptor]))
 
         for k, url in plan.to_redirect:
-            actions.append([self.redirect_key, k, url])
+            if owned(k):
+                jobs.append(([model.request()], [self.redirect_key, k, url]))
 
         for k in plan.to_sync:
-            actions.append([self.sync_key, k])
+            if owned(k):
+                jobs.append(([model.request()], [self.sync_key, k]))
 
-        actions.append([self.delete_keys, list(plan.to_delete)])
+        if shard is None:
+            to_delete = list(plan.to_delete)
+            costs = [model.request()] * -(-len(to_delete) // 1000)
+            jobs.append((costs, [self.delete_keys, to_delete]))
+            schedule.execute(self.conn, jobs)
+            return
 
+        barrier = shard.barrier(self)
+        try:
+            schedule.execute(self.conn, jobs)
+            barrier.arrive(shard.index)
+            if shard.deletes:
+                barrier.prune()
+                barrier.wait()
+                self.delete_keys(list(plan.to_delete))
+        finally:
+            if shard.deletes:
+                barrier.clear()
+
+    def _execute_download_plan(self, plan, remote_keys, unverified=False):
+        actions = []
+        for k, path in plan.to_download:
+            s3_key = remote_keys[k]
+            actions.append([self.download_key_to_path, k, path, s3_key.size,
+                            s3_key.md5, s3_key.modified, unverified])
+        for k, path in plan.to_local_delete:
+            actions.append([self._delete_local_path, path])
         self.conn.join(actions)
 
+    def _delete_local_path(self, path):
+        log.info('delete: {}'.format(path))
+        os.remove(path)
+
     # INDIVIDUAL BUCKET SYNCING METHODS
     #
     # Each checks if this bucket has its respective attr set and, if it does,
@@ -398,3 +639,12 @@ class Bucket(object):
         else:
             log.info("delete website configuration")
             return self.make_request('DELETE', 'website')
+
+
+def _upload_size(path, descriptor=None):
+    if descriptor is not None:
+        return descriptor.size
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
@@ -1,10 +1,15 @@
+from binascii import hexlify
 import argparse
+import json
 import logging
 import textwrap
 import sys
 import os
 
-from s3tup.parse import load_config, parse_config
+# Everything else is imported by the (sub)commands that use it, so that
+# startup (and --help) stays quick.
+import s3tup.constants as constants
+import s3tup.utils as utils
 
 log = logging.getLogger('s3tup')
 title = (
@@ -16,8 +21,87 @@ title = (
     "                   /_/       \n"
 )
 
+# Subcommands, given before any other argument. Without one, s3tup syncs.
+COMMANDS = ('plan', 'apply', 'bench')
+
+
+def add_common_arguments(parser):
+    add_verbosity_arguments(parser)
+    parser.add_argument(
+        '--access_key_id')
+    parser.add_argument(
+        '--secret_access_key')
+    parser.add_argument(
+        '--temporary_security_token')
+
+
+def add_verbosity_arguments(parser):
+    verbosity = parser.add_mutually_exclusive_group()
+    verbosity.add_argument(
+        '-v', '--verbose',
+        action='store_true',
+        help='increase output verbosity')
+    verbosity.add_argument(
+        '-q', '--quiet',
+        action='store_true',
+        help='silence all output')
+
+
+def add_planning_arguments(parser):
+    parser.add_argument(
+        '--rsync',
+        action='store_true',
+        help='only sync keys that have been modified or removed')
+    parser.add_argument(
+        '--no-hash-cache',
+        dest='hash_cache',
+        action='store_false',
+        help="don't cache the md5s of local files between runs")
+    add_redirect_cache_argument(parser)
+    parser.add_argument(
+        '--config-cache',
+        action='store_true',
+        help='cache the parsed config, so it is only parsed again once it '
+             'changes')
+    parser.add_argument(
+        '--hash-workers',
+        type=int,
+        metavar='WORKERS',
+        help='number of threads hashing local files (default: one per cpu)')
+
+
+def add_redirect_cache_argument(parser):
+    parser.add_argument(
+        '--no-redirect-cache',
+        dest='redirect_cache',
+        action='store_false',
+        help="don't keep track of the redirects put, and put them all again "
+             "instead of skipping unchanged ones")
+
+
+def add_shard_arguments(parser):
+    parser.add_argument(
+        '--shard',
+        metavar='INDEX/COUNT',
+        help='only execute this slice of the plan, e.g. 0/4 on the first '
+             'of four machines; shard 0 also makes the deletes')
+    parser.add_argument(
+        '--shard-barrier',
+        metavar='DIR',
+        help='directory shared by all shards to coordinate deletes in '
+             '(default: marker objects in the bucket)')
+    parser.add_argument(
+        '--shard-run-id',
+        metavar='ID',
+        help='id of this run, the same for all shards and new for every '
+             'run (required with --shard)')
+
+
 parser = argparse.ArgumentParser(
-    description='s3tup: configuration management and deployment for AmazonS3')
+    prog='s3tup',
+    description='s3tup: configuration management and deployment for AmazonS3',
+    epilog='run "s3tup plan -h" and "s3tup apply -h" for planning ahead, '
+           'and "s3tup bench -h" for benchmarking')
 parser.add_argument(
     'config_path',
     help='path to your configuration file')
@@ -26,36 +110,159 @@ parser.add_argument(
     action='store_true',
     help='preview what will happen when this command runs')
 parser.add_argument(
-    '--rsync',
+    '--download',
     action='store_true',
-    help='only sync keys that have been modified or removed')
+    help='rsync the other way: download modified keys from the bucket')
+parser.add_argument(
+    '--download-unverified',
+    action='store_true',
+    help='with --download, keep multipart keys whose etag can\'t be '
+         'verified instead of failing')
+parser.add_argument(
+    '--watch',
+    action='store_true',
+    help='keep running, rsyncing local changes as they happen (linux only)')
+parser.add_argument(
+    '--resume',
+    action='store_true',
+    help='journal multipart uploads and resume them if interrupted')
+add_planning_arguments(parser)
+add_shard_arguments(parser)
 parser.add_argument(
     '-c',
     type=int,
     metavar='CONCURRENCY',
     help='number of concurrent requests (default: 5)')
-verbosity = parser.add_mutually_exclusive_group()
-verbosity.add_argument(
-    '-v', '--verbose',
+add_common_arguments(parser)
+
+plan_parser = argparse.ArgumentParser(
+    prog='s3tup plan',
+    description='plan syncing your configuration and write the plan to a '
+                'file, to be executed later with s3tup apply')
+plan_parser.add_argument(
+    'config_path',
+    help='path to your configuration file')
+plan_parser.add_argument(
+    '--out',
+    required=True,
+    metavar='PLAN',
+    help='path to write the plan to (gzipped if it ends in .gz)')
+add_planning_arguments(plan_parser)
+add_common_arguments(plan_parser)
+
+apply_parser = argparse.ArgumentParser(
+    prog='s3tup apply',
+    description='execute a plan written by s3tup plan')
+apply_parser.add_argument(
+    'plan_path',
+    help='path to the plan file')
+apply_parser.add_argument(
+    '--dryrun',
     action='store_true',
-    help='increase output verbosity')
-verbosity.add_argument(
-    '-q', '--quiet',
+    help='preview what will happen when this command runs')
+apply_parser.add_argument(
+    '--resume',
     action='store_true',
-    help='silence all output')
-parser.add_argument(
-    '--access_key_id')
-parser.add_argument(
-    '--secret_access_key')
-parser.add_argument(
-    '--temporary_security_token')
+    help='journal multipart uploads and resume them if interrupted')
+add_redirect_cache_argument(apply_parser)
+add_shard_arguments(apply_parser)
+apply_parser.add_argument(
+    '-c',
+    type=int,
+    metavar='CONCURRENCY',
+    help='number of concurrent requests (default: 5)')
+add_common_arguments(apply_parser)
+
+# Argument types of bench_parser, named after the s3tup.bench functions
+# they defer to so that argparse's errors read the same.
+def parse_size(s):
+    from s3tup.bench import parse_size
+    return parse_size(s)
 
 
-def main():
+def parse_size_distribution(s):
+    from s3tup.bench import parse_size_distribution
+    return parse_size_distribution(s)
+
+
+bench_parser = argparse.ArgumentParser(
+    prog='s3tup bench',
+    description='benchmark syncing a generated tree of files to a local '
+                'stand-in for s3, and report the results as json')
+bench_parser.add_argument(
+    '--files',
+    type=int,
+    default=constants.BENCH_FILES,
+    help='number of files to generate (default: %(default)s)')
+bench_parser.add_argument(
+    '--sizes',
+    type=parse_size_distribution,
+    default=constants.BENCH_SIZES,
+    metavar='SIZE:WEIGHT,...',
+    help='distribution of file sizes (default: %(default)s)')
+bench_parser.add_argument(
+    '--changed',
+    type=float,
+    default=constants.BENCH_CHANGED,
+    metavar='FRACTION',
+    help='fraction of files changed before rsyncing (default: %(default)s)')
+bench_parser.add_argument(
+    '--latency',
+    type=float,
+    default=constants.BENCH_LATENCY,
+    metavar='SECONDS',
+    help='latency of every request (default: %(default)s)')
+bench_parser.add_argument(
+    '--bandwidth',
+    type=parse_size,
+    metavar='BYTES',
+    help='upload bandwidth of each request per second, e.g. 10M '
+         '(default: unlimited)')
+bench_parser.add_argument(
+    '--error-rate',
+    type=float,
+    default=0,
+    metavar='FRACTION',
+    help='fraction of requests failed with a 500 (default: 0)')
+bench_parser.add_argument(
+    '--seed',
+    type=int,
+    default=0,
+    help='seed of the file sizes, changes and errors (default: 0)')
+bench_parser.add_argument(
+    '--dir',
+    help='directory to generate files in (default: a temporary one)')
+bench_parser.add_argument(
+    '--out',
+    metavar='REPORT',
+    help='path to write the json report to (default: stdout)')
+bench_parser.add_argument(
+    '-c',
+    type=int,
+    default=5,
+    metavar='CONCURRENCY',
+    help='number of concurrent requests (default: 5)')
+add_verbosity_arguments(bench_parser)
+
+
+def main(argv=None):
 
     """Command line interface entry point."""
 
-    args = parser.parse_args()
+    if argv is None:
+        argv = sys.argv[1:]
+    command = None
+    if argv and argv[0] in COMMANDS:
+        command, argv = argv[0], argv[1:]
+
+    if command == 'plan':
+        args = plan_parser.parse_args(argv)
+    elif command == 'apply':
+        args = apply_parser.parse_args(argv)
+    elif command == 'bench':
+        args = bench_parser.parse_args(argv)
+    else:
+        args = parser.parse_args(argv)
 
     if not (args.quiet or args.verbose):
         log.addHandler(make_wrapped_handler('%(message)s'))
@@ -63,11 +270,41 @@ def main():
     elif args.verbose:
         logging.basicConfig(format='%(levelname)s: %(message)s',
                             level=logging.DEBUG)
+    # Only the bench's own progress, not every key it syncs.
+    if command == 'bench' and not args.verbose:
+        log.setLevel(logging.WARNING)
+        logging.getLogger('s3tup.bench').setLevel(
+            logging.WARNING if args.quiet else logging.INFO)
 
     try:
-        run(args.config_path, args.dryrun, args.rsync, args.c,
-            args.access_key_id, args.secret_access_key,
-            args.temporary_security_token)
+        shard = None
+        if getattr(args, 'shard', None) is not None:
+            if args.shard_run_id is None:
+                raise ValueError('--shard needs --shard-run-id')
+            from s3tup.shard import Shard
+            shard = Shard.parse(args.shard, args.shard_barrier,
+                                args.shard_run_id)
+        if command == 'plan':
+            run_plan(args.config_path, args.out, args.rsync,
+                     args.access_key_id, args.secret_access_key,
+                     args.hash_cache, args.hash_workers, args.config_cache,
+                     args.redirect_cache)
+        elif command == 'apply':
+            run_apply(args.plan_path, args.dryrun, args.c,
+                      args.access_key_id, args.secret_access_key,
+                      args.temporary_security_token, args.resume, shard,
+                      args.redirect_cache)
+        elif command == 'bench':
+            run_bench(args.files, args.sizes, args.changed, args.latency,
+                      args.bandwidth, args.error_rate, args.c, args.seed,
+                      args.dir, args.out)
+        else:
+            run(args.config_path, args.dryrun, args.rsync, args.c,
+                args.access_key_id, args.secret_access_key,
+                args.temporary_security_token, args.resume, args.download,
+                args.hash_cache, args.hash_workers, args.watch, shard,
+                args.config_cache, args.redirect_cache,
+                args.download_unverified)
     except Exception as e:
         if args.verbose:
             raise
@@ -75,26 +312,169 @@ def main():
         sys.exit(1)
 
 
-def run(config, dryrun=False, rsync=False, concurrency=None,
-        access_key_id=None, secret_access_key=None,
-        temporary_security_token=None):
-
+def set_credentials(access_key_id=None, secret_access_key=None):
     if access_key_id is not None:
         os.environ['AWS_ACCESS_KEY_ID'] = access_key_id
     if secret_access_key is not None:
         os.environ['AWS_SECRET_ACCESS_KEY'] = secret_access_key
 
-    config = load_config(config)
-    buckets = parse_config(config)
 
-    log.info(title)
+def configure_buckets(buckets, concurrency=None,
+                      temporary_security_token=None, resume=False,
+                      hash_cache=False, hash_workers=None,
+                      redirect_cache=False):
+    journal = None
+    if resume:
+        from s3tup.journal import UploadJournal
+        journal = UploadJournal()
+    if hash_cache:
+        from s3tup.hashcache import HashCache
+        hash_cache = HashCache()
+    else:
+        hash_cache = None
+    if redirect_cache:
+        from s3tup.redirectcache import RedirectCache
+        redirect_cache = RedirectCache()
+    else:
+        redirect_cache = None
 
     for b in buckets:
+        b.redirect_cache = redirect_cache
+        if journal is not None:
+            b.key_factory.journal = journal
+        for c in b.rsync_planner.configs:
+            if hash_cache is not None:
+                c.hash_cache = hash_cache
+            if hash_workers is not None:
+                c.hash_workers = hash_workers
         if concurrency is not None:
             b.conn.concurrency = concurrency
         if temporary_security_token is not None:
             b.conn.temporary_security_token = temporary_security_token
-        b.sync(dryrun=dryrun, rsync=rsync)
+
+
+def run(config, dryrun=False, rsync=False, concurrency=None,
+        access_key_id=None, secret_access_key=None,
+        temporary_security_token=None, resume=False, download=False,
+        hash_cache=False, hash_workers=None, watch=False, shard=None,
+        config_cache=False, redirect_cache=False, download_unverified=False):
+
+    if download_unverified and not download:
+        raise ValueError("--download-unverified needs --download")
+    if watch and download:
+        raise ValueError("--watch can't be combined with --download")
+    if shard is not None and (watch or download):
+        raise ValueError("--shard can't be combined with --watch or "
+                         "--download")
+
+    set_credentials(access_key_id, secret_access_key)
+    if shard is not None and shard.barrier_id is None:
+        shard.barrier_id = _file_digest(config)
+    from s3tup.parse import load_buckets
+    buckets = load_buckets(config, _config_cache_dir(config_cache))
+
+    log.info(title)
+
+    configure_buckets(buckets, concurrency, temporary_security_token,
+                      resume, hash_cache, hash_workers, redirect_cache)
+    for b in buckets:
+        if watch:
+            if not rsync:
+                b.sync_bucket(dryrun=dryrun)
+        elif download:
+            b.download_keys(dryrun=dryrun, unverified=download_unverified)
+        else:
+            b.sync(dryrun=dryrun, rsync=rsync, shard=shard)
+
+    if not dryrun:
+        from s3tup.compress import CompressionCache
+        CompressionCache().prune()
+
+    if watch:
+        watch_buckets(buckets, dryrun)
+
+
+def run_plan(config, out, rsync=False, access_key_id=None,
+             secret_access_key=None, hash_cache=False, hash_workers=None,
+             config_cache=False, redirect_cache=False):
+
+    """Plan syncing the keys of config and write the plan to out.
+
+    Bucket configuration isn't planned, only keys.
+
+    """
+    set_credentials(access_key_id, secret_access_key)
+    from s3tup.parse import load_buckets
+    buckets = load_buckets(config, _config_cache_dir(config_cache))
+    configure_buckets(buckets, hash_cache=hash_cache,
+                      hash_workers=hash_workers,
+                      redirect_cache=redirect_cache)
+
+    from s3tup.planfile import PlanWriter, open_plan
+    with open_plan(out, 'w') as f:
+        writer = PlanWriter(f)
+        for b in buckets:
+            plan = b.create_action_plan(rsync)
+            writer.write_plan(b, plan)
+            log.info("planned {} actions on bucket '{}'".format(
+                len(plan), b.name))
+
+
+# Shards on every machine run the same file, so its digest makes a barrier
+# id they all agree on.
+def _file_digest(path):
+    if not isinstance(path, basestring):
+        return None
+    with open(path, 'rb') as f:
+        return hexlify(utils.f_md5(f))
+
+
+def _config_cache_dir(config_cache):
+    return constants.CONFIG_CACHE_DIR if config_cache else None
+
+
+def run_apply(plan, dryrun=False, concurrency=None, access_key_id=None,
+              secret_access_key=None, temporary_security_token=None,
+              resume=False, shard=None, redirect_cache=False):
+    from s3tup.planfile import apply_plan, open_plan
+    set_credentials(access_key_id, secret_access_key)
+    journal = None
+    if resume:
+        from s3tup.journal import UploadJournal
+        journal = UploadJournal()
+    if redirect_cache:
+        from s3tup.redirectcache import RedirectCache
+        redirect_cache = RedirectCache()
+    else:
+        redirect_cache = None
+    barrier_id = None
+    if shard is not None:
+        barrier_id = _file_digest(plan)
+    with open_plan(plan) as f:
+        apply_plan(f, dryrun, concurrency, journal, temporary_security_token,
+                   shard, barrier_id, redirect_cache)
+
+
+def run_bench(files=None, sizes=None, changed=None, latency=None,
+              bandwidth=None, error_rate=0, concurrency=5, seed=0,
+              directory=None, out=None):
+    import s3tup.bench as bench
+    report = bench.run_bench(files, sizes, changed, latency, bandwidth,
+                             error_rate, concurrency, seed, directory)
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if out is None:
+        sys.stdout.write(data + '\n')
+    else:
+        with open(out, 'w') as f:
+            f.write(data + '\n')
+
+
+def watch_buckets(buckets, dryrun=False):
+    """Keep rsyncing each of buckets as their local files change."""
+    import gevent
+    from s3tup.watch import Watcher
+    watchers = [gevent.spawn(Watcher(b, dryrun).run) for b in buckets]
+    gevent.joinall(watchers, raise_error=True)
 
 
 def make_wrapped_handler(format):
@@ -0,0 +1,215 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+import zlib
+
+from s3tup.utils import UploadDescriptor
+import s3tup.constants as constants
+
+log = logging.getLogger('s3tup.compress')
+
+# Supported values of the compress key attribute. Each is also the
+# content-encoding the compressed key is served with.
+ALGORITHMS = ('gzip', 'deflate')
+
+DEFAULT_LEVEL = 9
+
+
+class CompressionCache(object):
+
+    """Compresses local files on demand and caches the results.
+
+    Compressed copies live in directory (constants.COMPRESSION_CACHE_DIR
+    by default), one per source path, algorithm and level, next to a small
+    json file recording the md5 of the compressed output and the
+    fingerprint (device, inode, size, mtime) of the source it was made
+    from. A copy is reused for as long as that fingerprint still matches.
+
+    Output is deterministic (gzip headers carry no name or timestamp), so
+    recompressing an unchanged file always gives the same etag.
+
+    Copies are kept until the cache is pruned (see prune).
+
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or constants.COMPRESSION_CACHE_DIR
+
+    def compress(self, path, algorithm='gzip', level=None):
+        """Return an UploadDescriptor of the compressed copy of path."""
+        if algorithm not in ALGORITHMS:
+            msg = "Unknown compression algorithm '{}'".format(algorithm)
+            raise ValueError(msg)
+        if level is None:
+            level = DEFAULT_LEVEL
+
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        fingerprint = [st.st_dev, st.st_ino, st.st_size, st.st_mtime]
+
+        name = hashlib.sha1(json.dumps([path, algorithm, level])).hexdigest()
+        out_path = os.path.join(self.directory, name)
+        meta_path = out_path + '.json'
+
+        descriptor = self._get_cached(out_path, meta_path, fingerprint)
+        if descriptor is not None:
+            return descriptor
+
+        log.debug('compress: {} ({} level {})'.format(path, algorithm,
+                                                      level))
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        # Temporary files are unique per call, as greenlets planning and
+        # uploading can be compressing the same path at once.
+        tmp = self._mkstemp()
+        try:
+            md5 = _compress(path, tmp, algorithm, level)
+            os.rename(tmp, out_path)
+        except:
+            _remove(tmp)
+            raise
+
+        out_st = os.stat(out_path)
+        meta = {'path': path, 'fingerprint': fingerprint, 'md5': md5,
+                'size': out_st.st_size, 'mtime': out_st.st_mtime}
+        tmp = self._mkstemp()
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmp, meta_path)
+        except:
+            _remove(tmp)
+            raise
+
+        return UploadDescriptor(out_path, out_st.st_size, out_st.st_mtime, md5)
+
+    def prune(self, max_size=None):
+
+        """Remove the copies that aren't worth keeping.
+
+        Those are copies of files that changed or no longer exist, and
+        then the oldest copies until the rest take up at most max_size
+        bytes (by default constants.COMPRESSION_CACHE_MAX_SIZE). Temporary
+        files left over from crashes are removed as well.
+
+        """
+        if max_size is None:
+            max_size = constants.COMPRESSION_CACHE_MAX_SIZE
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+
+        tmp_cutoff = time.time() - constants.COMPRESSION_CACHE_TMP_MAX_AGE
+        kept = []
+        for name in names:
+            path = os.path.join(self.directory, name)
+            if name.endswith('.tmp'):
+                try:
+                    if os.stat(path).st_mtime < tmp_cutoff:
+                        _remove(path)
+                except OSError:
+                    pass
+            elif name.endswith('.json'):
+                continue
+            elif self._is_current(path):
+                st = os.stat(path)
+                kept.append((st.st_mtime, st.st_size, path))
+            else:
+                log.debug('prune: {}'.format(path))
+                _remove(path + '.json')
+                _remove(path)
+
+        total = sum(size for mtime, size, path in kept)
+        for mtime, size, path in sorted(kept):
+            if total <= max_size:
+                break
+            log.debug('prune: {}'.format(path))
+            _remove(path + '.json')
+            _remove(path)
+            total -= size
+
+    def _is_current(self, out_path):
+        """Return whether out_path is the copy of its source as it is."""
+        try:
+            with open(out_path + '.json') as f:
+                source = json.load(f)['path']
+            st = os.stat(source)
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+        fingerprint = [st.st_dev, st.st_ino, st.st_size, st.st_mtime]
+        return self._get_cached(out_path, out_path + '.json',
+                                fingerprint) is not None
+
+    def _mkstemp(self):
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        os.close(fd)
+        return tmp
+
+    @staticmethod
+    def _get_cached(out_path, meta_path, fingerprint):
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            out_st = os.stat(out_path)
+        except (IOError, OSError, ValueError):
+            return None
+        if meta['fingerprint'] != fingerprint:
+            return None
+        # Make sure the compressed copy wasn't touched since either.
+        if out_st.st_size != meta['size'] or out_st.st_mtime != meta['mtime']:
+            return None
+        return UploadDescriptor(out_path, meta['size'], meta['mtime'],
+                                meta['md5'])
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class _HashingWriter(object):
+
+    """File wrapper that hashes everything written through it."""
+
+    def __init__(self, f):
+        self._f = f
+        self.md5 = hashlib.md5()
+
+    def write(self, data):
+        self.md5.update(data)
+        self._f.write(data)
+
+    def flush(self):
+        self._f.flush()
+
+
+def _compress(src, dest, algorithm, level):
+    """Compress src into dest and return the hex md5 of the output."""
+    with open(src, 'rb') as f_in, open(dest, 'wb') as f_out:
+        out = _HashingWriter(f_out)
+        if algorithm == 'gzip':
+            z = gzip.GzipFile(filename='', mode='wb', compresslevel=level,
+                              fileobj=out, mtime=0)
+            write, finish = z.write, z.close
+        else:
+            z = zlib.compressobj(level)
+            write = lambda data: out.write(z.compress(data))
+            finish = lambda: out.write(z.flush())
+        while True:
+            buf = f_in.read(1048576)
+            if not buf:
+                break
+            write(buf)
+        finish()
+    return out.md5.hexdigest()
@@ -1,44 +1,88 @@
 from base64 import b64encode
+from binascii import unhexlify
 from email.utils import formatdate
 from contextlib import contextmanager
 import os
 import logging
 import hashlib
 import hmac
+import time
 import urllib
 
-import gevent
-from gevent.pool import Pool
-from gevent import monkey
-monkey.patch_all(thread=False, select=False)
-
-# Make greenlets not print traceback info on exception.
-# I imagine this isn't a good thing to do, but forcing a
-# traceback to stdout on a cli is a no go.
-#
-# However, in order to debug joined functions you may have
-# to comment out these lines. You can usually get around this
-# by just setting concurrency to 0, which will bypass gevent
-# and run each joined function linearly.
-#
-from gevent.hub import Hub
-Hub.print_exception = lambda *args, **kwargs: None
-
-from bs4 import BeautifulSoup
-from requests import Session, Request
-from requests.structures import CaseInsensitiveDict
-
 from s3tup.exception import S3ResponseError, AccessKeyIdNotFound, \
                             SecretAccessKeyNotFound
 import s3tup.utils as utils
 
 log = logging.getLogger('s3tup.connection')
 
+# Query params that are part of the canonicalized resource when signing.
+SIGNED_PARAMS = (
+    'partNumber',
+    'uploadId',
+    'versionId',
+    'response-cache-control',
+    'response-content-disposition',
+    'response-content-encoding',
+    'response-content-language',
+    'response-content-type',
+    'response-expires',
+)
+
+# Smallest request body that counts towards Connection.bandwidth.
+BANDWIDTH_MIN_BODY = 1048576
+
+_patched = False
+
+
+def monkey_patch():
+
+    """Patch the standard library for gevent, if it hasn't been already.
+
+    Connections do this themselves before making concurrent requests, so
+    merely importing s3tup (or making a Connection with concurrency 0)
+    leaves the host application alone. Call it up front to opt in
+    before anything else creates sockets.
+
+    """
+    global _patched
+    if _patched:
+        return
+    from gevent import monkey
+    monkey.patch_all(thread=False, select=False)
+
+    # Make greenlets not print traceback info on exception.
+    # I imagine this isn't a good thing to do, but forcing a
+    # traceback to stdout on a cli is a no go.
+    #
+    # However, in order to debug joined functions you may have
+    # to comment out these lines. You can usually get around this
+    # by just setting concurrency to 0, which will bypass gevent
+    # and run each joined function linearly.
+    #
+    from gevent.hub import Hub
+    Hub.print_exception = lambda *args, **kwargs: None
+    _patched = True
+
 
 class Connection(object):
 
     def __init__(self, access_key_id=None, secret_access_key=None,
                  hostname=None, temporary_security_token=None, concurrency=5):
+        if hostname is None:
+            hostname = "s3.amazonaws.com"
+
+        self._set_credentials(access_key_id, secret_access_key)
+
+        self.hostname = hostname
+        self.temporary_security_token = temporary_security_token
+
+        self.concurrency = concurrency
+        self._joined = False
+        self._nested_waiting = 0
+
+        self.reset_stats()
+
+    def _set_credentials(self, access_key_id=None, secret_access_key=None):
         if access_key_id is None:
             try:
                 access_key_id = os.environ['AWS_ACCESS_KEY_ID']
@@ -49,22 +93,59 @@ class Connection(object):
                 secret_access_key = os.environ['AWS_SECRET_ACCESS_KEY']
             except KeyError:
                 raise SecretAccessKeyNotFound()
-        if hostname is None:
-            hostname = "s3.amazonaws.com"
-
         self.access_key_id = access_key_id
         self.secret_access_key = secret_access_key
 
-        self.hostname = hostname
-        self.temporary_security_token = temporary_security_token
-
-        self.concurrency = concurrency
-        self._joined = False
-
-        self.reset_stats()
+    # Connections are pickled (by the config cache, see
+    # s3tup.parse.load_buckets) without their credentials or request pool.
+    # Unpickled ones take their credentials from the environment, just as
+    # Connection() does.
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for attr in ('access_key_id', 'secret_access_key',
+                     'temporary_security_token', '_pool', '_nested_done'):
+            state.pop(attr, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pool = None
+        self.temporary_security_token = None
+        self._set_credentials()
 
     def reset_stats(self):
         self.stats = {'GET': 0, 'POST': 0, 'PUT': 0, 'DELETE': 0, 'HEAD': 0}
+        # Predicted and actual wall clock seconds of the executed plans,
+        # see s3tup.schedule.
+        self.makespan = {'predicted': 0.0, 'actual': 0.0}
+        self._sent_bytes = 0
+        self._sent_seconds = 0.0
+        self._latency_seconds = 0.0
+        self._latency_requests = 0
+
+    @property
+    def latency(self):
+        """Measured average seconds taken by requests without big bodies.
+
+        None if no such request has been made yet.
+
+        """
+        if self._latency_requests == 0:
+            return None
+        return self._latency_seconds / self._latency_requests
+
+    @property
+    def bandwidth(self):
+        """Measured upload bandwidth of a single request in bytes/sec.
+
+        Only requests with bodies of at least BANDWIDTH_MIN_BODY bytes are
+        measured, as anything smaller is dominated by latency. None if no
+        such request has been made yet.
+
+        """
+        if self._sent_seconds <= 0:
+            return None
+        return self._sent_bytes / self._sent_seconds
 
     @property
     def concurrency(self):
@@ -76,10 +157,20 @@ class Connection(object):
             self._pool.join()
         except AttributeError:
             pass
-        if val > 0:
-            self._pool = Pool(val)
+        self._pool = None
         self._concurrency = val
 
+    def _get_pool(self):
+        """Return the pool of concurrent requests, made on first use."""
+        if self._pool is None:
+            monkey_patch()
+            from gevent.event import Event
+            from gevent.pool import Pool
+            self._pool = Pool(self.concurrency)
+            self._nested_done = Event()
+            self._nested_done.set()
+        return self._pool
+
     # Join requires some strange context management because it's
     # possible for joined methods to themselves call join. If
     # these methods then saturate the pool, the joins that they're
@@ -106,19 +197,45 @@ class Connection(object):
         else:
             return self._linear_join(functions)
 
+    # Functions are started in order as pool slots free up. Functions of
+    # nested joins (e.g. the parts of a multipart upload) go ahead of
+    # those of the outermost join, so that work already under way is
+    # finished before new work is started.
     def _concurrent_join(self, functions):
+        import gevent
+        self._get_pool()
+        nested = self._joined
         with self.joincontext():
             greenlets = []
             for f in functions:
-                if hasattr(f, '__iter__'):
-                    greenlet = gevent.spawn(*f)
+                if not hasattr(f, '__iter__'):
+                    f = [f]
+                if nested:
+                    greenlets.append(self._spawn_nested(f))
                 else:
-                    greenlet = gevent.spawn(f)
-                self._pool.add(greenlet)
-                greenlets.append(greenlet)
+                    greenlets.append(self._spawn_outer(f))
             gevent.joinall(greenlets, raise_error=True)
             return [g.get() for g in greenlets]
 
+    # Only takes a free slot while no nested join is waiting for one.
+    def _spawn_outer(self, f):
+        semaphore = self._pool._semaphore
+        while True:
+            self._nested_done.wait()
+            if semaphore.counter > 0:
+                return self._pool.spawn(*f)
+            semaphore.wait()
+
+    def _spawn_nested(self, f):
+        self._nested_waiting += 1
+        self._nested_done.clear()
+        try:
+            return self._pool.spawn(*f)
+        finally:
+            self._nested_waiting -= 1
+            if self._nested_waiting == 0:
+                self._nested_done.set()
+
     # Useful for debugging
     def _linear_join(self, functions):
         out = []
@@ -130,8 +247,17 @@ class Connection(object):
         return out
 
     # Here be dragons
+    #
+    # md5 is the raw md5 digest of data, if the caller already has it.
+    # Alternatively descriptor is an s3tup.utils.UploadDescriptor of the
+    # file data whose md5 is used if the file still matches it. Either
+    # saves hashing the whole body again for Content-MD5.
+    #
+    # With stream set the response body isn't read up front, so that large
+    # bodies can be consumed in chunks with resp.iter_content.
     def make_request(self, method, bucket, key=None, subresource=None,
-                     params=None, data=None, headers=None):
+                     params=None, data=None, headers=None, md5=None,
+                     descriptor=None, stream=False):
 
         # Remove params that are set to None
         if params is None:
@@ -143,10 +269,15 @@ class Connection(object):
         # Construct target url
         url = 'http://{}/{}'.format(self.hostname, bucket)
         url += '/{}'.format(key) if key is not None else '/'
-        if subresource is not None:
-            url += '?{}'.format(subresource)
-        elif len(params) > 0:
-            url += '?{}'.format(urllib.urlencode(params))
+        query = [] if subresource is None else [subresource]
+        query += [urllib.urlencode({k: v}) for k, v in params.items()]
+        if len(query) > 0:
+            url += '?{}'.format('&'.join(sorted(query)))
+
+        if self.concurrency > 0:
+            monkey_patch()
+        from requests import Session, Request
+        from requests.structures import CaseInsensitiveDict
 
         # Make headers case insensitive
         if headers is None:
@@ -158,18 +289,30 @@ class Connection(object):
         if self.temporary_security_token is not None:
             headers['x-amz-security-token'] = self.temporary_security_token
 
+        if md5 is None and descriptor is not None and \
+                descriptor.md5 is not None and descriptor.matches(data):
+            md5 = unhexlify(descriptor.md5)
+
         if data is not None:
-            try:
-                raw_md5 = utils.f_md5(data)
-            except:
-                m = hashlib.md5()
-                m.update(data)
-                raw_md5 = m.digest()
+            if md5 is not None:
+                raw_md5 = md5
+            else:
+                try:
+                    raw_md5 = utils.f_md5(data)
+                except:
+                    m = hashlib.md5()
+                    m.update(data)
+                    raw_md5 = m.digest()
             md5 = b64encode(raw_md5)
             headers['Content-MD5'] = md5
         else:
             md5 = ''
 
+        # Requests labels raw buffers as form data unless told otherwise,
+        # which would then no longer match the signature.
+        if isinstance(data, buffer) and 'Content-Type' not in headers:
+            headers['Content-Type'] = 'application/octet-stream'
+
         try:
             content_type = headers['Content-Type']
         except KeyError:
@@ -189,10 +332,12 @@ class Connection(object):
         # Construct canonicalized resource string
         canonicalized_resource = '/' + bucket
         canonicalized_resource += '/' if key is None else '/{}'.format(key)
-        if subresource is not None:
-            canonicalized_resource += '?{}'.format(subresource)
-        elif len(params) > 0:
-            canonicalized_resource += '?{}'.format(urllib.urlencode(params))
+        # Only sub-resources are signed, not listing params like marker.
+        signed = [] if subresource is None else [subresource]
+        signed += [urllib.urlencode({k: v}) for k, v in params.items()
+                   if k in SIGNED_PARAMS]
+        if len(signed) > 0:
+            canonicalized_resource += '?{}'.format('&'.join(sorted(signed)))
 
         # Construct string to sign
         string_to_sign = method.upper() + '\n'
@@ -224,7 +369,12 @@ class Connection(object):
         log.debug(log_message)
 
         # Send request
-        resp = Session().send(req)
+        start = time.time()
+        resp = Session().send(req, stream=stream)
+        elapsed = time.time() - start
+
+        if resp.status_code/100 == 2:
+            self._measure(data, elapsed)
 
         # Update stats, log response data.
         self.stats[method.upper()] += 1
@@ -232,9 +382,15 @@ class Connection(object):
 
         # Handle errors
         if resp.status_code/100 != 2:
-            soup = BeautifulSoup(resp.text)
+            soup = utils.soup(resp.text)
             error = soup.find('error')
 
+            # HEAD responses (and some others) have no error body.
+            if error is None:
+                log.debug('response has no error body')
+                raise S3ResponseError(str(resp.status_code), resp.reason,
+                                      resp)
+
             log_message = "S3 replied with non 2xx response code!!!!\n"
             log_message += '  request: {} {}\n'.format(method, url)
             for c in error.children:
@@ -248,3 +404,18 @@ class Connection(object):
             raise S3ResponseError(code, message, resp)
 
         return resp
+
+    def _measure(self, data, elapsed):
+        """Count a request towards bandwidth or latency."""
+        size = 0
+        if data is not None:
+            try:
+                size = utils.f_sizeof(data)
+            except AttributeError:
+                size = len(data)
+        if size >= BANDWIDTH_MIN_BODY:
+            self._sent_bytes += size
+            self._sent_seconds += elapsed
+        else:
+            self._latency_seconds += elapsed
+            self._latency_requests += 1
@@ -1,15 +1,150 @@
+import os
+
 # All files larger than this will use multipart uploading.
 MULTIPART_CUTOFF = 5242880
 
-# Size of the individual pieces in a multipart upload.
-#
-# Needs to be constant to make etag generation reproducible
-# locally on files that were uploaded with multipart, as s3 uses
-# the hash of the concatenated hashes of each part.
-#
-# Minimum: 5242880 (any smaller and s3 returns an error)
+# Default (and minimum) size of the individual pieces in a multipart
+# upload. Any smaller and s3 returns an error.
 MULTIPART_PART_SIZE = 5242880
 
+# Largest part size and largest number of parts s3 will accept.
+MULTIPART_MAX_PART_SIZE = 5368709120
+MULTIPART_MAX_PARTS = 10000
+
+# Part sizes are chosen per upload (see s3tup.utils.choose_part_size),
+# so to keep etag generation reproducible locally they are always whole
+# multiples of this step. s3 uses the hash of the concatenated hashes of
+# each part as the etag, so the part size of a remote key can then be
+# inferred from its size and part count. The part size used is also
+# recorded in the key's metadata under MULTIPART_PART_SIZE_META.
+MULTIPART_PART_SIZE_STEP = 1048576
+MULTIPART_PART_SIZE_META = 's3tup-part-size'
+
+# Automatic part sizing aims for at most this many parts per upload and,
+# once upload bandwidth has been measured, for parts that take roughly
+# MULTIPART_PART_SECONDS to send (but never fewer than
+# MULTIPART_MIN_PARTS parts).
+MULTIPART_TARGET_PARTS = 1000
+MULTIPART_PART_SECONDS = 10
+MULTIPART_MIN_PARTS = 10
+
+# Ways RsyncConfig can tell whether a local file differs from its key:
+# compare etags (checksum), only sizes (size-only), or sizes and, failing
+# that, etags of files modified since the key was (size-mtime).
+RSYNC_COMPARE_MODES = ('checksum', 'size-mtime', 'size-only')
+
+# What RsyncConfig does with symlinks to files: upload their target's
+# contents (follow), leave them and their keys alone (skip), or make
+# their keys redirect to the key of their target (redirect).
+SYMLINK_POLICIES = ('follow', 'skip', 'redirect')
+
+# Kinds of pool RsyncConfig can hash local files in.
+HASH_POOLS = ('thread', 'process')
+
+# Size of the reads local files are hashed with.
+HASH_READ_SIZE = 1048576
+
+# Maximum number of candidate part sizes hashed when checking a local
+# file against a multipart etag whose part size is ambiguous.
+MULTIPART_MAX_CANDIDATES = 8
+
+# Number of times an individual part is retried before a multipart
+# upload gives up.
+MULTIPART_PART_RETRIES = 3
+
+# Keys larger than this are downloaded as concurrent ranged GETs of this
+# size, unless they're multipart keys, which are fetched part by part.
+DOWNLOAD_PART_SIZE = 8388608
+
+# Downloaded ranges are streamed to disk in chunks of this size.
+DOWNLOAD_CHUNK_SIZE = 65536
+
+# Downloads are written to path + DOWNLOAD_SUFFIX and only moved into
+# place once they've been verified.
+DOWNLOAD_SUFFIX = '.s3tup-download'
+
+# Directory s3tup keeps its local state in (upload journal, caches).
+STATE_DIR = os.environ.get('S3TUP_STATE_DIR',
+                           os.path.join(os.path.expanduser('~'), '.s3tup'))
+
+# Journal of in-progress multipart uploads, used to resume them.
+UPLOAD_JOURNAL_PATH = os.path.join(STATE_DIR, 'uploads.journal')
+
+# Incomplete multipart uploads older than this (in seconds) are
+# considered abandoned and are aborted when resuming.
+UPLOAD_JOURNAL_MAX_AGE = 7 * 24 * 60 * 60
+
+# Persistent cache of local file digests, see s3tup.hashcache. Writes
+# are committed in batches of HASH_CACHE_BATCH files, and files modified
+# less than HASH_CACHE_RACY_NS nanoseconds ago aren't cached, as a write
+# within the same mtime tick wouldn't change their stat.
+HASH_CACHE_PATH = os.path.join(STATE_DIR, 'hashes.sqlite')
+HASH_CACHE_BATCH = 1000
+HASH_CACHE_RACY_NS = 2 * 10**9
+
+# Redirects s3tup has put in place, see s3tup.redirectcache. Writes are
+# committed in batches of REDIRECT_CACHE_BATCH. A redirect's key is only
+# taken to be the one s3tup put if it was last modified within
+# REDIRECT_CACHE_SLACK seconds of when s3 answered the PUT (s3 dates have
+# whole seconds, and last modified is taken when the PUT started).
+REDIRECT_CACHE_PATH = os.path.join(STATE_DIR, 'redirects.sqlite')
+REDIRECT_CACHE_BATCH = 1000
+REDIRECT_CACHE_SLACK = 2
+
+# Parsed configs cached by s3tup.parse.load_buckets, by the md5 of the
+# config file. Bump CONFIG_CACHE_FORMAT whenever the parsed classes change
+# in a way that breaks cached copies.
+CONFIG_CACHE_DIR = os.path.join(STATE_DIR, 'configs')
+CONFIG_CACHE_FORMAT = 3
+
+# Compressed copies of local files for keys with the compress attribute,
+# kept so that unchanged files are never compressed twice. Pruning the
+# cache (see s3tup.compress.CompressionCache.prune) drops copies of files
+# that changed or are gone, and then the least recently made copies
+# until at most COMPRESSION_CACHE_MAX_SIZE bytes are left. Temporary
+# files older than COMPRESSION_CACHE_TMP_MAX_AGE seconds are left over
+# from crashes and are removed too.
+COMPRESSION_CACHE_DIR = os.path.join(STATE_DIR, 'compressed')
+COMPRESSION_CACHE_MAX_SIZE = 1024 ** 3
+COMPRESSION_CACHE_TMP_MAX_AGE = 24 * 60 * 60
+
+# Watch mode (see s3tup.watch) waits for WATCH_DEBOUNCE seconds without
+# file changes, but never more than WATCH_MAX_DELAY seconds, before
+# syncing what changed, and rsyncs against a full bucket listing every
+# WATCH_RECONCILE_INTERVAL seconds to catch changes it wasn't told of.
+WATCH_DEBOUNCE = 0.5
+WATCH_MAX_DELAY = 5
+WATCH_RECONCILE_INTERVAL = 600
+
+# Plan files (see s3tup.planfile) are applied in batches of this many
+# actions, so applying a plan of any size takes bounded memory.
+PLAN_APPLY_BATCH = 1000
+
+# Shards of a plan (see s3tup.shard) mark that they're done by putting
+# empty marker objects under SHARD_MARKER_PREFIX, which bucket listings
+# leave out. Shard 0 checks for the others' markers every
+# SHARD_BARRIER_INTERVAL seconds, for up to SHARD_BARRIER_TIMEOUT seconds,
+# before deleting anything.
+SHARD_MARKER_PREFIX = '.s3tup-shards/'
+SHARD_BARRIER_INTERVAL = 5
+SHARD_BARRIER_TIMEOUT = 6 * 60 * 60
+
+# Plans are executed longest action first (see s3tup.schedule), costing
+# actions by the latency and upload bandwidth measured on the connection
+# or, until they have been, SCHEDULE_LATENCY seconds per request and
+# SCHEDULE_BANDWIDTH bytes per second.
+SCHEDULE_LATENCY = 0.1
+SCHEDULE_BANDWIDTH = 10485760
+
+# Defaults of s3tup bench (see s3tup.bench): the number of files in the
+# synthetic tree, their sizes (SIZE:WEIGHT, ...), the fraction of them
+# changed before rsyncing, and the seconds of latency of every request to
+# the local stand-in for s3.
+BENCH_FILES = 1000
+BENCH_SIZES = '4K:80,64K:15,1M:4,8M:1'
+BENCH_CHANGED = 0.1
+BENCH_LATENCY = 0.02
+
 # Allowed attributes on s3tup.key.Key objects.
 # Used to filter out invalid kwargs in the Key and KeyConfigurator
 # constructors, and also acts as a guide for which attributes to set
@@ -18,6 +153,8 @@ KEY_ATTRS = (
     'acl',
     'cache_control',
     'canned_acl',
+    'compress',
+    'compress_level',
     'content_disposition',
     'content_encoding',
     'content_type',
@@ -25,10 +162,26 @@ KEY_ATTRS = (
     'encrypted',
     'expires',
     'metadata',
+    'part_size',
     'redirect_url',
     'reduced_redundancy',
 )
 
+# Fields allowed in rsync configs, i.e. the arguments of
+# s3tup.rsync.RsyncConfig that can be configured (as opposed to, say, its
+# hash_cache, which is set at runtime).
+RSYNC_ATTRS = (
+    'compare',
+    'delete',
+    'dest',
+    'hash_pool',
+    'hash_workers',
+    'mtime_tolerance',
+    'src',
+    'symlinks',
+    'walk_workers',
+)
+
 # Allowed attributes on s3tup.bucket.Bucket objects.
 # Used to filter out invalid kwargs in the Bucket constructor.
 BUCKET_ATTRS = (
@@ -18,11 +18,38 @@ class ActionConflict(Exception):
                 msg += "{} -> {}".format(action['type'], action['url'])
             elif action['type'] == 'upload':
                 msg += "{} <- {}".format(action['type'], action['path'])
+            elif action['type'] in ('download', 'local_delete'):
+                msg += "{} {}".format(action['type'], action['path'])
             msg += " || "
         msg = msg[:-3]
         super(ActionConflict, self).__init__(msg)
 
 
+class ETagMismatch(Exception):
+    def __init__(self, key, etag):
+        msg = "Download of '{}' doesn't match its etag {}".format(key, etag)
+        super(ETagMismatch, self).__init__(msg)
+        self.key = key
+        self.etag = etag
+
+
+class UnverifiableDownload(Exception):
+    def __init__(self, key, etag):
+        msg = ("Download of '{}' can't be verified against its multipart "
+               "etag {}".format(key, etag))
+        super(UnverifiableDownload, self).__init__(msg)
+        self.key = key
+        self.etag = etag
+
+
+class StalePlan(Exception):
+    pass
+
+
+class ShardBarrierTimeout(Exception):
+    pass
+
+
 class ConfigLoadError(Exception):
     pass
 
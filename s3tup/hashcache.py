@@ -0,0 +1,144 @@
+import logging
+import os
+import sqlite3
+import time
+
+import s3tup.constants as constants
+
+log = logging.getLogger('s3tup.hashcache')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS hashes (
+    dev INTEGER NOT NULL,
+    ino INTEGER NOT NULL,
+    part_size INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    ctime_ns INTEGER NOT NULL,
+    md5s TEXT NOT NULL,
+    PRIMARY KEY (dev, ino, part_size)
+)
+'''
+
+
+class HashCache(object):
+
+    """Persistent cache of the md5s of local files.
+
+    Digests are stored in an sqlite database at path (by default
+    constants.HASH_CACHE_PATH) under the file's device and inode, along
+    with its size, mtime and ctime (in nanoseconds). They're only used
+    while all of those still match, so any write to the file, or a
+    rename over it, invalidates them. Whole file md5s are stored with a
+    part size of 0, multipart part md5s with their part size.
+
+    sqlite's own locking makes it safe for several s3tup runs to share a
+    cache. Writes are batched and committed on flush (or every
+    constants.HASH_CACHE_BATCH writes).
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path or constants.HASH_CACHE_PATH
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(self.path, timeout=60)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(_SCHEMA)
+        self._db.commit()
+        self._pending = 0
+
+    def load(self, f, descriptor):
+        """Fill in the digests of f on descriptor from the cache.
+
+        Returns the stat key of f to pass to save, or None if f isn't a
+        real file.
+
+        """
+        key = stat_key(f)
+        if key is None:
+            return None
+        rows = self._db.execute(
+            'SELECT part_size, size, mtime_ns, ctime_ns, md5s FROM hashes '
+            'WHERE dev = ? AND ino = ?', key[:2])
+        for part_size, size, mtime_ns, ctime_ns, md5s in rows:
+            if (size, mtime_ns, ctime_ns) != key[2:]:
+                continue
+            if part_size == 0:
+                if descriptor.md5 is None:
+                    descriptor.md5 = md5s
+            elif part_size not in descriptor.part_md5s:
+                descriptor.part_md5s[part_size] = _split(md5s)
+        return key
+
+    def save(self, f, key, descriptor):
+        """Store the digests on descriptor for f.
+
+        key is the stat key load returned before f was hashed. Nothing is
+        stored if f changed since, or if it was modified so recently that
+        another write within the same mtime tick could go unnoticed (see
+        store).
+
+        """
+        if key is None or stat_key(f) != key:
+            return
+        self.store(key, descriptor)
+
+    def store(self, key, descriptor):
+        """Store the digests on descriptor for the file with stat key key.
+
+        The caller makes sure the file didn't change since it was hashed.
+
+        """
+        if time.time() * 1e9 - key[3] < constants.HASH_CACHE_RACY_NS:
+            log.debug('not caching hashes of recently modified {}'.format(
+                descriptor.path))
+            return
+
+        rows = []
+        if descriptor.md5 is not None:
+            rows.append(key[:2] + (0,) + key[2:] + (descriptor.md5,))
+        for part_size, md5s in descriptor.part_md5s.items():
+            rows.append(key[:2] + (part_size,) + key[2:] + (''.join(md5s),))
+
+        # Digests stored for an older version of the file are dropped.
+        self._db.execute(
+            'DELETE FROM hashes WHERE dev = ? AND ino = ? AND '
+            '(size != ? OR mtime_ns != ? OR ctime_ns != ?)', key)
+        self._db.executemany(
+            'INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?, ?)',
+            rows)
+        self._pending += 1
+        if self._pending >= constants.HASH_CACHE_BATCH:
+            self.flush()
+
+    def flush(self):
+        self._db.commit()
+        self._pending = 0
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+def stat_key(f):
+    """Return (dev, inode, size, mtime_ns, ctime_ns) of file f, or None."""
+    try:
+        st = os.fstat(f.fileno())
+    except (AttributeError, ValueError, EnvironmentError):
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, _ns(st, 'mtime'),
+            _ns(st, 'ctime'))
+
+
+def _ns(st, name):
+    try:
+        return getattr(st, 'st_{}_ns'.format(name))
+    except AttributeError:
+        return int(round(getattr(st, 'st_' + name) * 1e9))
+
+
+def _split(md5s):
+    return [md5s[i:i+32] for i in range(0, len(md5s), 32)]
@@ -0,0 +1,152 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import logging
+import os
+import time
+
+import s3tup.constants as constants
+
+log = logging.getLogger('s3tup.journal')
+
+
+class UploadJournal(object):
+
+    """Persists the progress of multipart uploads so they can be resumed.
+
+    Each entry is keyed by bucket and key name and records the upload id,
+    the part size, a fingerprint of the local file being uploaded (see
+    s3tup.utils.f_fingerprint) and the etags of the parts that have
+    completed so far. An entry is only resumed if the fingerprint still
+    matches the local file.
+
+    The journal is an append-only file of json lines, one per event, so
+    recording a finished part is a single small write. It's compacted
+    every time it's loaded. Loading, compacting and appending all hold an
+    exclusive lock on path + '.lock', so that runs sharing a journal don't
+    lose each other's records.
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path or constants.UPLOAD_JOURNAL_PATH
+        self._entries = None
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            with self._lock():
+                self._entries = self._load()
+                self._compact()
+        return self._entries
+
+    def get(self, bucket, key):
+        """Return the entry for an upload to bucket/key, or None."""
+        return self.entries.get((bucket, key))
+
+    def items(self, bucket):
+        """Return (key, entry) pairs of all uploads to bucket."""
+        return [(k[1], v) for k, v in self.entries.items() if k[0] == bucket]
+
+    def start(self, bucket, key, upload_id, part_size, fingerprint):
+        self._write({'op': 'start', 'bucket': bucket, 'key': key,
+                     'upload_id': upload_id, 'part_size': part_size,
+                     'fingerprint': list(fingerprint), 'time': time.time()})
+
+    def add_part(self, bucket, key, upload_id, part_num, etag):
+        self._write({'op': 'part', 'bucket': bucket, 'key': key,
+                     'upload_id': upload_id, 'part': part_num,
+                     'etag': etag})
+
+    def finish(self, bucket, key, upload_id):
+        """Forget about an upload that was completed or aborted."""
+        self._write({'op': 'finish', 'bucket': bucket, 'key': key,
+                     'upload_id': upload_id})
+
+    def _write(self, record):
+        self._apply(self.entries, record)
+        with self._lock():
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+
+    # The journal itself is replaced when compacted, so the lock is taken
+    # on a file of its own.
+    @contextmanager
+    def _lock(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+        with open(self.path + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _apply(entries, record):
+        # json reads strings back as unicode, while the names and paths
+        # s3tup journals are utf-8 strs, which wouldn't compare equal.
+        record = dict((k, _utf8(v)) for k, v in record.items())
+        k = (record['bucket'], record['key'])
+        entry = entries.get(k)
+        if record['op'] == 'start':
+            entries[k] = {
+                'upload_id': record['upload_id'],
+                'part_size': record['part_size'],
+                'fingerprint': record['fingerprint'],
+                'time': record['time'],
+                'parts': {},
+            }
+        elif entry is None or entry['upload_id'] != record['upload_id']:
+            return
+        elif record['op'] == 'part':
+            entry['parts'][record['part']] = record['etag']
+        elif record['op'] == 'finish':
+            entries.pop(k)
+
+    def _load(self):
+        entries = {}
+        try:
+            f = open(self.path, 'r')
+        except IOError:
+            return entries
+        with f:
+            for line in f:
+                try:
+                    self._apply(entries, json.loads(line))
+                except (ValueError, KeyError):
+                    # Most likely a line cut off by a crash.
+                    log.debug('skipping bad journal line: {}'.format(line))
+        return entries
+
+    def _compact(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            for (bucket, key), entry in self._entries.items():
+                records = [{'op': 'start', 'bucket': bucket, 'key': key,
+                            'upload_id': entry['upload_id'],
+                            'part_size': entry['part_size'],
+                            'fingerprint': entry['fingerprint'],
+                            'time': entry['time']}]
+                for part_num, etag in sorted(entry['parts'].items()):
+                    records.append({'op': 'part', 'bucket': bucket,
+                                    'key': key,
+                                    'upload_id': entry['upload_id'],
+                                    'part': part_num, 'etag': etag})
+                for record in records:
+                    f.write(json.dumps(record) + '\n')
+        os.rename(tmp, self.path)
+
+
+def _utf8(value):
+    """Return value with any unicode in it encoded as utf-8."""
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_utf8(v) for v in value]
+    return value
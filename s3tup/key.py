@@ -1,27 +1,68 @@
-from binascii import hexlify
+from binascii import hexlify, unhexlify
+import hashlib
 import logging
 import mimetypes
-
-from bs4 import BeautifulSoup
-
-from s3tup.exception import S3ResponseError
+import mmap
+import os
+import posixpath
+import time
+
+from s3tup.compress import CompressionCache
+from s3tup.exception import S3ResponseError, ETagMismatch, \
+                            UnverifiableDownload
 import s3tup.utils as utils
 import s3tup.constants as constants
 
 log = logging.getLogger('s3tup.key')
 
+_KEY_ATTRS = frozenset(constants.KEY_ATTRS)
+
 
 class KeyFactory(object):
 
-    """Container for KeyConfigurators."""
+    """Container for KeyConfigurators.
+
+    Key names matched by the same configurators that also look the same
+    to mimetypes (same extension) end up with identical configuration.
+    The factory configures one template Key per such class of names and
+    memoizes its headers, and every key it makes is a lightweight handle
+    that refers back to that template instead of being configured anew.
+
+    """
 
-    def __init__(self, configurators=None):
+    def __init__(self, configurators=None, journal=None):
         self.configurators = configurators or []
+        self.journal = journal
+        self._classes = {}
+        self._configured = ()
 
     def make_key(self, conn, bucket_name, key_name,):
         """Return a properly configured key."""
-        key = Key(conn, bucket_name, key_name)
-        return self.configure_key(key)
+        configurators = tuple(self.configurators)
+        if configurators != self._configured:
+            self._classes = {}
+            self._configured = configurators
+
+        matched = tuple(c for c in configurators if c.effects_key(key_name))
+        type_signature = _type_signature(key_name)
+        if type_signature is None:
+            key = Key(conn, bucket_name, key_name, journal=self.journal)
+            for c in matched:
+                key = c.configure_key(key)
+            return key
+
+        signature = (matched, type_signature)
+        try:
+            template, headers = self._classes[signature]
+        except KeyError:
+            template = Key(None, None, key_name)
+            for c in matched:
+                template = c.configure_key(template)
+            headers = tuple(template.get_headers().items())
+            self._classes[signature] = (template, headers)
+
+        return Key.from_template(template, conn, bucket_name, key_name,
+                                 self.journal, headers)
 
     def configure_key(self, key):
         for c in self.configurators:
@@ -30,6 +71,22 @@ class KeyFactory(object):
         return key
 
 
+def _type_signature(key_name):
+    """Return the parts of key_name that mimetypes.guess_type looks at.
+
+    That's the extension, and the one before it for compressed (.gz) or
+    aliased (.tgz) extensions. Returns None for names that guess_type
+    would treat as data urls.
+
+    """
+    if key_name[:5].lower() == 'data:':
+        return None
+    base, ext = posixpath.splitext(key_name)
+    if ext in mimetypes.suffix_map or ext in mimetypes.encodings_map:
+        return (ext, posixpath.splitext(base)[1])
+    return (ext,)
+
+
 class KeyConfigurator(object):
 
     """Configures Key objects."""
@@ -52,7 +109,7 @@ class KeyConfigurator(object):
         """Return the input key with all configurations applied."""
         for attr in constants.KEY_ATTRS:
             if attr in self.__dict__ and attr != 'metadata':
-                key.__dict__[attr] = self.__dict__[attr]
+                setattr(key, attr, self.__dict__[attr])
         try:
             key.metadata.update(self.metadata)
         except AttributeError:
@@ -78,13 +135,27 @@ class Key(object):
 
     It has attributes (all defined in constants.KEY_ATTRS) that you can set,
     delete, modify, and then sync to s3 using the sync or upload methods.
+    If given an s3tup.journal.UploadJournal, multipart uploads of real
+    files are recorded in it and resumed from it when they fail midway.
+
+    Keys made by a KeyFactory are handles onto a shared template key (see
+    from_template): attributes not set on the key itself are read from
+    the template, and the template's headers are used until an attribute
+    is set. Metadata is copied on first access, so changing it in place
+    never leaks into other keys.
 
     """
 
-    def __init__(self, conn, bucket_name, key_name, **kwargs):
+    __slots__ = ('conn', 'name', 'bucket_name', 'journal', '_template',
+                 '_headers') + constants.KEY_ATTRS
+
+    def __init__(self, conn, bucket_name, key_name, journal=None, **kwargs):
+        self._template = None
+        self._headers = None
         self.conn = conn
         self.name = key_name
         self.bucket_name = bucket_name
+        self.journal = journal
 
         # Set defaults for required attributes:
         self.reduced_redundancy = kwargs.pop('reduced_redundancy', False)
@@ -95,18 +166,56 @@ class Key(object):
         # constants.KEY_ATTRS to this object instance
         for k, v in kwargs.items():
             if k in constants.KEY_ATTRS:
-                self.__dict__[k] = v
+                setattr(self, k, v)
             else:
                 msg = ("__init__() got an unexpected keyword"
                        " argument '{}'".format(k))
                 raise TypeError(msg)
 
+    @classmethod
+    def from_template(cls, template, conn, bucket_name, key_name,
+                      journal=None, headers=None):
+        """Return a key that shares its configuration with template.
+
+        headers, if given, are template's headers as a tuple of items.
+
+        """
+        key = cls.__new__(cls)
+        init = object.__setattr__
+        init(key, '_template', template)
+        init(key, '_headers', headers)
+        init(key, 'conn', conn)
+        init(key, 'name', key_name)
+        init(key, 'bucket_name', bucket_name)
+        init(key, 'journal', journal)
+        return key
+
+    # Only called for attributes that aren't set on the key itself.
+    def __getattr__(self, name):
+        if name not in _KEY_ATTRS or self._template is None:
+            raise AttributeError(name)
+        value = getattr(self._template, name)
+        if name == 'metadata':
+            value = dict(value)
+            self.metadata = value
+        return value
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name in _KEY_ATTRS:
+            object.__setattr__(self, '_headers', None)
+
+    def __delattr__(self, name):
+        object.__delattr__(self, name)
+        if name in _KEY_ATTRS:
+            object.__setattr__(self, '_headers', None)
+
     @property
     def pretty_path(self):
         return key_pretty_path(self.bucket_name, self.name)
 
     def make_request(self, method, subresource=None, params=None,
-                    data=None, headers=None):
+                    data=None, headers=None, md5=None, descriptor=None):
         """Convenience method for self.conn.make_request."""
         # Has bucket and key fields already filled in.
         return self.conn.make_request(
@@ -116,7 +225,9 @@ class Key(object):
             subresource=subresource,
             params=params,
             data=data,
-            headers=headers
+            headers=headers,
+            md5=md5,
+            descriptor=descriptor
         )
 
     def get_headers(self):
@@ -127,6 +238,9 @@ class Key(object):
         headers in a dict.
 
         """
+        if self._headers is not None:
+            return dict(self._headers)
+
         headers = {}
 
         try:
@@ -157,8 +271,17 @@ class Key(object):
 
         for k in ('cache_control', 'content_disposition', 'content_encoding',
                   'content_type', 'content_language', 'expires'):
-            if k in self.__dict__:
-                headers[k.replace('_', '-')] = self.__dict__[k]
+            try:
+                headers[k.replace('_', '-')] = getattr(self, k)
+            except AttributeError:
+                pass
+
+        # Keys compressed by s3tup are served with the matching encoding.
+        if 'content-encoding' not in headers:
+            try:
+                headers['content-encoding'] = self.compress
+            except AttributeError:
+                pass
 
         # Guess content-type
         if 'content-type' not in headers:
@@ -172,12 +295,12 @@ class Key(object):
         delete_key(self.conn, self.bucket_name, self.name)
 
     def redirect(self, url):
-        """Uploads a zero byte redirect to url."""
+        """Uploads a zero byte redirect to url, returning the response."""
         msg = 'redirect: {}\n          to {}'.format(self.pretty_path, url)
         log.info(msg)
         headers = self.get_headers()
         headers['x-amz-website-redirect-location'] = url
-        self.make_request('PUT', headers=headers)
+        return self.make_request('PUT', headers=headers)
 
     # Does a copy-source PUT so key *must* already exist.
     def sync(self):
@@ -194,15 +317,68 @@ class Key(object):
         self.make_request('PUT', headers=headers)
         self.sync_acl()
 
-    def upload_from_path(self, path):
+    # The optional descriptor is an s3tup.utils.UploadDescriptor of the
+    # file whose digests are reused instead of hashing the file again, as
+    # long as the file hasn't changed since the descriptor was made.
+    #
+    # Keys with the compress attribute are compressed on the fly and
+    # uploaded from a CompressionCache, which also provides the md5.
+    def upload_from_path(self, path, descriptor=None):
+        compressed = self.get_compressed(path)
+        if compressed is not None:
+            path = compressed.path
+            if descriptor is None or descriptor.path != path:
+                descriptor = compressed
         with open(path.replace(" ", "\\ "), 'rb') as f:
-            self.upload_from_file(f)
+            self.upload_from_file(f, descriptor)
+
+    def get_compressed(self, path):
+        """Return UploadDescriptor of path compressed for this key.
+
+        Returns None if this key isn't compressed.
+
+        """
+        try:
+            algorithm = self.compress
+        except AttributeError:
+            return None
+        try:
+            level = self.compress_level
+        except AttributeError:
+            level = None
+        return CompressionCache().compress(path, algorithm, level)
+
+    def upload_from_file(self, f, descriptor=None):
+        if descriptor is not None and not descriptor.matches(f):
+            log.debug('{} changed since it was described'.format(
+                descriptor.path))
+            descriptor = None
+
+        if not utils.f_seekable(f):
+            self.upload_from_stream(f)
+        elif utils.f_sizeof(f) <= constants.MULTIPART_CUTOFF:
+            self._basic_upload(f, descriptor)
+        else:
+            self._multipart_upload(f, descriptor)
+
+    def upload_from_stream(self, stream):
+        """Upload from a non-seekable file like object or string iterable.
 
-    def upload_from_file(self, f):
-        if utils.f_sizeof(f) <= constants.MULTIPART_CUTOFF:
-            self._basic_upload(f)
+        The stream is buffered into fixed size parts. If it ends before
+        constants.MULTIPART_CUTOFF bytes it's uploaded with a single
+        request, otherwise parts are uploaded concurrently while the rest
+        of the stream is still being read. Reading waits for a free
+        request slot, so at most one part more than the connection's
+        concurrency is held in memory at any time.
+
+        """
+        reader = utils.StreamReader(stream)
+        head = reader.read(constants.MULTIPART_CUTOFF + 1)
+        self.log_upload(stream)
+        if len(head) <= constants.MULTIPART_CUTOFF:
+            self.make_request('PUT', headers=self.get_headers(), data=head)
         else:
-            self._multipart_upload(f)
+            self._multipart_upload_stream(reader, head)
 
     def upload_from_string(self, string):
         self._basic_upload(string)
@@ -217,39 +393,173 @@ class Key(object):
                 msg += '"{}"'.format(source)
         log.info(msg)
 
-    def _basic_upload(self, data):
+    def _basic_upload(self, data, descriptor=None):
         self.log_upload(data)
-        self.make_request('PUT', headers=self.get_headers(), data=data)
+        self.make_request('PUT', headers=self.get_headers(), data=data,
+                          descriptor=descriptor)
 
-    def _multipart_upload(self, file_like_object):
+    # Each part is read exactly once: the buffers from utils.f_parts are
+    # hashed as the part is uploaded, and that digest is both sent as the
+    # Content-MD5 and used as the part's etag in the completion request.
+    def _multipart_upload(self, file_like_object, descriptor=None):
         self.log_upload(file_like_object)
-        upload_id = self._initiate_multipart_upload()
+
+        # Only real files are journaled, as resuming has to be able to
+        # tell whether the file changed in the meantime.
+        journal = None
+        fingerprint = None
+        if self.journal is not None:
+            fingerprint = utils.f_fingerprint(file_like_object)
+            if fingerprint is not None:
+                journal = self.journal
+
+        resumed = None
+        if journal is not None:
+            resumed = self._resume_multipart_upload(fingerprint)
+
+        if resumed is not None:
+            upload_id, part_size, etags = resumed
+            log.info('resuming upload: {} ({} parts done)'.format(
+                self.pretty_path, len(etags)))
+        else:
+            size = utils.f_sizeof(file_like_object)
+            part_size = self._get_part_size(size)
+            upload_id = self._initiate_multipart_upload(part_size)
+            etags = {}
+            if journal is not None:
+                journal.start(self.bucket_name, self.name, upload_id,
+                              part_size, fingerprint)
+
+        # Part digests from planning are only of use if they happen to be
+        # of the part size chosen.
+        md5s = None
+        if descriptor is not None:
+            md5s = descriptor.part_md5s.get(part_size)
 
         # Upload individual parts
         upload_reqs = []
-        parts = []
-        chunks = utils.f_chunk(file_like_object, constants.MULTIPART_PART_SIZE)
+        chunks = utils.f_parts(file_like_object, part_size)
         for r in range(len(chunks)):
+            if r+1 in etags:
+                continue
             upload_reqs.append([
                 self._multipart_upload_part,
                 chunks[r],
                 r+1,
-                upload_id
+                upload_id,
+                journal,
+                md5s[r] if md5s is not None else None
             ])
-            parts.append((r+1, hexlify(utils.f_md5(chunks[r]))))
         try:
-            self.conn.join(upload_reqs)
+            results = self.conn.join(upload_reqs)
+        except:
+            # Journaled uploads are kept around to be resumed next time.
+            if journal is None:
+                self._abort_multipart_upload(upload_id)
+            raise
+
+        for req, etag in zip(upload_reqs, results):
+            etags[req[2]] = etag
+        parts = sorted(etags.items())
+        self._complete_multipart_upload(upload_id, parts)
+        if journal is not None:
+            journal.finish(self.bucket_name, self.name, upload_id)
+
+    def _multipart_upload_stream(self, reader, head):
+        # The total size isn't known up front, so the part size is either
+        # the configured one or the default. That also caps the stream at
+        # constants.MULTIPART_MAX_PARTS parts.
+        part_size = self._get_part_size(0)
+        upload_id = self._initiate_multipart_upload(part_size)
+
+        # Consumed lazily by join, which only pulls the next part off of
+        # the stream once there's room to upload it.
+        def upload_reqs():
+            parts = utils.stream_parts(reader, part_size, head)
+            for r, part in enumerate(parts):
+                if r == constants.MULTIPART_MAX_PARTS:
+                    raise ValueError('Stream is larger than {} parts of {}'
+                                     ' bytes'.format(r, part_size))
+                yield [self._multipart_upload_part, part, r+1, upload_id]
+
+        try:
+            etags = self.conn.join(upload_reqs())
         except:
             self._abort_multipart_upload(upload_id)
             raise
 
+        parts = [(r+1, etags[r]) for r in range(len(etags))]
         self._complete_multipart_upload(upload_id, parts)
 
-    def _initiate_multipart_upload(self):
+    def _resume_multipart_upload(self, fingerprint):
+        """Return (upload_id, part_size, etags) of a journaled upload.
+
+        The journal is reconciled against the parts s3 actually has, so
+        only parts that are both recorded and present are counted as
+        done. Returns None if there is nothing to resume, aborting any
+        upload that was journaled for a different version of the file.
+
+        """
+        entry = self.journal.get(self.bucket_name, self.name)
+        if entry is None:
+            return None
+        upload_id = entry['upload_id']
+
+        if entry['fingerprint'] != list(fingerprint):
+            log.debug('local file changed, abandoning upload {}'.format(
+                upload_id))
+            self._abort_multipart_upload(upload_id)
+            self.journal.finish(self.bucket_name, self.name, upload_id)
+            return None
+
+        try:
+            remote_parts = self._list_parts(upload_id)
+        except S3ResponseError as e:
+            if e.error_code != 'NoSuchUpload':
+                raise
+            self.journal.finish(self.bucket_name, self.name, upload_id)
+            return None
+
+        etags = {}
+        for part_num, etag in entry['parts'].items():
+            if remote_parts.get(part_num) == etag:
+                etags[part_num] = etag
+        return upload_id, entry['part_size'], etags
+
+    def _list_parts(self, upload_id):
+        """Return dict of part number -> etag of an in-progress upload."""
+        parts = {}
+        marker = None
+        more = True
+        while more:
+            params = {'uploadId': upload_id, 'part-number-marker': marker}
+            resp = self.make_request('GET', params=params)
+            root = utils.soup(resp.text).find('listpartsresult')
+            for p in root.find_all('part'):
+                part_num = int(p.find('partnumber').text)
+                parts[part_num] = p.find('etag').text.replace('"', '')
+                marker = part_num
+            more = root.find('istruncated').text == 'true'
+        return parts
+
+    def _get_part_size(self, size):
+        """Return the multipart part size to upload size bytes with."""
+        try:
+            part_size = self.part_size
+        except AttributeError:
+            part_size = None
+        bandwidth = getattr(self.conn, 'bandwidth', None)
+        return utils.choose_part_size(size, part_size, bandwidth)
+
+    def _initiate_multipart_upload(self, part_size=None):
         """Initiates a multipart upload and returns the upload id."""
         headers = self.get_headers()
+        # Recorded so that rsync can reproduce the etag later on.
+        if part_size is not None:
+            meta = 'x-amz-meta-' + constants.MULTIPART_PART_SIZE_META
+            headers[meta] = str(part_size)
         resp = self.make_request('POST', 'uploads', headers=headers)
-        return BeautifulSoup(resp.text).find('uploadid').text
+        return utils.soup(resp.text).find('uploadid').text
 
     def _complete_multipart_upload(self, upload_id, parts):
         data = "<CompleteMultipartUpload>\n"
@@ -271,9 +581,224 @@ class Key(object):
                 return
             raise
 
-    def _multipart_upload_part(self, f, part_num, upload_id):
+    # Failed parts are retried in place rather than failing (and aborting)
+    # the whole upload.
+    def _multipart_upload_part(self, data, part_num, upload_id,
+                               journal=None, md5=None):
+        """Upload a single part and return its etag.
+
+        md5 is the part's hex md5, if already known.
+
+        """
+        if md5 is not None:
+            md5 = unhexlify(md5)
+        else:
+            md5 = hashlib.md5(data).digest()
         params = {'partNumber': part_num, 'uploadId': upload_id}
-        return self.make_request('PUT', params=params, data=f)
+        for attempt in range(constants.MULTIPART_PART_RETRIES + 1):
+            try:
+                self.make_request('PUT', params=params, data=data, md5=md5)
+                break
+            except (S3ResponseError, EnvironmentError) as e:
+                if attempt == constants.MULTIPART_PART_RETRIES:
+                    raise
+                log.debug('retrying part {} of {}: {}'.format(
+                    part_num, self.pretty_path, e))
+                time.sleep(2 ** attempt)
+        etag = hexlify(md5)
+        if journal is not None:
+            journal.add_part(self.bucket_name, self.name, upload_id,
+                             part_num, etag)
+        return etag
+
+    def download_to_path(self, path, size=None, etag=None, modified=None,
+                         unverified=False):
+        """Download this key to path and verify it against its etag.
+
+        size, etag and modified are the key's size, etag and last modified
+        timestamp as listed by Bucket.get_remote_keys; size and etag are
+        looked up with a HEAD request if not given. If modified is given
+        it's set as the file's mtime, so that size-mtime rsyncs see the
+        file as unmodified. Large keys are fetched as concurrent ranged
+        GETs, each streamed straight into a preallocated, memory-mapped
+        file. The key is downloaded next to path and only replaces it once
+        verified.
+
+        Multipart keys whose part size can't be worked out can't be
+        verified, and raise UnverifiableDownload unless unverified is set,
+        in which case they're kept with a warning.
+
+        """
+        if size is None or etag is None:
+            resp = self.make_request('HEAD')
+            size = int(resp.headers['content-length'])
+            etag = resp.headers['etag'].replace('"', '')
+
+        log.info('download: {}\n          to {}'.format(self.pretty_path,
+                                                        path))
+
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):
+                    raise
+
+        tmp = path + constants.DOWNLOAD_SUFFIX
+        try:
+            with open(tmp, 'w+b') as f:
+                range_size = self._get_range_size(size, etag)
+                if size <= range_size:
+                    md5, part_size = self._download_range(f, 0, size)
+                    md5s = [md5]
+                else:
+                    md5s, part_size = self._download_ranges(f, size,
+                                                            range_size)
+                verified = self._verify_download(f, size, etag, range_size,
+                                                 md5s, part_size)
+                if verified is None and unverified:
+                    log.warning("can't verify download of {} (etag {})"
+                                .format(self.pretty_path, etag))
+                elif verified is None:
+                    raise UnverifiableDownload(self.pretty_path, etag)
+                elif not verified:
+                    raise ETagMismatch(self.pretty_path, etag)
+            if modified is not None:
+                mtime = utils.parse_timestamp(modified)
+                os.utime(tmp, (mtime, mtime))
+            os.rename(tmp, path)
+        except:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
+
+    def _get_range_size(self, size, etag):
+        # Ranges that line up with the parts of a multipart key give its
+        # part md5s, and so its etag, without hashing the file again.
+        if '-' in etag:
+            num_parts = int(etag.split('-')[1])
+            candidates = utils.multipart_part_sizes(size, num_parts)
+            if candidates:
+                return candidates[0]
+        return constants.DOWNLOAD_PART_SIZE
+
+    def _download_ranges(self, f, size, range_size):
+        """Download size bytes into f in range_size ranges.
+
+        Returns the hex md5s of the ranges and the part size recorded on
+        the key, if any.
+
+        """
+        f.truncate(size)
+        m = mmap.mmap(f.fileno(), size)
+        try:
+            reqs = []
+            for start in range(0, size, range_size):
+                end = min(start + range_size, size)
+                reqs.append([self._download_range, m, start, end])
+            results = self.conn.join(reqs)
+            m.flush()
+        finally:
+            m.close()
+        return [md5 for md5, _ in results], results[0][1]
+
+    # Like parts of multipart uploads, failed ranges are retried in place.
+    def _download_range(self, out, start, end):
+        """Download bytes start to end of this key into out.
+
+        out is either a file or an mmap, written at start. The body is
+        streamed in DOWNLOAD_CHUNK_SIZE chunks, so only one chunk of it is
+        ever held in memory. Returns the hex md5 of the range and the part
+        size recorded on the key, if any.
+
+        """
+        headers = None
+        if end - start > 0:
+            headers = {'Range': 'bytes={}-{}'.format(start, end - 1)}
+        for attempt in range(constants.MULTIPART_PART_RETRIES + 1):
+            try:
+                resp = self.conn.make_request('GET', self.bucket_name,
+                                              self.name, headers=headers,
+                                              stream=True)
+                md5 = self._write_range(resp, out, start, end)
+                break
+            except (S3ResponseError, EnvironmentError) as e:
+                if attempt == constants.MULTIPART_PART_RETRIES:
+                    raise
+                log.debug('retrying bytes {}-{} of {}: {}'.format(
+                    start, end, self.pretty_path, e))
+                time.sleep(2 ** attempt)
+
+        meta = 'x-amz-meta-' + constants.MULTIPART_PART_SIZE_META
+        try:
+            part_size = int(resp.headers[meta])
+        except (KeyError, ValueError):
+            part_size = None
+        return md5, part_size
+
+    def _write_range(self, resp, out, start, end):
+        """Write the body of resp into out at start, returning its md5."""
+        md5 = hashlib.md5()
+        pos = start
+        if not isinstance(out, mmap.mmap):
+            out.seek(start)
+        try:
+            for chunk in resp.iter_content(constants.DOWNLOAD_CHUNK_SIZE):
+                if pos + len(chunk) > end:
+                    raise IOError('expected {} bytes, got more'.format(
+                        end - start))
+                if isinstance(out, mmap.mmap):
+                    out[pos:pos + len(chunk)] = chunk
+                else:
+                    out.write(chunk)
+                md5.update(chunk)
+                pos += len(chunk)
+        finally:
+            resp.close()
+        if pos != end:
+            raise IOError('expected {} bytes, got {}'.format(
+                end - start, pos - start))
+        return hexlify(md5.digest())
+
+    def _verify_download(self, f, size, etag, range_size, md5s,
+                         part_size=None):
+        """Return whether the downloaded file f matches etag.
+
+        md5s are the hex md5s of the range_size ranges f was downloaded
+        in, which are used instead of hashing f again where possible.
+        Returns None if etag is a multipart etag that can't be checked.
+
+        """
+        if '-' not in etag:
+            if len(md5s) == 1:
+                return md5s[0] == etag
+            return hexlify(utils.f_md5(f)) == etag
+
+        num_parts = int(etag.split('-')[1])
+        if part_size is not None:
+            candidates = [part_size]
+        else:
+            candidates = utils.multipart_part_sizes(size, num_parts)
+            candidates = candidates[:constants.MULTIPART_MAX_CANDIDATES]
+        if range_size in candidates or len(md5s) == num_parts == 1:
+            if utils.multipart_etag(md5s) == etag:
+                return True
+            candidates = [c for c in candidates if c != range_size]
+        if candidates:
+            _, part_md5s = utils.f_digests(f, candidates, md5=False)
+            for candidate in candidates:
+                if utils.multipart_etag(part_md5s[candidate]) == etag:
+                    return True
+
+        # Multipart keys that weren't uploaded by s3tup may use part sizes
+        # that can't be guessed, so only keys with a recorded part size
+        # are known to be corrupt.
+        if part_size is None:
+            return None
+        return False
 
     def sync_acl(self):
         try:
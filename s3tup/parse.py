@@ -1,6 +1,9 @@
+from binascii import hexlify
 from contextlib import contextmanager
+import cPickle as pickle
 import logging
-import copy
+import os
+import tempfile
 
 from s3tup.connection import Connection
 from s3tup.bucket import Bucket
@@ -8,6 +11,8 @@ from s3tup.key import KeyFactory, KeyConfigurator
 from s3tup.rsync import RsyncPlanner, RsyncConfig
 from s3tup.exception import ConfigParseError, ConfigLoadError
 from s3tup.utils import Matcher
+import s3tup.constants as constants
+import s3tup.utils as utils
 
 log = logging.getLogger('s3tup.parse')
 
@@ -36,8 +41,11 @@ def load_config(config):
     read = getattr(config, "read", None)
     if callable(read):
         import yaml
+        # libyaml's loader, when pyyaml was built with it, is many times
+        # faster and loads the same documents.
+        loader = getattr(yaml, 'CLoader', yaml.Loader)
         try:
-            config = yaml.load(config)
+            config = yaml.load(config, Loader=loader)
         except yaml.YAMLError as e:
             msg = "Problem parsing yaml:\n" + e.__str__()
             raise ConfigLoadError(msg)
@@ -47,6 +55,59 @@ def load_config(config):
 
     return config
 
+
+def load_buckets(config, cache_dir=None):
+
+    """Return the Buckets configured by 'config'.
+
+    The same as parse_config(load_config(config)), except that if config
+    is a path and cache_dir is set, the parsed Buckets are cached in
+    cache_dir under the md5 of the file, so an unchanged config is only
+    ever parsed once. Configs containing credentials aren't cached, and
+    cached Connections are stored without theirs (see
+    Connection.__getstate__).
+
+    """
+    if cache_dir is None or not isinstance(config, basestring):
+        return parse_config(load_config(config))
+    try:
+        with open(config, 'rb') as f:
+            digest = hexlify(utils.f_md5(f))
+    except IOError:
+        return parse_config(load_config(config))
+
+    name = '{}.{}.pickle'.format(digest, constants.CONFIG_CACHE_FORMAT)
+    path = os.path.join(cache_dir, name)
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except IOError:
+        pass
+    except Exception as e:
+        log.debug('ignoring broken config cache {}: {}'.format(path, e))
+
+    config = load_config(config)
+    buckets = parse_config(config)
+    if any(_has_credentials(c) for c in config):
+        return buckets
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=cache_dir)
+    with os.fdopen(fd, 'wb') as f:
+        pickle.dump(buckets, f, pickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+    return buckets
+
+
+def _has_credentials(bucket_config):
+    return isinstance(bucket_config, dict) and \
+        ('access_key_id' in bucket_config or
+         'secret_access_key' in bucket_config)
+
 # Recursive config definition
 #
 # [x, ...] = list of 'x's
@@ -59,19 +120,25 @@ def load_config(config):
 # key_config: [key_configurator, ...]
 # key_configurator: {*s3tup.constants.KEY_ATTRS, *matcher_fields}
 # rsync: (src|rsync_object|[rsync_object,])
-# rsync_object: {src, dest, delete, *matcher_fields}
+# rsync_object: {*s3tup.constants.RSYNC_ATTRS, *matcher_fields}
 # matcher_fields: (patterns, ignore_patterns, regexes, ignore_regexes)
 
 # IMPORTANT:
 # Many parse methods directly mutate input by design. This can lead to many
 # hard to debug issues, especially when using parsers programtically (rather
 # than through the cli). To counteract this, the parse_method decorator is
-# applied to each parse method. This decorator basically calls copy.deepcopy
-# on the input before passing it on to the decorated function. Performance
-# not really an issue here, anything more fine grained would be premature.
+# applied to each parse method. This decorator hands the decorated function
+# a shallow copy of its input, which is all parse methods ever mutate:
+# anything nested is only read, or passed on to another parse method that
+# copies it in turn. Deep copying instead would copy big configs (tens of
+# thousands of redirects) over again at every level.
 def parse_method(f):
     def inner(config):
-        return f(copy.deepcopy(config))
+        if isinstance(config, dict):
+            config = dict(config)
+        elif isinstance(config, list):
+            config = list(config)
+        return f(config)
     return inner
 
 
@@ -187,10 +254,15 @@ def parse_rsync(config):
 def parse_rsync_object(config):
     """Return a properly configured Rsync object from 'config'"""
     matcher, config = extract_matcher(config)
+    for k in config:
+        if k not in constants.RSYNC_ATTRS:
+            raise ConfigParseError("Invalid field '{}'".format(k))
     try:
         return RsyncConfig(matcher=matcher, **config)
     except TypeError as e:
         raise convert_type_error(e)
+    except ValueError as e:
+        raise ConfigParseError(str(e))
 
 
 @parse_method
@@ -0,0 +1,334 @@
+"""Plan files: action plans written out to be executed later.
+
+A plan file is a stream of json lines, gzipped if its name ends in .gz.
+Each bucket starts with a line like
+
+    {"bucket": "example", "hostname": "s3.amazonaws.com", "format": 1}
+
+followed by one line per action on its keys:
+
+    {"type": "upload", "key": ..., "path": ..., "size": ..., "mtime": ...,
+     "md5": ..., "part_md5s": {part size: [hex md5, ...]},
+     "headers": {...}, "attrs": {...}}
+    {"type": "redirect", "key": ..., "url": ..., "headers": {...}}
+    {"type": "sync", "key": ..., "headers": {...}, "attrs": {...}}
+    {"type": "delete", "key": ...}
+
+headers are the key's resolved headers, and attrs the key attributes that
+aren't headers (acl, compress, compress_level, part_size), so plans are
+applied without the configuration they were made from. size and mtime
+fingerprint the local file when it was planned, and md5 and part_md5s
+are whichever of its digests planning computed. Fields that would be
+empty are left out. Deletes come last.
+
+"""
+import gzip
+import json
+import logging
+import os
+
+from s3tup.bucket import Bucket
+from s3tup.connection import Connection
+from s3tup.exception import StalePlan
+from s3tup.key import Key
+from s3tup.utils import UploadDescriptor
+import s3tup.constants as constants
+import s3tup.schedule as schedule
+
+log = logging.getLogger('s3tup.planfile')
+
+PLAN_FORMAT = 1
+
+# Key attributes that affect what's uploaded but aren't headers.
+PLAN_KEY_ATTRS = ('acl', 'compress', 'compress_level', 'part_size')
+
+
+def open_plan(path, mode='r'):
+    """Open plan file at path, gzipped if it ends with .gz."""
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 'b')
+    return open(path, mode + 'b')
+
+
+class PlanWriter(object):
+
+    """Writes the action plans of buckets to file f, one line at a time."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def write_plan(self, bucket, plan):
+        self._write({'bucket': bucket.name, 'hostname': bucket.conn.hostname,
+                     'format': PLAN_FORMAT})
+        for k, path in plan.to_upload:
+            self._write(self._upload_record(bucket, k, path,
+                                            plan.get_descriptor(k)))
+        for k, url in plan.to_redirect:
+            self._write({'type': 'redirect', 'key': k, 'url': url,
+                         'headers': bucket.make_key(k).get_headers()})
+        for k in plan.to_sync:
+            key = bucket.make_key(k)
+            self._write(_strip({'type': 'sync', 'key': k,
+                                'headers': key.get_headers(),
+                                'attrs': _key_attrs(key)}))
+        for k in plan.to_delete:
+            self._write({'type': 'delete', 'key': k})
+
+    def _upload_record(self, bucket, k, path, descriptor):
+        key = bucket.make_key(k)
+        record = {'type': 'upload', 'key': k, 'path': path,
+                  'headers': key.get_headers(), 'attrs': _key_attrs(key)}
+        # Descriptors of compressed keys describe the compressed copy,
+        # which is made again when the plan is applied.
+        if descriptor is not None and descriptor.path == path:
+            record['size'] = descriptor.size
+            record['mtime'] = descriptor.mtime
+            record['md5'] = descriptor.md5
+            record['part_md5s'] = descriptor.part_md5s
+        else:
+            st = os.stat(path)
+            record['size'] = st.st_size
+            record['mtime'] = st.st_mtime
+        return _strip(record)
+
+    def _write(self, record):
+        self.f.write(json.dumps(record, separators=(',', ':')) + '\n')
+
+
+def read_plan(f):
+    """Yield the records of plan file f: bucket lines and action lines."""
+    for line in f:
+        if line.strip():
+            yield _decode(json.loads(line))
+
+
+def apply_plan(f, dryrun=False, concurrency=None, journal=None,
+               temporary_security_token=None, shard=None, barrier_id=None,
+               redirect_cache=None):
+
+    """Execute the plans in plan file f.
+
+    Nothing is listed or hashed beyond what uploading needs, and actions
+    are executed in batches of constants.PLAN_APPLY_BATCH as they're read.
+    Files whose size or mtime changed since they were planned aren't
+    uploaded; StalePlan is raised once everything else is done if there
+    were any.
+
+    If shard (an s3tup.shard.Shard) is given, only its slice of the plan
+    is executed. barrier_id identifies the plan file to the shard
+    barrier, and must be the same for every shard. Redirects put are
+    recorded in redirect_cache (an s3tup.redirectcache.RedirectCache), if
+    given.
+
+    """
+    applier = None
+    stale = 0
+    try:
+        for record in read_plan(f):
+            if 'bucket' in record:
+                if applier is not None:
+                    stale += applier.finish()
+                    applier = None
+                if record.get('format') != PLAN_FORMAT:
+                    raise StalePlan('Unsupported plan format {}'.format(
+                        record.get('format')))
+                conn = _make_connection(record['hostname'], concurrency,
+                                        temporary_security_token)
+                bucket = Bucket(conn, record['bucket'])
+                bucket.redirect_cache = redirect_cache
+                applier = PlanApplier(bucket, dryrun, journal, shard,
+                                      barrier_id)
+            elif applier is None:
+                raise StalePlan('Plan file has actions before a bucket')
+            else:
+                applier.add(record)
+        if applier is not None:
+            stale += applier.finish()
+    except:
+        if applier is not None:
+            applier.close()
+        raise
+    if stale:
+        raise StalePlan('{} planned files changed since they were '
+                        'planned, plan again'.format(stale))
+
+
+def _make_connection(hostname, concurrency=None,
+                     temporary_security_token=None):
+    conn = Connection(hostname=hostname,
+                      temporary_security_token=temporary_security_token)
+    if concurrency is not None:
+        conn.concurrency = concurrency
+    return conn
+
+
+class PlanApplier(object):
+
+    """Executes the actions read from a plan file on a bucket in batches.
+
+    When sharded, deletes (which come last) are only made by shard 0,
+    once every shard has arrived at the barrier.
+
+    """
+
+    def __init__(self, bucket, dryrun=False, journal=None, shard=None,
+                 barrier_id=None):
+        self.bucket = bucket
+        self.dryrun = dryrun
+        self.journal = journal
+        self.shard = shard
+        self.barrier = None
+        if shard is not None and not dryrun:
+            self.barrier = shard.barrier(bucket, barrier_id)
+        self.stale = 0
+        self._model = schedule.CostModel.from_connection(bucket.conn)
+        self._jobs = []
+        self._deletes = []
+        self._arrived = False
+
+    def add(self, record):
+        action_type = record['type']
+        if self.shard is not None:
+            if action_type == 'delete':
+                if not self.shard.deletes:
+                    return
+            elif not self.shard.owns(record['key']):
+                return
+        if action_type == 'delete':
+            if not self._arrived:
+                self._arrive()
+            self._deletes.append(record['key'])
+            if len(self._deletes) >= 1000:
+                self._flush_deletes()
+        elif action_type == 'upload':
+            self._add_upload(record)
+        elif action_type in ('redirect', 'sync'):
+            key = self._make_key(record)
+            if self.dryrun:
+                log.info('{}: {}'.format(action_type, key.pretty_path))
+            elif action_type == 'redirect':
+                self._add_job([self._model.request()],
+                              [self.bucket.put_redirect, key, record['url']])
+            else:
+                self._add_job([self._model.request()], [key.sync])
+        else:
+            raise StalePlan('Unknown action {}'.format(action_type))
+        if len(self._jobs) >= constants.PLAN_APPLY_BATCH:
+            self._flush()
+
+    def finish(self):
+        """Execute the remaining actions and return the stale count."""
+        try:
+            self._flush_deletes()
+            self._flush()
+            if self.bucket.redirect_cache is not None:
+                self.bucket.redirect_cache.flush()
+            if not self._arrived:
+                self._arrive()
+        finally:
+            self.close()
+        return self.stale
+
+    def close(self):
+        """Clear the barrier if this is shard 0, done or not."""
+        if self.barrier is not None and self.shard.deletes:
+            self.barrier.clear()
+
+    def _arrive(self):
+        """Finish everything but deletes and wait for the other shards."""
+        self._arrived = True
+        if self.barrier is None:
+            return
+        self._flush()
+        self.barrier.arrive(self.shard.index)
+        if self.shard.deletes:
+            self.barrier.prune()
+            self.barrier.wait()
+
+    def _add_upload(self, record):
+        path = record['path']
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is None or st.st_size != record['size'] or \
+                st.st_mtime != record['mtime']:
+            log.error('{} changed since it was planned, not uploading'
+                      .format(path))
+            self.stale += 1
+            return
+        key = self._make_key(record)
+        if self.dryrun:
+            log.info('upload: {} <- {}'.format(key.pretty_path, path))
+            return
+        descriptor = UploadDescriptor(path, st.st_size, st.st_mtime,
+                                      record.get('md5'),
+                                      record.get('part_md5s'))
+        self._add_job(self._model.upload(st.st_size),
+                      [key.upload_from_path, path, descriptor])
+
+    def _add_job(self, costs, action):
+        self._jobs.append((costs, action))
+
+    def _make_key(self, record):
+        template = Key(None, None, record['key'], **record.get('attrs', {}))
+        headers = tuple(record.get('headers', {}).items())
+        return Key.from_template(template, self.bucket.conn,
+                                 self.bucket.name, record['key'],
+                                 self.journal, headers)
+
+    def _flush_deletes(self):
+        if not self._deletes:
+            return
+        if self.dryrun:
+            for k in self._deletes:
+                log.info('delete: {}'.format(k))
+        else:
+            self._add_job([self._model.request()],
+                          [self.bucket.delete_keys, self._deletes])
+        self._deletes = []
+
+    # Each batch is executed longest action first, costed with whatever
+    # the connection has measured by the time it's planned.
+    def _flush(self):
+        if self._jobs:
+            schedule.execute(self.bucket.conn, self._jobs)
+            self._jobs = []
+            self._model = schedule.CostModel.from_connection(self.bucket.conn)
+
+
+def _key_attrs(key):
+    attrs = {}
+    for name in PLAN_KEY_ATTRS:
+        try:
+            attrs[name] = getattr(key, name)
+        except AttributeError:
+            pass
+    return attrs
+
+
+def _strip(record):
+    return dict((k, v) for k, v in record.items() if v not in (None, {}))
+
+
+def _decode(record):
+    """Return record as json.loads gives it with str keys and values."""
+    out = {}
+    for k, v in record.items():
+        if isinstance(v, dict):
+            v = _decode(v)
+        elif isinstance(v, list):
+            v = [_utf8(i) for i in v]
+        else:
+            v = _utf8(v)
+        out[str(k)] = v
+    if 'part_md5s' in out:
+        out['part_md5s'] = dict((int(k), v)
+                                for k, v in out['part_md5s'].items())
+    return out
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+
+import s3tup.constants as constants
+import s3tup.utils as utils
+
+log = logging.getLogger('s3tup.redirectcache')
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS redirects (
+    bucket TEXT NOT NULL,
+    key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    modified TEXT,
+    put_time REAL,
+    PRIMARY KEY (bucket, key)
+)
+'''
+
+
+class RedirectCache(object):
+
+    """Persistent record of the redirects s3tup has put in place.
+
+    Each redirect key is stored with the fingerprint (see fingerprint) of
+    the url and headers it was last PUT with and the time s3 gave for the
+    PUT, at path (by default constants.REDIRECT_CACHE_PATH). The first
+    bucket listing that shows the key has to show it last modified within
+    constants.REDIRECT_CACHE_SLACK seconds of that time, and its last
+    modified time then replaces it, so that a key written over by
+    anything else (after the slack) no longer matches. Buckets are named
+    by hostname and bucket name.
+
+    Writes are batched and committed on flush (or every
+    constants.REDIRECT_CACHE_BATCH writes).
+
+    """
+
+    def __init__(self, path=None):
+        self.path = path or constants.REDIRECT_CACHE_PATH
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._db = sqlite3.connect(self.path, timeout=60)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(_SCHEMA)
+        # Caches made before put times were recorded.
+        columns = [r[1] for r in
+                   self._db.execute('PRAGMA table_info(redirects)')]
+        if 'put_time' not in columns:
+            self._db.execute('ALTER TABLE redirects ADD COLUMN put_time REAL')
+        self._db.commit()
+        self._pending = 0
+
+    def matches(self, bucket, key, fingerprint, modified):
+        """Return whether key is still the redirect with fingerprint.
+
+        modified is the key's last modified time in the bucket listing.
+
+        """
+        row = self._db.execute(
+            'SELECT fingerprint, modified, put_time FROM redirects '
+            'WHERE bucket = ? AND key = ?', (bucket, key)).fetchone()
+        if row is None or row[0] != fingerprint:
+            return False
+        if row[1] is not None:
+            return row[1] == modified
+        if row[2] is None:
+            return False
+        # First listing since the redirect was put.
+        try:
+            listed = utils.parse_timestamp(modified)
+        except ValueError:
+            return False
+        if abs(listed - row[2]) > constants.REDIRECT_CACHE_SLACK:
+            return False
+        self._write('UPDATE redirects SET modified = ? '
+                    'WHERE bucket = ? AND key = ?', (modified, bucket, key))
+        return True
+
+    def store(self, bucket, key, fingerprint, put_time=None):
+        """Record that key was PUT as the redirect with fingerprint.
+
+        put_time is the time s3 gave for the PUT, in seconds since the
+        epoch. Without one the redirect never matches.
+
+        """
+        self._write('INSERT OR REPLACE INTO redirects '
+                    'VALUES (?, ?, ?, NULL, ?)',
+                    (bucket, key, fingerprint, put_time))
+
+    def _write(self, sql, args):
+        self._db.execute(sql, args)
+        self._pending += 1
+        if self._pending >= constants.REDIRECT_CACHE_BATCH:
+            self.flush()
+
+    def flush(self):
+        self._db.commit()
+        self._pending = 0
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+
+def fingerprint(url, headers):
+    """Return a digest of a redirect to url PUT with headers."""
+    data = json.dumps([url, sorted(headers.items())])
+    return hashlib.md5(data).hexdigest()
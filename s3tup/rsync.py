@@ -1,14 +1,22 @@
-from binascii import hexlify
-import hashlib
+import json
 import logging
+import multiprocessing
 import os
+import stat
+import urllib
 
 from s3tup.exception import ActionConflict
+import s3tup.hashcache as hashcache
 import s3tup.utils as utils
 import s3tup.constants as constants
 
 log = logging.getLogger('s3tup.rsync')
 
+# Action types that give way to any other action on the same key.
+DELETE_ACTIONS = ('delete', 'local_delete')
+
+ACTION_TYPES = ('upload', 'sync', 'redirect', 'download') + DELETE_ACTIONS
+
 
 class ActionPlan(object):
 
@@ -18,33 +26,53 @@ class ActionPlan(object):
     plans know when there are conflicting actions on keys.
     Actions are added to action plans
 
+    Actions are stored per type, as a dict of key to the action's
+    argument (its path or url, or None), so listing or counting the
+    actions of one type never touches the others.
+
     """
 
     def __init__(self):
-        self._actions = {}
-
-    # Ugly... but works and passes tests
-    def _add_action(self, key, action_type, **kwargs):
-
-        new_action = {'type': action_type}
-        new_action.update(kwargs)
-        old_action = self._actions.pop(key, None)
-
-        if old_action is None:
-            self._actions[key] = new_action
-        elif old_action == new_action:
-            self._actions[key] = old_action
-        elif old_action['type'] == 'delete':
-            self._actions[key] = new_action
-        elif new_action['type'] == 'delete':
-            self._actions[key] = old_action
+        self._index = dict((t, {}) for t in ACTION_TYPES)
+        self._descriptors = {}
+
+    def _find(self, key):
+        """Return (action type, arg) of the action on key, or None."""
+        for action_type in ACTION_TYPES:
+            actions = self._index[action_type]
+            if key in actions:
+                return action_type, actions[key]
+        return None
+
+    def _add_action(self, key, action_type, arg=None):
+        old = self._find(key)
+        if old is None:
+            self._index[action_type][key] = arg
+        elif old == (action_type, arg):
+            pass
+        elif old[0] in DELETE_ACTIONS:
+            del self._index[old[0]][key]
+            self._index[action_type][key] = arg
+        elif action_type in DELETE_ACTIONS:
+            pass
         else:
-            raise ActionConflict(key, new_action, old_action)
+            raise ActionConflict(key, _action_dict(action_type, arg),
+                                 _action_dict(*old))
 
     def remove_actions(self, *action_types):
-        for k, v in list(self._actions.items()):
-            if v['type'] in action_types:
-                self._actions.pop(k)
+        for action_type in action_types:
+            actions = self._index[action_type]
+            if self._descriptors:
+                for k in actions:
+                    self._descriptors.pop(k, None)
+            actions.clear()
+
+    def remove_key(self, key):
+        """Remove whatever action there is on key."""
+        old = self._find(key)
+        if old is not None:
+            del self._index[old[0]][key]
+            self._descriptors.pop(key, None)
 
     def add_delete(self, key):
         self._add_action(key, 'delete')
@@ -53,131 +81,736 @@ class ActionPlan(object):
         self._add_action(key, 'sync')
 
     def add_redirect(self, key, url):
-        self._add_action(key, 'redirect', url=url)
+        self._add_action(key, 'redirect', url)
+
+    def add_upload(self, key, path, descriptor=None):
+        """Add an upload, optionally with a utils.UploadDescriptor."""
+        self._add_action(key, 'upload', path)
+        if descriptor is not None:
+            self._descriptors[key] = descriptor
+
+    def add_download(self, key, path):
+        self._add_action(key, 'download', path)
+
+    def add_local_delete(self, key, path):
+        self._add_action(key, 'local_delete', path)
+
+    def get_descriptor(self, key):
+        """Return the UploadDescriptor stored for key, or None."""
+        return self._descriptors.get(key)
 
-    def add_upload(self, key, path):
-        self._add_action(key, 'upload', path=path)
+    def count(self, action_type=None):
+        """Return the number of actions of action_type, or of all types."""
+        if action_type is not None:
+            return len(self._index[action_type])
+        return sum(len(actions) for actions in self._index.values())
+
+    def __len__(self):
+        return self.count()
+
+    def __contains__(self, key):
+        return self._find(key) is not None
 
     @property
     def affected_keys(self):
-        return self._actions.keys()
+        for action_type in ACTION_TYPES:
+            for k in self._index[action_type]:
+                yield k
 
     @property
     def to_upload(self):
-        for k, v in self._actions.items():
-            if v['type'] == 'upload':
-                yield k, v['path']
+        return self._index['upload'].iteritems()
 
     @property
     def to_redirect(self):
-        for k, v in self._actions.items():
-            if v['type'] == 'redirect':
-                yield k, v['url']
+        return self._index['redirect'].iteritems()
 
     @property
     def to_delete(self):
-        for k, v in self._actions.items():
-            if v['type'] == 'delete':
-                yield k
+        return self._index['delete'].iterkeys()
+
+    @property
+    def to_download(self):
+        return self._index['download'].iteritems()
+
+    @property
+    def to_local_delete(self):
+        return self._index['local_delete'].iteritems()
 
     @property
     def to_sync(self):
-        for k, v in self._actions.items():
-            if v['type'] == 'sync':
-                yield k
+        return self._index['sync'].iterkeys()
+
+    def dump(self, f):
+        """Write the plan to file f, one JSON array per action.
+
+        Each line is [type, key] or [type, key, path or url], grouped by
+        type. Descriptors aren't written. Plans are read back with load.
+
+        """
+        for action_type in ACTION_TYPES:
+            for key, arg in self._index[action_type].iteritems():
+                if arg is None:
+                    line = [action_type, key]
+                else:
+                    line = [action_type, key, arg]
+                f.write(json.dumps(line, separators=(',', ':')) + '\n')
+
+    @classmethod
+    def load(cls, f):
+        """Return the plan written to file f by dump."""
+        plan = cls()
+        for line in f:
+            if not line.strip():
+                continue
+            action = [_utf8(v) for v in json.loads(line)]
+            if action[0] not in ACTION_TYPES:
+                raise ValueError('unknown action: {}'.format(action[0]))
+            arg = action[2] if len(action) > 2 else None
+            plan._add_action(action[1], action[0], arg)
+        return plan
+
+    def merge(self, other):
+        """Add the actions of other to this plan in place.
+
+        Conflicting actions raise ActionConflict, just like adding them
+        one by one would.
+
+        """
+        for action_type in ACTION_TYPES:
+            for key, arg in other._index[action_type].iteritems():
+                self._add_action(key, action_type, arg)
+        for key, descriptor in other._descriptors.iteritems():
+            if other._find(key) == self._find(key):
+                self._descriptors[key] = descriptor
+        return self
 
     def __add__(self, other):
         new = ActionPlan()
-        for old in (other, self):
-            for key, v in old._actions.items():
-                if v['type'] == 'redirect':
-                    new.add_redirect(key, v['url'])
-                if v['type'] == 'upload':
-                    new.add_upload(key, v['path'])
-                if v['type'] == 'delete':
-                    new.add_delete(key)
-                if v['type'] == 'sync':
-                    new.add_sync(key)
+        new.merge(other)
+        new.merge(self)
         return new
 
     def __iadd__(self, other):
-        return self.__add__(other)
+        return self.merge(other)
+
+
+def _utf8(s):
+    if isinstance(s, unicode):
+        return s.encode('utf-8')
+    return s
+
+
+def _action_dict(action_type, arg=None):
+    action = {'type': action_type}
+    if action_type == 'redirect':
+        action['url'] = arg
+    elif arg is not None:
+        action['path'] = arg
+    return action
 
 
 class RsyncPlanner(object):
-    """Container for RsyncConfigs."""
+
+    """Container for RsyncConfigs.
+
+    Plans all of its configs together: each distinct src is walked once
+    for all the configs that share it, configs are planned concurrently
+    (through the bucket's connection, when there is one) and their plans
+    are merged into one.
+
+    """
 
     def __init__(self, rsync_configs=None):
         self.configs = rsync_configs or []
 
-    def plan(self, remote_keys):
-        plan = ActionPlan()
+    def plan(self, remote_keys, bucket=None, walks=None):
+        return self._plan_all('plan', remote_keys, bucket, walks)
+
+    def plan_download(self, remote_keys, bucket=None, walks=None):
+        return self._plan_all('plan_download', remote_keys, bucket, walks)
+
+    def _plan_all(self, method, remote_keys, bucket=None, walks=None):
+        if walks is None:
+            walks = self.walk_sources()
+        # Digests are shared by the configs for the run, so that a file
+        # under several of them is hashed once.
+        digests = {}
+        reqs = []
         for config in self.configs:
-            plan += config.plan(remote_keys)
+            config.digests = digests
+            local_files = walks[src_key(config)]
+            reqs.append([getattr(config, method), remote_keys, bucket,
+                         local_files])
+        if bucket is not None:
+            plans = bucket.conn.join(reqs)
+        else:
+            plans = [r[0](*r[1:]) for r in reqs]
+
+        plan = ActionPlan()
+        for p in plans:
+            plan.merge(p)
         return plan
 
+    def walk_sources(self):
+        """Return dict of src to list of (path, stat) of files in src.
+
+        Only directories that every config of a src excludes are pruned,
+        and files aren't filtered, as each config applies its own matcher.
+
+        """
+        by_src = {}
+        for config in self.configs:
+            by_src.setdefault(src_key(config), []).append(config)
+        walks = {}
+        for src, configs in by_src.items():
+            matcher = _AnyMatcher([c.matcher for c in configs])
+            workers = max(c.walk_workers for c in configs)
+            walks[src] = list(utils.walk_files(src, matcher, workers))
+        return walks
+
+
+class _AnyMatcher(object):
+
+    """Matches what any of matchers match; used to walk a shared src."""
+
+    def __init__(self, matchers):
+        self.matchers = matchers
+
+    def matches(self, s):
+        return True
+
+    def excludes_dir(self, d):
+        return all(m.excludes_dir(d) for m in self.matchers)
+
+
+def src_key(config):
+    """Return the src of config as RsyncPlanner.walk_sources keys it."""
+    return os.path.normpath(config.src or '.')
+
 
 class RsyncConfig(object):
 
-    def __init__(self, src=None, dest=None, delete=False, matcher=None):
+    """Rsyncs a local folder with (a folder in) a bucket.
+
+    compare is one of constants.RSYNC_COMPARE_MODES. With size-mtime,
+    files of the same size as their key that haven't been modified since
+    the key was (give or take mtime_tolerance seconds of clock skew) are
+    taken to be unmodified without hashing them.
+
+    If hash_cache is set to an s3tup.hashcache.HashCache, the digests of
+    local files are looked up in and saved to it, so unchanged files
+    aren't hashed again on every run.
+
+    Files that do need hashing are hashed by a pool of hash_workers
+    (by default one per cpu) threads or processes, as set by hash_pool
+    (one of constants.HASH_POOLS). hashlib releases the GIL, so threads
+    are usually enough. Likewise src is walked with walk_workers threads,
+    one top level directory each.
+
+    Paths that share a file, whether hardlinks or symlinks to it, are
+    hashed once and share its digests, which are kept in digests (by
+    hashcache.stat_key) for the rest of the run. symlinks is one of
+    constants.SYMLINK_POLICIES and says what is uploaded for symlinks to
+    files. Symlinks redirected to a target outside of src, or to one the
+    matcher leaves out, are followed instead.
+
+    """
+
+    def __init__(self, src=None, dest=None, delete=False, matcher=None,
+                 compare='checksum', mtime_tolerance=0, hash_cache=None,
+                 hash_workers=None, hash_pool='thread', walk_workers=1,
+                 symlinks='follow'):
+        if compare not in constants.RSYNC_COMPARE_MODES:
+            msg = "Invalid compare mode '{}'".format(compare)
+            raise ValueError(msg)
+        if symlinks not in constants.SYMLINK_POLICIES:
+            msg = "Invalid symlink policy '{}'".format(symlinks)
+            raise ValueError(msg)
+        if hash_pool not in constants.HASH_POOLS:
+            msg = "Invalid hash pool '{}'".format(hash_pool)
+            raise ValueError(msg)
+        if hash_workers is None:
+            hash_workers = multiprocessing.cpu_count()
         self.src = src
         self.dest = dest
         self.delete = delete
         self.matcher = matcher or utils.Matcher()
+        self.compare = compare
+        self.mtime_tolerance = mtime_tolerance
+        self.hash_cache = hash_cache
+        self.hash_workers = hash_workers
+        self.hash_pool = hash_pool
+        self.walk_workers = walk_workers
+        self.symlinks = symlinks
+        self.digests = {}
+
+    def plan(self, remote_keys, bucket=None, walked=None):
+
+        """Return an ActionPlan that rsyncs src with the remote keys.
+
+        remote_keys is the output of Bucket.get_remote_keys. The optional
+        bucket is used to look up key metadata when the local and remote
+        keys can't be compared from the listing alone. walked is the
+        output of utils.walk_files for src, if it's already been walked.
+
+        """
+        local_files = dict(self._get_local_files(walked))
+        plan = self._plan_uploads(local_files, remote_keys, bucket)
+        if self.delete:
+            for k in remote_keys:
+                if k not in local_files:
+                    plan.add_delete(k)
+        return plan
 
-    def plan(self, remote_keys):
+    def plan_paths(self, paths, remote_keys, bucket=None):
 
-        remote_key_names = set(remote_keys.keys())
+        """Return an ActionPlan that rsyncs only the given paths in src.
 
-        new = set()
-        removed = set()
-        modified = set()
-        unmodified = set()
+        paths are relative to src. Folders are rsynced whole, and the keys
+        of paths that no longer exist (and, for folders, the keys under
+        them) are deleted if delete is set. Keys whose md5 is None in
+        remote_keys are taken to exist with unknown contents, so their
+        files are uploaded without being compared. Unmodified keys aren't
+        synced. Used to plan just what changed since the last plan.
 
-        for k in self._get_local_key_names():
-            if k not in remote_key_names:
-                new.add(k)
+        """
+        src = self.src or '.'
+        dest = self.dest or '.'
+        local_files = {}
+        gone = []
+        for path in paths:
+            full_path = os.path.join(src, path)
+            try:
+                st = os.stat(full_path)
+            except OSError:
+                gone.append(os.path.normpath(os.path.join(dest, path)))
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                if os.path.islink(full_path):
+                    continue
+                for p, st in utils.walk_files(full_path):
+                    p = os.path.join(path, p)
+                    if self.matcher.matches(p):
+                        k = os.path.normpath(os.path.join(dest, p))
+                        local_files[k] = st
+            elif self.matcher.matches(path):
+                local_files[os.path.normpath(os.path.join(dest, path))] = st
+
+        plan = self._plan_uploads(local_files, remote_keys, bucket,
+                                  sync=False)
+        if self.delete and gone:
+            prefixes = tuple(k + '/' for k in gone)
+            for k in gone:
+                if k in remote_keys:
+                    plan.add_delete(k)
+            for k in remote_keys:
+                if k.startswith(prefixes) and k not in local_files:
+                    plan.add_delete(k)
+        return plan
+
+    def _plan_uploads(self, local_files, remote_keys, bucket=None,
+                      sync=True):
+        """Return an ActionPlan uploading the modified local_files.
+
+        local_files maps key names to the stats of their files. Unmodified
+        keys are synced if sync is set.
+
+        """
+        plan = ActionPlan()
+        existing = []
+        for k in local_files:
+            if self.symlinks != 'follow' and self._plan_symlink(plan, k):
+                continue
+            s3_key = remote_keys.get(k)
+            if s3_key is None or s3_key.md5 is None:
+                plan.add_upload(k, self._get_local_path_from_key(k))
             else:
-                if (self._is_unmodified(remote_keys[k])):
-                    unmodified.add(k)
-                else:
-                    modified.add(k)
-        removed = remote_key_names - (modified | unmodified)
+                existing.append(k)
+
+        compared = self._compare_keys(existing, remote_keys, bucket,
+                                      stats=local_files)
+        for k, same, descriptor in compared:
+            if not same:
+                path = self._get_local_path_from_key(k)
+                plan.add_upload(k, path, descriptor)
+            elif sync:
+                plan.add_sync(k)
+        if self.hash_cache is not None:
+            self.hash_cache.flush()
+        return plan
+
+    def _plan_symlink(self, plan, k):
+        """Plan the key k of a symlink, returning False if it isn't one.
+
+        Also returns False for symlinks that are to be followed after all.
+
+        """
+        path = self._get_local_path_from_key(k)
+        if not os.path.islink(path):
+            return False
+        if self.symlinks == 'skip':
+            log.debug('skipping symlink {}'.format(path))
+            return True
+        target = self._get_link_target_key(path)
+        if target is None:
+            log.debug('following symlink {}'.format(path))
+            return False
+        plan.add_redirect(k, urllib.quote('/' + target))
+        return True
+
+    def _get_link_target_key(self, path):
+        """Return the key of the file symlink path points to, or None."""
+        src = os.path.realpath(self.src or '.')
+        target = os.path.realpath(path)
+        rel = os.path.relpath(target, src)
+        if rel.split(os.sep)[0] == '..' or not os.path.isfile(target) or \
+                not self.matcher.matches(rel):
+            return None
+        return os.path.normpath(os.path.join(self.dest or '.', rel))
+
+    def plan_download(self, remote_keys, bucket=None, walked=None):
+
+        """Return an ActionPlan that rsyncs the remote keys into src.
+
+        The reverse of plan: remote keys under dest are downloaded if
+        they're missing locally or differ from their local file, and
+        local files whose keys aren't in the bucket are deleted if delete
+        is set. The matcher is run on key names relative to dest.
+
+        """
+        local_files = dict(self._get_local_files(walked))
+        local_key_names = set(local_files)
+        remote_key_names = set(self._get_remote_key_names(remote_keys))
+
+        existing = remote_key_names & local_key_names
+        compared = self._compare_keys(existing, remote_keys, bucket,
+                                      download=True, stats=local_files)
+        unmodified = set(k for k, same, _ in compared if same)
 
         plan = ActionPlan()
-        for k in new | modified:
-            plan.add_upload(k, self._get_local_path_from_key(k))
-        for k in unmodified:
-            plan.add_sync(k)
+        for k in remote_key_names - unmodified:
+            plan.add_download(k, self._get_local_path_from_key(k))
         if self.delete:
-            for k in removed:
-                plan.add_delete(k)
+            for k in local_key_names - remote_key_names:
+                plan.add_local_delete(k, self._get_local_path_from_key(k))
+        if self.hash_cache is not None:
+            self.hash_cache.flush()
         return plan
 
     def _get_local_key_names(self):
+        for k, _ in self._get_local_files():
+            yield k
+
+    def _get_local_files(self, walked=None):
+        """Yield (key name, stat) for each local file to be rsynced.
+
+        walked is the unfiltered output of utils.walk_files for src, if
+        it's already been walked.
+
+        """
         src = self.src or '.'
         dest = self.dest or '.'
-        for path in utils.os_walk_relative(src):
-            if not self.matcher.matches(path):
+        if walked is None:
+            files = utils.walk_files(src, self.matcher, self.walk_workers)
+        else:
+            files = ((p, st) for p, st in walked if self.matcher.matches(p))
+        for path, st in files:
+            yield os.path.normpath(os.path.join(dest, path)), st
+
+    def _get_remote_key_names(self, remote_keys):
+        dest = os.path.normpath(self.dest or '.')
+        for k in remote_keys:
+            # Skip "folder" placeholder keys.
+            if k.endswith('/'):
+                continue
+            if dest == '.':
+                path = k
+            elif k.startswith(dest + '/'):
+                path = k[len(dest)+1:]
+            else:
+                continue
+            # Only keys that map back onto a path inside src.
+            if os.path.normpath(path) != path or os.path.isabs(path) or \
+                    path.split('/')[0] == '..':
+                log.debug('skipping key {}'.format(k))
                 continue
-            yield os.path.normpath(os.path.join(dest, path))
+            if self.matcher.matches(path):
+                yield k
 
     def _get_local_path_from_key(self, key):
         src = self.src or '.'
         dest = self.dest or '.'
         return os.path.normpath(os.path.join(src, os.path.relpath(key, dest)))
 
-    def _is_unmodified(self, s3_key):
+    def _is_unmodified(self, s3_key, bucket=None):
+        return self._compare(s3_key, bucket)[0]
+
+    def _compare(self, s3_key, bucket=None):
+        """Return (unmodified, descriptor) for the local file of s3_key.
+
+        The returned utils.UploadDescriptor carries any digests that had
+        to be computed for the comparison, so that uploading the file if
+        it was modified doesn't have to compute them again.
+
+        """
+        unmodified, descriptor, job = self._prepare_compare(s3_key, bucket)
+        if job is not None:
+            result = _hash_file(_hash_job([job]))
+            unmodified = self._finish_compare(descriptor, job, result)
+        return unmodified, descriptor
+
+    def _compare_keys(self, key_names, remote_keys, bucket=None,
+                      download=False, stats=None):
+        """Yield (key name, unmodified, descriptor) for each of key_names.
+
+        stats optionally maps key names to the stats of their local files.
+        Files are compared as far as they can be without hashing first.
+        The ones left are then hashed in the hashing pool, biggest first,
+        and yielded as they're done. Keys whose paths share a file are
+        hashed together, once.
+
+        """
+        pending = []
+        by_file = {}
+        for k in key_names:
+            st = stats.get(k) if stats is not None else None
+            unmodified, descriptor, job = self._prepare_compare(
+                remote_keys[k], bucket, download, st)
+            if job is None:
+                yield k, unmodified, descriptor
+                continue
+            stat_key = job[3] if job[3] is not None else k
+            try:
+                by_file[stat_key].append((k, descriptor, job))
+            except KeyError:
+                by_file[stat_key] = [(k, descriptor, job)]
+                pending.append(by_file[stat_key])
+
+        # Big files go first so that no worker is left hashing one alone
+        # at the end.
+        pending.sort(key=lambda p: (-p[0][1].size, p[0][0]))
+        jobs = [_hash_job([job for _, _, job in p]) for p in pending]
+        for i, result in self._hash_files(jobs):
+            for k, descriptor, job in pending[i]:
+                unmodified = self._finish_compare(descriptor, job, result)
+                yield k, unmodified, descriptor
+
+    def _hash_files(self, jobs):
+        """Yield (index, result) of _hash_file for jobs as they finish."""
+        if self.hash_workers <= 1 or len(jobs) <= 1:
+            for i, job in enumerate(jobs):
+                yield i, _hash_file(job)
+            return
+
+        workers = min(self.hash_workers, len(jobs))
+        if self.hash_pool == 'process':
+            pool = multiprocessing.Pool(workers)
+        else:
+            from gevent.threadpool import ThreadPool
+            pool = ThreadPool(workers)
+        try:
+            for r in pool.imap_unordered(_hash_indexed_file, enumerate(jobs)):
+                yield r
+        finally:
+            if self.hash_pool == 'process':
+                pool.terminate()
+                pool.join()
+            else:
+                pool.kill()
+
+    def _prepare_compare(self, s3_key, bucket=None, download=False,
+                         st=None):
+        """Compare the local file of s3_key as far as possible unhashed.
+
+        st is the local file's stat, if already known. Returns
+        (unmodified, descriptor, job). If the file has to be hashed to
+        tell, unmodified is None and job is what _hash_file takes, to be
+        passed on to _finish_compare with its result.
+
+        """
         local_path = self._get_local_path_from_key(s3_key.name)
-        with open(local_path, 'rb') as f:
-            if utils.f_sizeof(f) != s3_key.size:
-                return False
-            if not '-' in s3_key.md5:
-                local_md5 = hexlify(utils.f_md5(f))
+
+        # Compressed copies are younger than their source, so the source's
+        # mtime is what gets compared.
+        mtime = None
+        if self.compare == 'size-mtime' and not download:
+            if st is not None:
+                mtime = st.st_mtime
             else:
-                chunks = utils.f_chunk(f, constants.MULTIPART_PART_SIZE)
-                m = hashlib.md5()
-                for chunk in chunks:
-                    m.update(utils.f_md5(chunk))
-                local_md5 = "{}-{}".format(hexlify(m.digest()), len(chunks))
-            return local_md5 == s3_key.md5
+                mtime = os.path.getmtime(local_path)
+
+        # Keys that are compressed on upload are compared by the digest of
+        # their (cached) compressed copy. Downloads are always compared
+        # as is.
+        descriptor = None
+        if bucket is not None and not download:
+            descriptor = bucket.make_key(s3_key.name).get_compressed(
+                local_path)
+            if descriptor is not None:
+                local_path = descriptor.path
+
+        # Files the walk already stat'd are only opened if they have to be
+        # hashed.
+        if descriptor is None and st is not None:
+            descriptor = utils.UploadDescriptor(local_path, st.st_size,
+                                                st.st_mtime)
+        if descriptor is not None:
+            unmodified = self._quick_compare(s3_key, descriptor, mtime,
+                                             download)
+            if unmodified is not None:
+                return unmodified, descriptor, None
+
+        with open(local_path, 'rb') as f:
+            if descriptor is None:
+                descriptor = utils.UploadDescriptor.from_file(f)
+                unmodified = self._quick_compare(s3_key, descriptor, mtime,
+                                                 download)
+                if unmodified is not None:
+                    return unmodified, descriptor, None
+            stat_key = hashcache.stat_key(f)
+            if self.hash_cache is not None:
+                self.hash_cache.load(f, descriptor)
+        self._load_digests(stat_key, descriptor)
+
+        if not '-' in s3_key.md5:
+            if descriptor.md5 is not None:
+                return descriptor.md5 == s3_key.md5, descriptor, None
+            part_sizes = None
+        else:
+            part_sizes = []
+            for part_size in self._get_part_sizes(s3_key, bucket):
+                if descriptor.etag(part_size) == s3_key.md5:
+                    return True, descriptor, None
+                if part_size not in descriptor.part_md5s:
+                    part_sizes.append(part_size)
+            if not part_sizes:
+                return False, descriptor, None
+        return None, descriptor, (local_path, s3_key.md5, part_sizes,
+                                  stat_key)
+
+    def _load_digests(self, stat_key, descriptor):
+        """Fill in digests of descriptor's file already computed this run."""
+        try:
+            md5, part_md5s = self.digests[stat_key]
+        except KeyError:
+            return
+        if descriptor.md5 is None:
+            descriptor.md5 = md5
+        for part_size, md5s in part_md5s.iteritems():
+            descriptor.part_md5s.setdefault(part_size, md5s)
+
+    def _finish_compare(self, descriptor, job, result):
+        """Return whether the hashed file of job matches its etag.
+
+        The digests in result are added to descriptor (and digests and
+        hash_cache, the first time the file is seen).
+
+        """
+        stat_key, md5, part_md5s = result
+        # Changed since it was first looked at, so it'll need uploading
+        # (and hashing) anyway.
+        if stat_key is None or stat_key != job[3]:
+            return False
+
+        if md5 is not None:
+            descriptor.md5 = md5
+        descriptor.part_md5s.update(part_md5s)
+        if stat_key not in self.digests:
+            if self.hash_cache is not None:
+                self.hash_cache.store(stat_key, descriptor)
+        self.digests[stat_key] = (descriptor.md5, dict(descriptor.part_md5s))
+
+        etag, part_sizes = job[1:3]
+        if part_sizes is None:
+            return descriptor.md5 == etag
+        return any(descriptor.etag(p) == etag for p in part_sizes)
+
+    def _quick_compare(self, s3_key, descriptor, mtime=None,
+                       download=False):
+        """Return whether descriptor's file is unmodified, or None.
+
+        None means the file has to be hashed to tell.
+
+        """
+        if descriptor.size != s3_key.size:
+            return False
+        if mtime is None:
+            mtime = descriptor.mtime
+        if self._quick_check(s3_key, mtime, download):
+            return True
+        return None
+
+    def _quick_check(self, s3_key, mtime, download=False):
+        """Return whether a file the same size as s3_key is unmodified.
+
+        Files that fail the quick check are compared by checksum. A file
+        passes size-mtime if it's no newer than the key when uploading,
+        or no older than the key when downloading.
+
+        """
+        if self.compare == 'size-only':
+            return True
+        if self.compare == 'size-mtime':
+            modified = utils.parse_timestamp(s3_key.modified)
+            if download:
+                return mtime >= modified - self.mtime_tolerance
+            return mtime <= modified + self.mtime_tolerance
+        return False
+
+    def _get_part_sizes(self, s3_key, bucket=None):
+        """Return the part sizes s3_key could have been uploaded with.
+
+        Usually the size and part count of the key leave only one option.
+        If not, the part size recorded in the key's metadata is used when
+        available, otherwise the most likely candidates are returned.
+
+        """
+        num_parts = int(s3_key.md5.split('-')[1])
+        candidates = utils.multipart_part_sizes(s3_key.size, num_parts)
+        if len(candidates) > 1 and bucket is not None:
+            part_size = bucket.get_remote_part_size(s3_key.name)
+            if part_size is not None:
+                return [part_size]
+        return candidates[:constants.MULTIPART_MAX_CANDIDATES]
+
+
+def _hash_job(jobs):
+    """Return the _hash_file job for compare jobs of the same file.
+
+    Compare jobs are (path, etag, part sizes, stat key) as made by
+    RsyncConfig._prepare_compare. Part sizes is None if the etag is a
+    whole file md5. The returned (path, md5, part sizes, stat key) hashes
+    everything any of jobs needs.
+
+    """
+    path, _, _, stat_key = jobs[0]
+    md5 = any(job[2] is None for job in jobs)
+    part_sizes = set()
+    for job in jobs:
+        part_sizes.update(job[2] or ())
+    return path, md5, sorted(part_sizes), stat_key
+
+
+def _hash_file(job):
+    """Return (stat key, md5, part md5s) of the file of a hash job.
+
+    job is (path, md5, part sizes, stat key) as made by _hash_job. The
+    whole file md5 (if md5 is set) and the part md5s for every part size
+    are computed in the same pass over the file. The returned stat key is
+    None if the file changed while it was being hashed. Runs in the
+    hashing pool.
+
+    """
+    path, md5, part_sizes, _ = job
+    with open(path, 'rb') as f:
+        stat_key = hashcache.stat_key(f)
+        md5, part_md5s = utils.f_digests(f, part_sizes, md5=md5)
+        if hashcache.stat_key(f) != stat_key:
+            stat_key = None
+    return stat_key, md5, part_md5s
+
+
+def _hash_indexed_file(indexed_job):
+    i, job = indexed_job
+    return i, _hash_file(job)
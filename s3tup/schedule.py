@@ -0,0 +1,115 @@
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+import s3tup.constants as constants
+import s3tup.utils as utils
+
+log = logging.getLogger('s3tup.schedule')
+
+
+class CostModel(object):
+
+    """Estimates how many seconds actions take to execute.
+
+    Every request costs latency seconds, plus its body size over
+    bandwidth (bytes per second) to send. Both default to
+    constants.SCHEDULE_LATENCY and constants.SCHEDULE_BANDWIDTH until
+    they've been measured on a connection (see from_connection).
+
+    """
+
+    def __init__(self, latency=None, bandwidth=None):
+        self.latency = latency or constants.SCHEDULE_LATENCY
+        self.bandwidth = bandwidth or constants.SCHEDULE_BANDWIDTH
+
+    @classmethod
+    def from_connection(cls, conn):
+        return cls(getattr(conn, 'latency', None),
+                   getattr(conn, 'bandwidth', None))
+
+    def request(self, size=0):
+        return self.latency + float(size) / self.bandwidth
+
+    def upload(self, size):
+        """Return the costs of uploading size bytes.
+
+        A basic upload is a single cost. A multipart upload is the cost of
+        initiating and completing it followed by the costs of its parts,
+        which can all be sent concurrently.
+
+        """
+        if size <= constants.MULTIPART_CUTOFF:
+            return [self.request(size)]
+        part_size = utils.choose_part_size(size, bandwidth=self.bandwidth)
+        full, last = divmod(size, part_size)
+        costs = [2 * self.latency] + [self.request(part_size)] * full
+        if last:
+            costs.append(self.request(last))
+        return costs
+
+
+def lpt_order(jobs):
+    """Order (costs, action) jobs longest first.
+
+    Starting the longest jobs first (LPT) keeps a big upload from being
+    started last and running on alone, while the cheap requests at the
+    end fill in the gaps left on the other workers.
+
+    """
+    return sorted(jobs, key=lambda job: sum(job[0]), reverse=True)
+
+
+def predict_makespan(jobs, workers):
+    """Predict the seconds workers take to execute jobs in order.
+
+    Simulates greedy list scheduling as Connection.join does it: each
+    worker that frees up takes the next part of a job already started if
+    one is ready to go, and only otherwise starts the next job. A job's
+    parts are ready once its first cost (initiating a multipart upload)
+    has been paid.
+
+    """
+    free = [0.0] * max(workers, 1)
+    parts = []
+    seq = itertools.count()
+    pending = deque(costs for costs, action in jobs if costs)
+    makespan = 0.0
+    while parts or pending:
+        start = heapq.heappop(free)
+        if parts and (parts[0][0] <= start or not pending):
+            ready, _, cost = heapq.heappop(parts)
+            start = max(start, ready)
+        else:
+            costs = pending.popleft()
+            cost = costs[0]
+            for part in costs[1:]:
+                heapq.heappush(parts, (start + cost, next(seq), part))
+        end = start + cost
+        makespan = max(makespan, end)
+        heapq.heappush(free, end)
+    return makespan
+
+
+def execute(conn, jobs):
+
+    """Execute (costs, action) jobs on conn longest first.
+
+    The predicted and actual makespans are logged and added to
+    conn.makespan.
+
+    """
+    if not jobs:
+        return
+    jobs = lpt_order(jobs)
+    predicted = predict_makespan(jobs, conn.concurrency)
+    start = time.time()
+    conn.join([action for costs, action in jobs])
+    actual = time.time() - start
+
+    conn.makespan['predicted'] += predicted
+    conn.makespan['actual'] += actual
+    log.info('executed {} actions in {:.2f}s (predicted {:.2f}s)'.format(
+        len(jobs), actual, predicted))
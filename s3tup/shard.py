@@ -0,0 +1,209 @@
+import hashlib
+import logging
+import os
+import time
+
+from s3tup.exception import S3ResponseError, ShardBarrierTimeout
+import s3tup.constants as constants
+import s3tup.utils as utils
+
+log = logging.getLogger('s3tup.shard')
+
+
+class Shard(object):
+
+    """One of count disjoint slices of an action plan.
+
+    Keys are assigned to shards by a stable hash of their name, so every
+    machine executing the same plan with a different index (0 to count-1)
+    executes a different slice of it, and each upload (multipart or not)
+    is done by exactly one of them. Deletes are all done by shard 0, only
+    once every shard has arrived at the barrier (see ShardBarrier). If
+    barrier_dir is set, the barrier is kept in that (shared) directory
+    instead of in the bucket.
+
+    Every machine has to arrive at the same barrier, so its barrier_id
+    can't depend on anything a machine works out for itself (like its
+    plan, which depends on when it listed the bucket). The cli uses the
+    md5 of the config or plan file. run_id has to be given as well, and
+    new for every run (retries included), so that markers left behind by
+    an earlier run of the same file are never mistaken for this one's.
+
+    """
+
+    def __init__(self, index, count, barrier_dir=None, run_id=None):
+        if not 0 <= index < count:
+            msg = 'Invalid shard {}/{}'.format(index, count)
+            raise ValueError(msg)
+        self.index = index
+        self.count = count
+        self.barrier_dir = barrier_dir
+        self.run_id = run_id
+        self.barrier_id = None
+
+    @classmethod
+    def parse(cls, s, barrier_dir=None, run_id=None):
+        """Return the Shard described by 'INDEX/COUNT'."""
+        try:
+            index, count = [int(i) for i in s.split('/')]
+        except ValueError:
+            msg = "Invalid shard '{}', expected INDEX/COUNT".format(s)
+            raise ValueError(msg)
+        return cls(index, count, barrier_dir, run_id)
+
+    def owns(self, key_name):
+        """Return whether key_name belongs to this shard."""
+        return shard_of(key_name, self.count) == self.index
+
+    @property
+    def deletes(self):
+        """Whether this shard is the one that deletes keys."""
+        return self.index == 0
+
+    def barrier(self, bucket, barrier_id=None):
+        """Return the barrier on bucket (by default self.barrier_id's)."""
+        if barrier_id is None:
+            barrier_id = self.barrier_id
+        if barrier_id is None:
+            raise ValueError('Sharded runs need a barrier id shared by '
+                             'every shard')
+        if self.run_id is None:
+            raise ValueError('Sharded runs need a run id shared by every '
+                             'shard and new for every run')
+        barrier_id = '{}-{}'.format(barrier_id, self.run_id)
+        return ShardBarrier(bucket, barrier_id, self.count, self.barrier_dir)
+
+    def __repr__(self):
+        return 'Shard({}, {})'.format(self.index, self.count)
+
+
+def shard_of(key_name, count):
+    """Return the index of the shard out of count that key_name is in."""
+    return int(hashlib.md5(key_name).hexdigest()[:8], 16) % count
+
+
+class ShardBarrier(object):
+
+    """Lets the shards executing a plan wait until they're all done.
+
+    Shards arrive by putting an empty marker object named after their
+    index under constants.SHARD_MARKER_PREFIX + barrier_id in the bucket,
+    or a marker file in directory if given. barrier_id identifies the
+    run, so that shards of different runs never mix. Shard 0 clears the
+    markers once it's done, whether or not it succeeded, and prunes those
+    other runs left behind (see prune).
+
+    """
+
+    def __init__(self, bucket, barrier_id, count, directory=None):
+        self.bucket = bucket
+        self.barrier_id = barrier_id
+        self.count = count
+        self.directory = directory
+
+    @property
+    def prefix(self):
+        return '{}{}/'.format(constants.SHARD_MARKER_PREFIX, self.barrier_id)
+
+    def arrive(self, index):
+        log.info('shard {}/{} done'.format(index, self.count))
+        if self.directory is not None:
+            path = self._marker_path(index)
+            open(path + '.tmp', 'w').close()
+            os.rename(path + '.tmp', path)
+        else:
+            self.bucket.conn.make_request('PUT', self.bucket.name,
+                                          self.prefix + str(index), data='')
+
+    def arrived(self):
+        """Return set of the indexes of the shards that have arrived."""
+        if self.directory is not None:
+            return set(i for i in range(self.count)
+                       if os.path.exists(self._marker_path(i)))
+        keys = self.bucket.get_remote_keys(prefix=self.prefix)
+        indexes = set()
+        for k in keys:
+            try:
+                indexes.add(int(k[len(self.prefix):]))
+            except ValueError:
+                pass
+        return indexes
+
+    def wait(self, timeout=None, interval=None):
+        """Wait until every shard has arrived.
+
+        Raises ShardBarrierTimeout after timeout seconds (by default
+        constants.SHARD_BARRIER_TIMEOUT).
+
+        """
+        if timeout is None:
+            timeout = constants.SHARD_BARRIER_TIMEOUT
+        if interval is None:
+            interval = constants.SHARD_BARRIER_INTERVAL
+        deadline = time.time() + timeout
+        while True:
+            missing = set(range(self.count)) - self.arrived()
+            if not missing:
+                return
+            if time.time() >= deadline:
+                msg = 'Shards {} never finished'.format(
+                    ', '.join(str(i) for i in sorted(missing)))
+                raise ShardBarrierTimeout(msg)
+            log.info('waiting for shards {}...'.format(
+                ', '.join(str(i) for i in sorted(missing))))
+            time.sleep(interval)
+
+    def clear(self):
+        """Remove every shard's marker."""
+        for i in range(self.count):
+            if self.directory is not None:
+                try:
+                    os.remove(self._marker_path(i))
+                except OSError:
+                    pass
+            else:
+                try:
+                    self.bucket.conn.make_request('DELETE', self.bucket.name,
+                                                  self.prefix + str(i))
+                except S3ResponseError:
+                    pass
+
+    def prune(self, max_age=None):
+        """Remove the markers of other barriers older than max_age.
+
+        Those are left over from runs whose shard 0 never got to clear
+        them. max_age defaults to constants.SHARD_BARRIER_TIMEOUT, after
+        which no shard 0 is still waiting for them.
+
+        """
+        if max_age is None:
+            max_age = constants.SHARD_BARRIER_TIMEOUT
+        cutoff = time.time() - max_age
+        if self.directory is not None:
+            own = set(os.path.basename(self._marker_path(i))
+                      for i in range(self.count))
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                if not name.startswith(self.bucket.name + '-') or \
+                        name in own:
+                    continue
+                try:
+                    if os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                except OSError:
+                    pass
+            return
+        keys = self.bucket.get_remote_keys(
+            prefix=constants.SHARD_MARKER_PREFIX)
+        for k in keys:
+            if k.startswith(self.prefix) or \
+                    utils.parse_timestamp(keys[k].modified) >= cutoff:
+                continue
+            try:
+                self.bucket.conn.make_request('DELETE', self.bucket.name, k)
+            except S3ResponseError:
+                pass
+
+    def _marker_path(self, index):
+        name = '{}-{}-{}'.format(self.bucket.name, self.barrier_id, index)
+        return os.path.join(self.directory, name)
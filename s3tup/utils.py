@@ -1,7 +1,80 @@
-from fnmatch import fnmatch
+from binascii import hexlify, unhexlify
+from collections import OrderedDict
+from fnmatch import fnmatch, translate
+import calendar
+import email.utils
 import hashlib
+import mmap
 import os
 import re
+import stat
+import sys
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+import s3tup.constants as constants
+
+_GLOB_CHARS = re.compile(r'[*?[]')
+_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def _strip_flags(translated):
+    # fnmatch.translate appends the flags it needs, which can't be in the
+    # middle of a combined regex.
+    if translated.endswith('(?ms)'):
+        return translated[:-len('(?ms)')]
+    return translated
+
+
+class _PatternSet(set):
+
+    """Set that makes its Matcher recompile whenever it's changed."""
+
+    def __init__(self, matcher, items=()):
+        set.__init__(self, items)
+        self._matcher = matcher
+
+    def __reduce__(self):
+        return _PatternSet, (self._matcher, list(self))
+
+
+def _invalidating(name):
+    method = getattr(set, name)
+    def inner(self, *args):
+        try:
+            return method(self, *args)
+        finally:
+            self._matcher._compiled = None
+    inner.__name__ = name
+    return inner
+
+for _name in ('add', 'clear', 'difference_update', 'discard',
+              'intersection_update', 'pop', 'remove',
+              'symmetric_difference_update', 'update', '__iand__',
+              '__ior__', '__isub__', '__ixor__'):
+    setattr(_PatternSet, _name, _invalidating(_name))
+
+
+def _pattern_set_property(name):
+    attr = '_' + name
+    def getter(self):
+        return getattr(self, attr)
+    def setter(self, value):
+        setattr(self, attr, _PatternSet(self, value or ()))
+        self._compiled = None
+    return property(getter, setter)
+
+
+# Regex syntax that looks past the end of a match, so that a regex found
+# in a directory's path isn't necessarily found in the paths under it.
+_LOOKAHEAD = ('$', '\\Z', '\\b', '\\B', '(?')
 
 
 class Matcher(object):
@@ -15,58 +88,186 @@ class Matcher(object):
     object assumes that the match is True (though the ignore sets can still
     overpower this assumption).
 
+    Each set is compiled on first use (and again whenever it changes):
+    plain, 'prefix*' and '*suffix' patterns are checked with string
+    operations and everything else is combined into a single regex. If
+    cache_size is set, the results for that many most recently matched
+    strings are cached as well.
+
     """
 
     def __init__(self, patterns=None, ignore_patterns=None, regexes=None,
-                 ignore_regexes=None):
-        self.patterns = set(patterns or set())
-        self.ignore_patterns = set(ignore_patterns or set())
-        self.regexes = set(regexes or set())
-        self.ignore_regexes = set(ignore_regexes or set())
+                 ignore_regexes=None, cache_size=0):
+        self._compiled = None
+        self.patterns = patterns
+        self.ignore_patterns = ignore_patterns
+        self.regexes = regexes
+        self.ignore_regexes = ignore_regexes
+        self.cache_size = cache_size
+
+    patterns = _pattern_set_property('patterns')
+    ignore_patterns = _pattern_set_property('ignore_patterns')
+    regexes = _pattern_set_property('regexes')
+    ignore_regexes = _pattern_set_property('ignore_regexes')
 
     def matches(self, s):
 
         """Return whether this matcher matches string s."""
 
+        compiled = self._compiled or self._compile()
+        cache = self._cache
+        if cache is not None:
+            try:
+                matched = cache.pop(s)
+                cache[s] = matched
+                return matched
+            except KeyError:
+                pass
+
+        match_all, patterns, regexes, ignore_patterns, ignore_regexes = \
+            compiled
+
         # If neither patterns nor regexes is set, match everything
-        matched = not self.patterns and not self.regexes
+        matched = match_all or patterns.match(s) or regexes.search(s)
+        if matched and (ignore_patterns.match(s) or ignore_regexes.search(s)):
+            matched = False
+
+        if cache is not None:
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+            cache[s] = matched
+        return matched
 
-        if not matched:
-            for pattern in self.patterns:
-                if fnmatch(s, pattern):
-                    matched = True
-                    break
-
-        if not matched:
-            for regex in self.regexes:
-                if re.search(regex, s):
-                    matched = True
-                    break
-
-        if matched:
-            for pattern in self.ignore_patterns:
-                if fnmatch(s, pattern):
-                    return False
+    def _compile(self):
+        self._compiled = (
+            not self._patterns and not self._regexes,
+            _GlobSet(self._patterns),
+            _RegexSet(self._regexes),
+            _GlobSet(self._ignore_patterns),
+            _RegexSet(self._ignore_regexes),
+        )
+        self._cache = OrderedDict() if self.cache_size > 0 else None
+        return self._compiled
+
+    def excludes_dir(self, d):
+
+        """Return whether no path under directory d can match.
+
+        Only returns True when that's certain: an ignore pattern ending in
+        '*' or an ignore regex matches d itself, or (without any regexes)
+        no pattern's literal start fits d.
 
-        if matched:
-            for regex in self.ignore_regexes:
-                if re.search(regex, s):
+        """
+        prefix = d.rstrip('/') + '/'
+
+        for pattern in self.ignore_patterns:
+            if pattern.endswith('*') and fnmatch(prefix, pattern[:-1]):
+                return True
+
+        for regex in self.ignore_regexes:
+            if any(t in regex for t in _LOOKAHEAD):
+                continue
+            if re.search(regex, prefix):
+                return True
+
+        if self.patterns and not self.regexes:
+            for pattern in self.patterns:
+                literal = re.split(r'[*?[]', pattern, 1)[0]
+                if literal.startswith(prefix) or prefix.startswith(literal):
                     return False
+            return True
 
-        return matched
+        return False
 
     def __add__(self, other):
         patterns = self.patterns | other.patterns
         ignore_patterns = self.ignore_patterns | other.ignore_patterns
         regexes = self.regexes | other.regexes
         ignore_regexes = self.ignore_regexes | other.ignore_regexes
+        cache_size = max(self.cache_size, other.cache_size)
 
-        return Matcher(patterns, ignore_patterns, regexes, ignore_regexes)
+        return Matcher(patterns, ignore_patterns, regexes, ignore_regexes,
+                       cache_size)
 
     def __iadd__(self, other):
         return self.__add__(other)
 
 
+class _GlobSet(object):
+
+    """Compiled set of glob patterns, matched like fnmatch."""
+
+    def __init__(self, patterns):
+        self.literals = set()
+        prefixes = []
+        suffixes = []
+        rest = []
+        for pattern in patterns:
+            if not _GLOB_CHARS.search(pattern):
+                self.literals.add(pattern)
+            elif pattern.endswith('*') and \
+                    not _GLOB_CHARS.search(pattern[:-1]):
+                prefixes.append(pattern[:-1])
+            elif pattern.startswith('*') and \
+                    not _GLOB_CHARS.search(pattern[1:]):
+                suffixes.append(pattern[1:])
+            else:
+                rest.append(_strip_flags(translate(pattern)))
+        self.prefixes = tuple(prefixes)
+        self.suffixes = tuple(suffixes)
+        self.regex = None
+        if rest:
+            combined = '|'.join('(?:{})'.format(r) for r in rest)
+            self.regex = re.compile(combined, re.M | re.S).match
+
+    def match(self, s):
+        return (s in self.literals or s.startswith(self.prefixes) or
+                s.endswith(self.suffixes) or
+                (self.regex is not None and self.regex(s) is not None))
+
+
+class _RegexSet(object):
+
+    """Compiled set of regexes, searched like re.search.
+
+    Regexes are combined into one, except those with inline flags (which
+    would apply to all of them) or backreferences (whose group numbers
+    would change).
+
+    """
+
+    def __init__(self, regexes):
+        combinable = []
+        self.separate = []
+        for regex in regexes:
+            compiled = re.compile(regex)
+            if compiled.flags or (compiled.groups and
+                                  _BACKREFERENCE.search(regex)):
+                self.separate.append(compiled.search)
+            else:
+                combinable.append(regex)
+
+        self.regex = None
+        if len(combinable) == 1:
+            self.regex = re.compile(combinable[0]).search
+        elif combinable:
+            combined = '|'.join('(?:{})'.format(r) for r in combinable)
+            try:
+                self.regex = re.compile(combined).search
+            except (re.error, AssertionError, OverflowError):
+                # Too many groups, or clashing group names.
+                self.separate.extend(re.compile(r).search
+                                     for r in combinable)
+
+    def search(self, s):
+        if self.regex is not None and self.regex(s) is not None:
+            return True
+        for search in self.separate:
+            if search(s) is not None:
+                return True
+        return False
+
+
 def os_walk_relative(src):
     """Return list of all file paths in src relative to src."""
     for root, dirs, files in os.walk(src):
@@ -75,6 +276,350 @@ def os_walk_relative(src):
             yield os.path.relpath(full_path, src)
 
 
+def walk_files(src, matcher=None, workers=1):
+
+    """Yield (path relative to src, stat) for all files in src.
+
+    Like os_walk_relative, but only yields paths matcher matches (if
+    given), and doesn't descend into directories that matcher excludes
+    altogether. Each file comes with its stat, so callers don't need to
+    stat it again. Like os.walk, symlinks to directories aren't followed
+    and unreadable directories are skipped. With more than one worker,
+    the top level directories are walked concurrently in gevent's
+    threadpool.
+
+    """
+    def walk(top):
+        dirs = [top]
+        while dirs:
+            d = dirs.pop()
+            for name, is_dir, st in _scan_dir(os.path.join(src, d)):
+                path = os.path.join(d, name) if d else name
+                if is_dir:
+                    if matcher is None or not matcher.excludes_dir(path):
+                        dirs.append(path)
+                elif matcher is None or matcher.matches(path):
+                    yield path, st
+
+    top_dirs = []
+    for name, is_dir, st in _scan_dir(src):
+        if is_dir:
+            if matcher is None or not matcher.excludes_dir(name):
+                top_dirs.append(name)
+        elif matcher is None or matcher.matches(name):
+            yield name, st
+
+    if workers > 1 and len(top_dirs) > 1:
+        from gevent.threadpool import ThreadPool
+        pool = ThreadPool(min(workers, len(top_dirs)))
+        try:
+            for files in pool.imap_unordered(lambda d: list(walk(d)),
+                                             top_dirs):
+                for f in files:
+                    yield f
+        finally:
+            pool.kill()
+    else:
+        for d in top_dirs:
+            for f in walk(d):
+                yield f
+
+
+def _scan_dir(path):
+    """Return list of (name, is_dir, stat) of the entries in path.
+
+    stat is None for directories. Symlinks to directories and entries
+    that can't be stat'd are left out.
+
+    """
+    entries = []
+    if scandir is not None:
+        try:
+            it = scandir(path)
+        except OSError:
+            return entries
+        for entry in it:
+            try:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        entries.append((entry.name, True, None))
+                else:
+                    entries.append((entry.name, False, entry.stat()))
+            except OSError:
+                pass
+        return entries
+
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return entries
+    for name in names:
+        full_path = os.path.join(path, name)
+        try:
+            st = os.lstat(full_path)
+            link = stat.S_ISLNK(st.st_mode)
+            if link:
+                st = os.stat(full_path)
+        except OSError:
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            if not link:
+                entries.append((name, True, None))
+        else:
+            entries.append((name, False, st))
+    return entries
+
+
+def choose_part_size(size, part_size=None, bandwidth=None):
+
+    """Return the multipart part size to use for a file of size bytes.
+
+    An explicit part_size is respected as far as s3 allows. Otherwise the
+    part size grows with the file so that it is split into at most
+    constants.MULTIPART_TARGET_PARTS parts and, if the upload bandwidth (in
+    bytes per second) is known, so that each part takes around
+    constants.MULTIPART_PART_SECONDS to send. The result is always a
+    multiple of constants.MULTIPART_PART_SIZE_STEP.
+
+    """
+    if part_size is None:
+        part_size = _ceil_div(size, constants.MULTIPART_TARGET_PARTS)
+        if bandwidth:
+            by_bandwidth = int(bandwidth * constants.MULTIPART_PART_SECONDS)
+            by_bandwidth = min(by_bandwidth,
+                               _ceil_div(size, constants.MULTIPART_MIN_PARTS))
+            part_size = max(part_size, by_bandwidth)
+
+    part_size = max(part_size, constants.MULTIPART_PART_SIZE,
+                    _ceil_div(size, constants.MULTIPART_MAX_PARTS))
+    step = constants.MULTIPART_PART_SIZE_STEP
+    part_size = _ceil_div(part_size, step) * step
+    return min(part_size, constants.MULTIPART_MAX_PART_SIZE)
+
+
+def multipart_part_sizes(size, num_parts):
+
+    """Return possible part sizes of a size byte key with num_parts parts.
+
+    Only multiples of constants.MULTIPART_PART_SIZE_STEP no smaller than
+    constants.MULTIPART_PART_SIZE are considered, as those are the only
+    part sizes s3tup uses (and s3 accepts). They're returned in order of
+    likelihood: the default part size first, then the one s3tup would
+    choose without any bandwidth measurements, then the rest ascending.
+
+    """
+    if num_parts < 1:
+        return []
+    if num_parts == 1:
+        return [max(size, 1)]
+
+    step = constants.MULTIPART_PART_SIZE_STEP
+    low = _ceil_div(size, num_parts)
+    high = (size - 1) // (num_parts - 1)
+    first = _ceil_div(max(low, constants.MULTIPART_PART_SIZE), step) * step
+    candidates = list(range(first, high + 1, step))
+
+    for preferred in (choose_part_size(size), constants.MULTIPART_PART_SIZE):
+        if preferred in candidates:
+            candidates.remove(preferred)
+            candidates.insert(0, preferred)
+    return candidates
+
+
+def _ceil_div(a, b):
+    return (a + b - 1) // b
+
+
+def f_parts(f, part_size):
+
+    """Return file split into part_size sized read-only buffers.
+
+    Real files are memory mapped, so each part is only read from disk
+    when it's first touched (e.g. hashed) and is then sent straight from
+    the page cache without being copied. Other file like objects are read
+    into memory once and sliced.
+
+    """
+    size = f_sizeof(f)
+    if size == 0:
+        return []
+    try:
+        data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        data = _f_read_all(f)
+    return [buffer(data, start, part_size)
+            for start in range(0, size, part_size)]
+
+
+class UploadDescriptor(object):
+
+    """Describes a local file and whichever of its digests are known.
+
+    Produced while planning (which has to hash files to compare them with
+    their keys) and handed to the upload so those digests don't have to
+    be computed again. md5 is the hex md5 of the whole file and
+    part_md5s maps part sizes to the hex md5s of each part. Digests are
+    only trusted while the file's size and mtime still match.
+
+    """
+
+    def __init__(self, path, size, mtime, md5=None, part_md5s=None):
+        self.path = path
+        self.size = size
+        self.mtime = mtime
+        self.md5 = md5
+        self.part_md5s = part_md5s or {}
+
+    @classmethod
+    def from_file(cls, f):
+        st = os.fstat(f.fileno())
+        return cls(f.name, st.st_size, st.st_mtime)
+
+    def matches(self, f):
+        """Return whether file f is still the file described."""
+        try:
+            st = os.fstat(f.fileno())
+        except (AttributeError, ValueError, EnvironmentError):
+            return False
+        return st.st_size == self.size and st.st_mtime == self.mtime
+
+    def etag(self, part_size=None):
+        """Return the etag of the file, or None if it isn't known."""
+        if part_size is None:
+            return self.md5
+        try:
+            return multipart_etag(self.part_md5s[part_size])
+        except KeyError:
+            return None
+
+    def __repr__(self):
+        return 'UploadDescriptor({!r}, {}, {})'.format(
+            self.path, self.size, self.mtime)
+
+
+def f_fingerprint(f):
+    """Return (absolute path, size, mtime) of a real file, or None."""
+    try:
+        st = os.fstat(f.fileno())
+        path = os.path.abspath(f.name)
+    except (AttributeError, ValueError, EnvironmentError):
+        return None
+    return (path, st.st_size, st.st_mtime)
+
+
+def parse_timestamp(timestamp):
+    """Return s3's ISO 8601 timestamps as seconds since the epoch."""
+    return calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%dT%H:%M:%S'))
+
+
+def parse_http_date(date):
+    """Return an http date header as seconds since the epoch, or None."""
+    parsed = email.utils.parsedate_tz(date or '')
+    if parsed is None:
+        return None
+    return email.utils.mktime_tz(parsed)
+
+
+def soup(markup):
+    """Return markup (an s3 response body) parsed by BeautifulSoup."""
+    # Imported here, like the rest of the network stack, so that commands
+    # that never talk to s3 don't pay for it.
+    from bs4 import BeautifulSoup
+    return BeautifulSoup(markup)
+
+
+class StreamReader(object):
+
+    """Read fixed amounts from a file like object or iterable of strings.
+
+    Unlike file.read, read(size) keeps reading until it has size bytes or
+    the stream runs out, however the underlying stream chunks its output.
+    Real files on pipes and sockets are read in gevent's threadpool when
+    gevent is running, so that other greenlets keep going while waiting
+    on the writer. They're still read through file.read, so bytes the
+    file already buffered (e.g. after a readline) aren't skipped.
+
+    """
+
+    def __init__(self, stream):
+        self._pending = ''
+        self._blocking = False
+        self._iter = None
+        self._read = getattr(stream, 'read', None)
+        if not callable(self._read):
+            self._iter = iter(stream)
+        elif isinstance(stream, file):
+            # Anything else with a fileno (e.g. a GzipFile) may well not
+            # be reading the bytes of that file descriptor as is.
+            try:
+                mode = os.fstat(stream.fileno()).st_mode
+            except (ValueError, EnvironmentError):
+                pass
+            else:
+                self._blocking = stat.S_ISFIFO(mode) or stat.S_ISSOCK(mode)
+
+    def read(self, size):
+        chunks = []
+        remaining = size
+        while remaining > 0:
+            chunk = self._next_chunk(remaining)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            remaining -= len(chunk)
+        return ''.join(chunks)
+
+    def _next_chunk(self, size):
+        if self._iter is None:
+            if self._blocking:
+                return _threadpool_read(self._read, size)
+            return self._read(size)
+        while not self._pending:
+            self._pending = next(self._iter, None)
+            if self._pending is None:
+                self._pending = ''
+                return ''
+        chunk = self._pending[:size]
+        self._pending = self._pending[size:]
+        return chunk
+
+
+def _threadpool_read(read, size):
+    # Without gevent loaded there are no other greenlets to block.
+    if 'gevent' not in sys.modules:
+        return read(size)
+    from gevent import get_hub
+    return get_hub().threadpool.apply(read, (size,))
+
+
+def stream_parts(reader, part_size, head=''):
+
+    """Yield part_size sized strings from a StreamReader.
+
+    head is data that was already read off of the stream and comes
+    first. Every part is part_size long except for the last one.
+
+    """
+    while len(head) >= part_size:
+        yield head[:part_size]
+        head = head[part_size:]
+    part = head + reader.read(part_size - len(head))
+    while part:
+        yield part
+        if len(part) < part_size:
+            return
+        part = reader.read(part_size)
+
+
+def f_seekable(f):
+    """Return whether file like object f can be seeked."""
+    try:
+        f.seek(f.tell())
+    except (AttributeError, EnvironmentError, ValueError):
+        return False
+    return True
+
+
 def f_decorator(func):
     """Make sure decorated function doesn't alter file position."""
     def inner(f, *args, **kwargs):
@@ -86,16 +631,110 @@ def f_decorator(func):
     return inner
 
 
-@f_decorator
 def f_md5(f):
     """Return md5 hash of file like object."""
+    return unhexlify(f_digests(f)[0])
+
+
+def f_multipart_etag(f, part_size):
+    """Return the etag s3 would give f if uploaded in part_size parts."""
+    return multipart_etag(f_part_md5s(f, part_size))
+
+
+def f_part_md5s(f, part_size):
+    """Return list of hex md5s of f split into part_size parts."""
+    return f_digests(f, [part_size], md5=False)[1][part_size]
+
+
+@f_decorator
+def f_digests(f, part_sizes=(), md5=True):
+
+    """Return (hex md5, dict of part size to hex part md5s) of f.
+
+    f is read once, whatever the number of part sizes, so that every form
+    of etag s3 could have given it can be checked together. The md5 is
+    None unless md5 is set. Real files are memory mapped and hashed
+    straight from the page cache; hashlib releases the GIL while hashing
+    each block, so files hashed in different threads hash in parallel.
+
+    """
+    whole = hashlib.md5() if md5 else None
+    chains = [_PartChain(p) for p in sorted(set(part_sizes))]
+    for block in _f_blocks(f, constants.HASH_READ_SIZE):
+        if whole is not None:
+            whole.update(block)
+        for chain in chains:
+            chain.update(block)
+    md5 = whole.hexdigest() if whole is not None else None
+    return md5, dict((c.part_size, c.finish()) for c in chains)
+
+
+class _PartChain(object):
+
+    """Hashes a stream of blocks as a sequence of part_size parts."""
+
+    __slots__ = ('part_size', 'md5s', '_md5', '_filled')
+
+    def __init__(self, part_size):
+        self.part_size = part_size
+        self.md5s = []
+        self._md5 = hashlib.md5()
+        self._filled = 0
+
+    def update(self, block):
+        offset = 0
+        size = len(block)
+        while offset < size:
+            n = min(self.part_size - self._filled, size - offset)
+            if offset == 0 and n == size:
+                self._md5.update(block)
+            else:
+                self._md5.update(buffer(block, offset, n))
+            offset += n
+            self._filled += n
+            if self._filled == self.part_size:
+                self.md5s.append(self._md5.hexdigest())
+                self._md5 = hashlib.md5()
+                self._filled = 0
+
+    def finish(self):
+        if self._filled:
+            self.md5s.append(self._md5.hexdigest())
+            self._filled = 0
+        return self.md5s
+
+
+def _f_blocks(f, block_size):
+    """Yield f from its current position in block_size sized blocks."""
+    try:
+        size = os.fstat(f.fileno()).st_size
+        data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, EnvironmentError):
+        data = None
+    if data is None:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                return
+            yield block
+    try:
+        for start in range(f.tell(), size, block_size):
+            yield buffer(data, start, block_size)
+    finally:
+        data.close()
+
+
+def multipart_etag(part_md5s):
+    """Return the etag of a multipart key from the hex md5s of its parts."""
     m = hashlib.md5()
-    while True:
-        buf = f.read(8192)
-        if not buf:
-            break
-        m.update(buf)
-    return m.digest()
+    for md5 in part_md5s:
+        m.update(unhexlify(md5))
+    return "{}-{}".format(m.hexdigest(), len(part_md5s))
+
+
+@f_decorator
+def _f_read_all(f):
+    return f.read()
 
 
 @f_decorator
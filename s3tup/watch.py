@@ -0,0 +1,326 @@
+from collections import namedtuple
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import socket
+import stat
+import struct
+import time
+
+from s3tup.rsync import ActionPlan, src_key
+import s3tup.constants as constants
+
+log = logging.getLogger('s3tup.watch')
+
+# From <sys/inotify.h>
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+WATCH_MASK = (IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+              IN_CREATE | IN_DELETE | IN_ONLYDIR | IN_DONT_FOLLOW)
+
+_EVENT = struct.Struct('iIII')
+
+# Stands in for the listing entry of a key uploaded since the last full
+# listing, whose etag isn't known.
+KeyTuple = namedtuple('KeyTuple', ['name', 'md5', 'size', 'modified'])
+
+
+class Inotify(object):
+
+    """Minimal ctypes binding of Linux's inotify.
+
+    Events are read cooperatively: read waits on the inotify descriptor
+    through gevent, so other greenlets keep running meanwhile.
+
+    """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'),
+                                 use_errno=True)
+        try:
+            init = self._libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self._check(init(IN_NONBLOCK | IN_CLOEXEC))
+
+    def _check(self, ret):
+        if ret < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return ret
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        """Watch path for events in mask and return its watch descriptor."""
+        return self._check(self._libc.inotify_add_watch(self.fd, path, mask))
+
+    def rm_watch(self, wd):
+        self._libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self, timeout=None):
+        """Return list of (wd, mask, cookie, name) of pending events.
+
+        Waits up to timeout seconds (forever if None) for events, and
+        returns an empty list if there weren't any.
+
+        """
+        from gevent.socket import wait_read
+        try:
+            wait_read(self.fd, timeout)
+        except socket.timeout:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return []
+            raise
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset+length].rstrip('\0')
+            offset += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher(object):
+
+    """Keeps a bucket rsynced with its local srcs as they change.
+
+    Linux only. The bucket's listing and the files in each rsync src are
+    kept in memory. inotify reports which paths change, and once they've
+    settled for debounce seconds just those paths are planned (see
+    RsyncConfig.plan_paths) and the plan is executed like any other.
+    Paths whose stat didn't change are skipped. Every reconcile_interval
+    seconds, and whenever inotify drops events, everything is rsynced
+    against a fresh listing instead, which catches changes made to the
+    bucket by anything else.
+
+    Like --rsync, only uploads and deletes are done: unmodified keys
+    aren't synced and redirects aren't made.
+
+    """
+
+    def __init__(self, bucket, dryrun=False, debounce=None,
+                 reconcile_interval=None):
+        if debounce is None:
+            debounce = constants.WATCH_DEBOUNCE
+        if reconcile_interval is None:
+            reconcile_interval = constants.WATCH_RECONCILE_INTERVAL
+        self.bucket = bucket
+        self.dryrun = dryrun
+        self.debounce = debounce
+        self.reconcile_interval = reconcile_interval
+        self.remote_keys = {}
+        self.local_files = {}
+        self._inotify = None
+        self._dirs = {}
+        self._last_reconcile = None
+
+    @property
+    def configs(self):
+        return self.bucket.rsync_planner.configs
+
+    def run(self, rounds=None):
+        """Rsync everything, then keep syncing changes.
+
+        Runs forever, or for rounds rounds of waiting for changes if set.
+
+        """
+        self.start()
+        try:
+            while rounds is None or rounds > 0:
+                due = self._last_reconcile + self.reconcile_interval
+                changes = self.wait_for_changes(max(due - time.time(), 0))
+                if changes is None or time.time() >= due:
+                    self.reconcile()
+                elif changes:
+                    self.sync_changes(changes)
+                if rounds is not None:
+                    rounds -= 1
+        finally:
+            self.close()
+
+    def start(self):
+        """Start watching the srcs and rsync everything.
+
+        The srcs are watched first, so that nothing that changes while
+        they're walked is missed.
+
+        """
+        self.watch()
+        self.reconcile()
+
+    def watch(self):
+        self._inotify = Inotify()
+        for src in set(src_key(c) for c in self.configs):
+            self._watch_tree(src, '')
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+            self._inotify = None
+            self._dirs = {}
+
+    def reconcile(self):
+        """Rsync everything against a full listing of the bucket."""
+        log.info("reconciling bucket '{}'...".format(self.bucket.name))
+        planner = self.bucket.rsync_planner
+        self.remote_keys = self.bucket.get_remote_keys()
+        walks = planner.walk_sources()
+        plan = planner.plan(self.remote_keys, self.bucket, walks)
+        plan.remove_actions('sync')
+        self._execute(plan)
+        self.local_files = dict((src, dict(files))
+                                for src, files in walks.items())
+        self._last_reconcile = time.time()
+
+    def wait_for_changes(self, timeout=None):
+        """Return dict of src to set of paths in it that changed.
+
+        Waits up to timeout seconds for a change, then until changes stop
+        for debounce seconds (or constants.WATCH_MAX_DELAY seconds have
+        passed). Returns None if inotify dropped events, in which case
+        everything has to be reconciled.
+
+        """
+        changes = {}
+        events = self._inotify.read(timeout)
+        deadline = time.time() + constants.WATCH_MAX_DELAY
+        while events:
+            if not self._add_events(events, changes):
+                return None
+            wait = min(self.debounce, deadline - time.time())
+            if wait <= 0:
+                break
+            events = self._inotify.read(wait)
+        return changes
+
+    def sync_changes(self, changes):
+        """Rsync the paths in changes, as returned by wait_for_changes."""
+        plan = ActionPlan()
+        for src, paths in changes.items():
+            paths = self._changed_paths(src, paths)
+            if not paths:
+                continue
+            for config in self.configs:
+                if src_key(config) == src:
+                    plan.merge(config.plan_paths(paths, self.remote_keys,
+                                                 self.bucket))
+        if len(plan):
+            self._execute(plan)
+
+    def _execute(self, plan):
+        self.bucket.execute_action_plan(plan, self.dryrun)
+        if self.dryrun:
+            return
+        for k, path in plan.to_upload:
+            self.remote_keys[k] = KeyTuple(k, None, None, None)
+        for k in plan.to_delete:
+            self.remote_keys.pop(k, None)
+
+    def _changed_paths(self, src, paths):
+        """Return the paths whose files changed since they were indexed.
+
+        The local file index of src is updated along the way.
+
+        """
+        index = self.local_files.setdefault(src, {})
+        changed = []
+        for path in paths:
+            try:
+                st = os.stat(os.path.join(src, path))
+            except OSError:
+                st = None
+            old = index.get(path)
+            if st is not None and not stat.S_ISDIR(st.st_mode):
+                if old is not None and _same_file(old, st):
+                    continue
+                index[path] = st
+            elif st is None:
+                index.pop(path, None)
+                if old is None:
+                    prefix = path + '/'
+                    for p in [p for p in index if p.startswith(prefix)]:
+                        del index[p]
+            changed.append(path)
+        return changed
+
+    def _add_events(self, events, changes):
+        """Add the paths events are about to changes.
+
+        Returns False if events were dropped.
+
+        """
+        for wd, mask, cookie, name in events:
+            if mask & IN_Q_OVERFLOW:
+                log.warning('inotify queue overflowed')
+                return False
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            try:
+                src, d = self._dirs[wd]
+            except KeyError:
+                continue
+            if not name:
+                continue
+            path = os.path.join(d, name) if d else name
+            if mask & IN_ISDIR:
+                if mask & IN_MOVED_FROM:
+                    self._unwatch_tree(src, path)
+                elif mask & (IN_CREATE | IN_MOVED_TO):
+                    self._watch_tree(src, path)
+            changes.setdefault(src, set()).add(path)
+        return True
+
+    def _watch_tree(self, src, path):
+        """Watch folder path in src and the folders under it."""
+        configs = [c for c in self.configs if src_key(c) == src]
+        top = os.path.join(src, path)
+        for root, dirs, _ in os.walk(top):
+            d = os.path.relpath(root, src)
+            d = '' if d == '.' else d
+            try:
+                wd = self._inotify.add_watch(root)
+            except OSError as e:
+                log.debug("can't watch {}: {}".format(root, e))
+                dirs[:] = []
+                continue
+            self._dirs[wd] = (src, d)
+            dirs[:] = [n for n in dirs if not all(
+                c.matcher.excludes_dir(os.path.join(d, n) if d else n)
+                for c in configs)]
+
+    def _unwatch_tree(self, src, path):
+        """Stop watching folder path in src, which moved out of it."""
+        prefix = path + '/'
+        for wd, (s, d) in list(self._dirs.items()):
+            if s == src and (d == path or d.startswith(prefix)):
+                self._inotify.rm_watch(wd)
+                del self._dirs[wd]
+
+
+def _same_file(st1, st2):
+    return (st1.st_ino, st1.st_size, st1.st_mtime) == \
+           (st2.st_ino, st2.st_size, st2.st_mtime)
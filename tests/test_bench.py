@@ -0,0 +1,84 @@
+from tempfile import mkdtemp
+import hashlib
+import os
+import random
+import shutil
+
+from nose.tools import raises
+
+from s3tup.bench import BUCKET, StandIn, make_tree, parse_size, \
+                        parse_size_distribution, run_bench
+from s3tup.connection import Connection
+from s3tup.exception import S3ResponseError
+
+def test_parse_size():
+    assert parse_size('4096') == 4096
+    assert parse_size('4k') == 4096
+    assert parse_size('1.5M') == 1572864
+
+def test_parse_size_distribution():
+    assert parse_size_distribution('4K:90,8M') == [(4096, 90), (8388608, 1)]
+
+@raises(ValueError)
+def test_parse_size_distribution_invalid():
+    parse_size_distribution('4K:0')
+
+def test_make_tree():
+    tmp = mkdtemp()
+    try:
+        paths = make_tree(tmp, 150, [(10, 1), (20, 1)], random.Random(0))
+        assert len(paths) == 150
+        assert len(os.listdir(tmp)) == 2
+        assert set(os.path.getsize(p) for p in paths) == set([10, 20])
+    finally:
+        shutil.rmtree(tmp)
+
+class TestStandIn:
+
+    def setup(self):
+        self.stand_in = StandIn()
+        self.stand_in.start()
+        self.conn = Connection('access_key_id', 'secret_access_key',
+                               hostname=self.stand_in.hostname,
+                               concurrency=0)
+
+    def teardown(self):
+        self.stand_in.stop()
+
+    def test_put_head_and_list(self):
+        self.conn.make_request('PUT', BUCKET, 'a', data='data',
+                               headers={'x-amz-meta-owner': 'me'})
+        resp = self.conn.make_request('HEAD', BUCKET, 'a')
+        assert resp.headers['etag'] == '"{}"'.format(
+            hashlib.md5('data').hexdigest())
+        assert resp.headers['content-length'] == '4'
+        assert resp.headers['x-amz-meta-owner'] == 'me'
+        resp = self.conn.make_request('GET', BUCKET)
+        assert '<Key>a</Key>' in resp.text
+        assert self.stand_in.stats['received_bytes'] == 4
+
+    def test_error_injection(self):
+        self.stand_in.error_rate = 1
+        try:
+            self.conn.make_request('GET', BUCKET)
+        except S3ResponseError as e:
+            assert e.error_code == 'InternalError'
+        else:
+            assert False
+        assert self.stand_in.stats['errors'] == 1
+
+def test_run_bench():
+    report = run_bench(files=10, sizes=[(1024, 1)], changed=0.5, latency=0,
+                       concurrency=2)
+    assert report['bytes'] == 10240
+    assert [s['name'] for s in report['scenarios']] == \
+        ['sync', 'resync', 'rsync']
+    assert all(s['failed'] is None for s in report['scenarios'])
+    sync, resync, rsync = report['scenarios']
+    assert sync['bytes_sent'] >= 10240
+    assert sync['requests_by_method']['PUT'] >= 10
+    assert resync['bytes_sent'] == 0
+    # One listing and an upload for each of the changed files.
+    assert rsync['requests_by_method'] == \
+        {'GET': 1, 'PUT': 5, 'POST': 0, 'DELETE': 0, 'HEAD': 0}
+    assert rsync['bytes_sent'] == 5120
@@ -1,9 +1,19 @@
+from collections import namedtuple
+from tempfile import mkdtemp
+import os
+import shutil
+
 from nose.tools import raises
 
 from s3tup.bucket import Bucket
+from s3tup.journal import UploadJournal
+from s3tup.redirectcache import RedirectCache
+from s3tup.rsync import ActionPlan
 
 from utils import ConnMock
 
+KeyTuple = namedtuple('KeyTuple', ['name', 'md5', 'size', 'modified'])
+
 @raises(TypeError)
 def test_bucket_init_invalid_kwarg():
     Bucket(None, None, None, invalid='invalid')
@@ -15,4 +25,54 @@ def test_bucket_init_missing_name():
 def test_bucket_init_success():
     b = Bucket(None, 'test', acl='test')
     assert b.name == 'test'
-    assert b.acl == 'test'
\ No newline at end of file
+    assert b.acl == 'test'
+
+def test_bucket_skip_unchanged_redirects():
+    tmp = mkdtemp()
+    try:
+        conn = ConnMock()
+        conn.hostname = 's3.amazonaws.com'
+        conn.make_request.return_value.headers = {
+            'date': 'Mon, 19 Oct 2026 12:00:01 GMT'}
+        b = Bucket(conn, 'test')
+        b.redirect_cache = RedirectCache(os.path.join(tmp, 'redirects'))
+        b.redirect_key('same', '/new')
+        b.redirect_key('changed', '/old')
+        b.redirect_key('overwritten', '/new')
+        assert conn.make_request.call_count == 3
+
+        remote = {}
+        for k in ('same', 'changed', 'missing'):
+            remote[k] = KeyTuple(k, 'd41d8cd98f00b204e9800998ecf8427e', 0,
+                                 '2026-10-19T12:00:00.500Z')
+        remote['overwritten'] = KeyTuple('overwritten', 'abc', 3,
+                                         '2026-10-19T12:00:00.500Z')
+        plan = ActionPlan()
+        for k in ('same', 'changed', 'overwritten', 'missing'):
+            plan.add_redirect(k, '/new')
+        assert b.skip_unchanged_redirects(plan, remote) == 1
+        assert sorted(k for k, _ in plan.to_redirect) == [
+            'changed', 'missing', 'overwritten']
+        assert 'same' not in plan
+    finally:
+        shutil.rmtree(tmp)
+
+def test_bucket_abort_stale_uploads():
+    tmp = mkdtemp()
+    try:
+        conn = ConnMock()
+        conn.join = lambda reqs: [r[0](*r[1:]) for r in reqs]
+        journal = UploadJournal(os.path.join(tmp, 'uploads.journal'))
+        journal.start('test', 'old', 'id1', 5242880, ('old', 10, 1.5))
+        journal.start('test', 'new', 'id2', 5242880, ('new', 10, 1.5))
+        journal.entries[('test', 'old')]['time'] = 0
+        b = Bucket(conn, 'test')
+        b.key_factory.journal = journal
+        b.abort_stale_uploads()
+        # Only the journal's own stale upload; nothing else is listed.
+        conn.make_request.assert_called_once_with(
+            'DELETE', 'test', 'old', params={'uploadId': 'id1'})
+        assert journal.get('test', 'old') is None
+        assert journal.get('test', 'new') is not None
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,137 @@
+from StringIO import StringIO
+from tempfile import mkdtemp
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import zlib
+
+from nose.tools import raises
+
+from s3tup.compress import CompressionCache
+import s3tup.compress
+
+class TestCompressionCache:
+
+    def setup(self):
+        self.tmp = mkdtemp()
+        self.src = os.path.join(self.tmp, 'src.html')
+        with open(self.src, 'wb') as f:
+            f.write('<html>' * 1000)
+        self.cache = CompressionCache(os.path.join(self.tmp, 'cache'))
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_gzip(self):
+        d = self.cache.compress(self.src, 'gzip', 6)
+        with open(d.path, 'rb') as f:
+            data = f.read()
+        assert gzip.GzipFile(fileobj=StringIO(data)).read() == '<html>' * 1000
+        assert d.md5 == hashlib.md5(data).hexdigest()
+        assert d.size == len(data)
+
+    def test_deflate(self):
+        d = self.cache.compress(self.src, 'deflate')
+        with open(d.path, 'rb') as f:
+            data = f.read()
+        assert zlib.decompress(data) == '<html>' * 1000
+        assert d.md5 == hashlib.md5(data).hexdigest()
+
+    def test_deterministic(self):
+        d1 = self.cache.compress(self.src)
+        other = CompressionCache(os.path.join(self.tmp, 'other'))
+        d2 = other.compress(self.src)
+        assert d1.md5 == d2.md5
+
+    def test_cache_hit(self):
+        d1 = self.cache.compress(self.src)
+        os.utime(d1.path, (0, 0))
+        # A touched compressed copy is rebuilt...
+        d2 = self.cache.compress(self.src)
+        assert d2.mtime != 0
+        # ...but otherwise it's reused as is.
+        d3 = self.cache.compress(self.src)
+        assert (d3.path, d3.mtime, d3.md5) == (d2.path, d2.mtime, d2.md5)
+
+    def test_source_changed(self):
+        d1 = self.cache.compress(self.src)
+        with open(self.src, 'wb') as f:
+            f.write('<body>' * 1000)
+        os.utime(self.src, (1, 1))
+        d2 = self.cache.compress(self.src)
+        assert d1.path == d2.path
+        assert d1.md5 != d2.md5
+
+    def test_interleaved(self):
+        # Another greenlet compressing the same path while this one is
+        # still writing its copy.
+        compress = s3tup.compress._compress
+        def interleaved(*args):
+            s3tup.compress._compress = compress
+            md5 = compress(*args)
+            self.cache.compress(self.src)
+            return md5
+        s3tup.compress._compress = interleaved
+        try:
+            d = self.cache.compress(self.src)
+        finally:
+            s3tup.compress._compress = compress
+        with open(d.path, 'rb') as f:
+            assert d.md5 == hashlib.md5(f.read()).hexdigest()
+        assert not [n for n in os.listdir(self.cache.directory)
+                    if n.endswith('.tmp')]
+
+    @raises(ValueError)
+    def test_unknown_algorithm(self):
+        self.cache.compress(self.src, 'lzma')
+
+    def test_failed_compress_leaves_no_tmp(self):
+        def failing(*args):
+            raise IOError('disk full')
+        compress = s3tup.compress._compress
+        s3tup.compress._compress = failing
+        try:
+            self.cache.compress(self.src)
+        except IOError:
+            pass
+        else:
+            assert False
+        finally:
+            s3tup.compress._compress = compress
+        assert os.listdir(self.cache.directory) == []
+
+    def test_prune_stale(self):
+        kept = self.cache.compress(self.src)
+        other = os.path.join(self.tmp, 'other.html')
+        with open(other, 'wb') as f:
+            f.write('<body>' * 1000)
+        removed = self.cache.compress(other)
+        changed = self.cache.compress(self.src, 'deflate')
+        os.remove(other)
+        os.utime(self.src, (1, 1))
+        kept = self.cache.compress(self.src)
+        stray = os.path.join(self.cache.directory, 'stray.tmp')
+        open(stray, 'w').close()
+        os.utime(stray, (0, 0))
+        self.cache.prune()
+        assert os.path.exists(kept.path)
+        assert os.path.exists(kept.path + '.json')
+        for path in (removed.path, changed.path, stray):
+            assert not os.path.exists(path)
+        assert len(os.listdir(self.cache.directory)) == 2
+
+    def test_prune_max_size(self):
+        old = self.cache.compress(self.src, 'deflate')
+        # Backdate the older copy as if it had been made long ago.
+        os.utime(old.path, (0, 0))
+        with open(old.path + '.json') as f:
+            meta = json.load(f)
+        meta['mtime'] = 0
+        with open(old.path + '.json', 'w') as f:
+            json.dump(meta, f)
+        new = self.cache.compress(self.src, 'gzip')
+        self.cache.prune(max_size=new.size)
+        assert not os.path.exists(old.path)
+        assert os.path.exists(new.path)
@@ -1,4 +1,8 @@
 import os
+import subprocess
+import sys
+
+import gevent
 
 from nose.tools import raises
 
@@ -32,4 +36,49 @@ def test_connection_init_explicit_supercedes_environ():
     assert c.access_key_id == 'explicit'
     assert c.secret_access_key == 'explicit'
 
-#hey
\ No newline at end of file
+#hey
+
+def test_connection_join_nested_first():
+    c = Connection('access_key_id', 'secret_access_key', concurrency=1)
+    order = []
+
+    def work(name):
+        gevent.sleep(0.01)
+        order.append(name)
+
+    def multipart():
+        order.append('multipart')
+        c.join([[work, 'part 1'], [work, 'part 2'], [work, 'part 3']])
+
+    c.join([multipart, [work, 'next']])
+    assert order == ['multipart', 'part 1', 'part 2', 'part 3', 'next']
+
+def test_connection_latency():
+    c = Connection('access_key_id', 'secret_access_key')
+    assert c.latency is None
+    c._measure(None, 0.2)
+    c._measure('small body', 0.4)
+    assert abs(c.latency - 0.3) < 1e-9
+    assert c.bandwidth is None
+    c.reset_stats()
+    assert c.latency is None
+    assert c.makespan == {'predicted': 0.0, 'actual': 0.0}
+
+def test_connection_patches_on_first_use():
+    # In a fresh interpreter, as the test run has long since patched.
+    code = '\n'.join([
+        'import socket, sys',
+        'import s3tup.cli',
+        'from s3tup.connection import Connection',
+        'c = Connection("access_key_id", "secret_access_key")',
+        'assert "gevent" not in sys.modules',
+        'assert "requests" not in sys.modules',
+        'assert "bs4" not in sys.modules',
+        'for m in ("bench", "hashcache", "journal", "parse", "planfile",',
+        '          "redirectcache", "shard", "watch"):',
+        '    assert "s3tup." + m not in sys.modules, m',
+        'c.join([lambda: None])',
+        'import gevent.socket',
+        'assert socket.socket is gevent.socket.socket',
+    ])
+    subprocess.check_call([sys.executable, '-c', code])
@@ -0,0 +1,65 @@
+from tempfile import mkdtemp
+import os
+import shutil
+import time
+
+from s3tup.hashcache import HashCache
+from s3tup.utils import UploadDescriptor
+
+class TestHashCache:
+
+    def setup(self):
+        self.tmp = mkdtemp()
+        self.path = os.path.join(self.tmp, 'state', 'hashes.sqlite')
+        self.file = os.path.join(self.tmp, 'file')
+        self.write('data')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, data, age=10):
+        with open(self.file, 'wb') as f:
+            f.write(data)
+        t = time.time() - age
+        os.utime(self.file, (t, t))
+
+    def save(self, cache, md5='a' * 32, part_md5s=None):
+        with open(self.file, 'rb') as f:
+            d = UploadDescriptor.from_file(f)
+            key = cache.load(f, d)
+            d.md5 = md5
+            d.part_md5s = part_md5s or {}
+            cache.save(f, key, d)
+        cache.flush()
+
+    def load(self, cache):
+        with open(self.file, 'rb') as f:
+            d = UploadDescriptor.from_file(f)
+            cache.load(f, d)
+        return d
+
+    def test_persists(self):
+        self.save(HashCache(self.path), part_md5s={5: ['b' * 32, 'c' * 32]})
+        d = self.load(HashCache(self.path))
+        assert d.md5 == 'a' * 32
+        assert d.part_md5s == {5: ['b' * 32, 'c' * 32]}
+
+    def test_modified_file(self):
+        cache = HashCache(self.path)
+        self.save(cache)
+        self.write('other', age=5)
+        d = self.load(cache)
+        assert d.md5 is None
+
+    def test_replaced_file(self):
+        cache = HashCache(self.path)
+        self.save(cache)
+        os.remove(self.file)
+        self.write('data')
+        assert self.load(cache).md5 is None
+
+    def test_recently_modified_not_cached(self):
+        self.write('data', age=0)
+        cache = HashCache(self.path)
+        self.save(cache)
+        assert self.load(cache).md5 is None
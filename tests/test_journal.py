@@ -0,0 +1,85 @@
+from tempfile import mkdtemp
+import os
+import shutil
+
+from s3tup.journal import UploadJournal
+
+class TestUploadJournal:
+
+    def setup(self):
+        self.tmp = mkdtemp()
+        self.path = os.path.join(self.tmp, 'state', 'uploads.journal')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_empty(self):
+        j = UploadJournal(self.path)
+        assert j.get('bucket', 'key') is None
+
+    def test_persists_parts(self):
+        j = UploadJournal(self.path)
+        j.start('bucket', 'key', 'id', 5242880, ('path', 10, 1.5))
+        j.add_part('bucket', 'key', 'id', 1, 'etag1')
+        j.add_part('bucket', 'key', 'id', 2, 'etag2')
+        j.add_part('bucket', 'key', 'other', 3, 'etag3')
+        entry = UploadJournal(self.path).get('bucket', 'key')
+        assert entry['upload_id'] == 'id'
+        assert entry['part_size'] == 5242880
+        assert entry['fingerprint'] == ['path', 10, 1.5]
+        assert entry['parts'] == {1: 'etag1', 2: 'etag2'}
+
+    def test_finish(self):
+        j = UploadJournal(self.path)
+        j.start('bucket', 'key', 'id', 5242880, ('path', 10, 1.5))
+        j.finish('bucket', 'key', 'id')
+        assert j.get('bucket', 'key') is None
+        assert UploadJournal(self.path).get('bucket', 'key') is None
+
+    def test_items(self):
+        j = UploadJournal(self.path)
+        j.start('bucket', 'key1', 'id1', 5242880, ('path', 10, 1.5))
+        j.start('other', 'key2', 'id2', 5242880, ('path', 10, 1.5))
+        items = j.items('bucket')
+        assert len(items) == 1
+        assert items[0][0] == 'key1'
+
+    def test_compacts_and_skips_bad_lines(self):
+        j = UploadJournal(self.path)
+        j.start('bucket', 'key', 'id', 5242880, ('path', 10, 1.5))
+        j.add_part('bucket', 'key', 'id', 1, 'etag1')
+        j.start('bucket', 'done', 'id2', 5242880, ('path', 10, 1.5))
+        j.finish('bucket', 'done', 'id2')
+        with open(self.path, 'a') as f:
+            f.write('{"op": "part", "bucket"')
+        entry = UploadJournal(self.path).get('bucket', 'key')
+        assert entry['parts'] == {1: 'etag1'}
+        with open(self.path) as f:
+            assert len(f.readlines()) == 2
+
+    def test_non_ascii_names(self):
+        fingerprint = ('/tmp/caf\xc3\xa9', 10, 1.5)
+        j = UploadJournal(self.path)
+        j.start('bucket', 'caf\xc3\xa9', 'id', 5242880, fingerprint)
+        entry = UploadJournal(self.path).get('bucket', 'caf\xc3\xa9')
+        assert entry['fingerprint'] == list(fingerprint)
+
+    def test_concurrent_runs(self):
+        UploadJournal(self.path).start('bucket', 'key', 'id', 5242880,
+                                       ('path', 10, 1.5))
+        pids = []
+        for i in range(4):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    # Every run loads (and so compacts) the journal anew.
+                    for part in range(i * 25 + 1, i * 25 + 26):
+                        UploadJournal(self.path).add_part(
+                            'bucket', 'key', 'id', part, 'etag')
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        entry = UploadJournal(self.path).get('bucket', 'key')
+        assert sorted(entry['parts']) == range(1, 101)
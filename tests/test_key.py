@@ -1,9 +1,18 @@
 from StringIO import StringIO
+from binascii import unhexlify
+from tempfile import mkdtemp, NamedTemporaryFile
+import hashlib
+import os
+import shutil
 
+from mock import MagicMock, patch
 from nose.tools import raises
 
-from s3tup.key import Key, KeyConfigurator
-from s3tup.utils import Matcher
+from s3tup.exception import ETagMismatch, UnverifiableDownload
+from s3tup.journal import UploadJournal
+from s3tup.key import Key, KeyConfigurator, KeyFactory
+from s3tup.utils import Matcher, UploadDescriptor, multipart_etag
+import s3tup.constants as constants
 
 from utils import ConnMock
 
@@ -34,6 +43,60 @@ def test_key_configurator_effects_key():
     assert c.effects_key('test.py')
     assert not c.effects_key('test.md')
 
+# KEY FACTORY
+
+def make_factory():
+    return KeyFactory([
+        KeyConfigurator(canned_acl='public-read', metadata={'a': '1'}),
+        KeyConfigurator(Matcher(['static/*']), cache_control='max-age=60'),
+    ])
+
+def test_key_factory_memoized_headers():
+    f = make_factory()
+    for name in ('static/a.css', 'static/b.css', 'c.css', 'd.tar.gz',
+                 'e.tgz', 'f', 'static/g.png', 'data:h'):
+        k = f.make_key(None, 'bucket', name)
+        fresh = Key(None, 'bucket', name)
+        for c in f.configurators:
+            if c.effects_key(name):
+                fresh = c.configure_key(fresh)
+        assert k.get_headers() == fresh.get_headers()
+        assert k.name == name
+
+def test_key_factory_mimetypes_per_extension():
+    f = make_factory()
+    assert f.make_key(None, 'bucket', 'a.css').get_headers()['content-type'] \
+        == 'text/css'
+    assert f.make_key(None, 'bucket', 'b.png').get_headers()['content-type'] \
+        == 'image/png'
+    headers = f.make_key(None, 'bucket', 'c.css.gz').get_headers()
+    assert headers['content-type'] == 'text/css'
+    assert 'content-type' not in f.make_key(None, 'bucket', 'd').get_headers()
+
+def test_key_factory_set_attribute():
+    f = make_factory()
+    k = f.make_key(None, 'bucket', 'static/a.css')
+    k.cache_control = 'no-cache'
+    assert k.get_headers()['cache-control'] == 'no-cache'
+    k2 = f.make_key(None, 'bucket', 'static/b.css')
+    assert k2.get_headers()['cache-control'] == 'max-age=60'
+
+def test_key_factory_metadata_isolated():
+    f = make_factory()
+    k = f.make_key(None, 'bucket', 'a.css')
+    k.metadata['b'] = '2'
+    assert k.get_headers()['x-amz-meta-b'] == '2'
+    k2 = f.make_key(None, 'bucket', 'b.css')
+    assert 'x-amz-meta-b' not in k2.get_headers()
+    assert k2.metadata == {'a': '1'}
+
+def test_key_factory_configurators_changed():
+    f = make_factory()
+    assert 'expires' not in f.make_key(None, 'bucket', 'a.css').get_headers()
+    f.configurators.append(KeyConfigurator(expires='never'))
+    assert f.make_key(None, 'bucket', 'b.css').get_headers()['expires'] \
+        == 'never'
+
 # KEY
 
 def test_key_pretty_path():
@@ -180,3 +243,207 @@ def test_key_headers_mimetype_guessing():
     headers = k.get_headers()
     assert headers['content-type'] == 'text/css'
 
+
+def test_key_multipart_upload_part():
+    conn = ConnMock()
+    key = Key(conn, 'test', 'test')
+    data = buffer('test')
+    etag = key._multipart_upload_part(data, 1, 'id')
+    assert etag == '098f6bcd4621d373cade4e832627b4f6'
+    conn.make_request.assert_called_once_with(
+        'PUT',
+        'test',
+        'test',
+        params={'partNumber': 1, 'uploadId': 'id'},
+        data=data,
+        md5=unhexlify(etag)
+    )
+
+def test_key_multipart_upload_part_size():
+    conn = ConnMock()
+    conn.join = lambda reqs: [r[0](*r[1:]) for r in reqs]
+    tmp = NamedTemporaryFile()
+    tmp.write('x' * (12 * 1048576 + 10))
+    tmp.flush()
+    tmp.seek(0)
+    # Planning hashed a part size too small to upload with.
+    descriptor = UploadDescriptor.from_file(tmp)
+    descriptor.part_md5s = {4 * 1048576: ['a', 'b', 'c', 'd'],
+                            6 * 1048576: ['e', 'f', 'g']}
+
+    def upload(part_size=None):
+        key = Key(conn, 'test', 'test')
+        if part_size is not None:
+            key.part_size = part_size
+        with patch.object(Key, '_initiate_multipart_upload',
+                          return_value='id') as initiate, \
+                patch.object(Key, '_complete_multipart_upload'), \
+                patch.object(Key, '_multipart_upload_part',
+                             return_value='etag') as upload_part:
+            key._multipart_upload(tmp, descriptor)
+        calls = [c[0] for c in upload_part.call_args_list]
+        for data, part_num, upload_id, journal, md5 in calls[:-1]:
+            assert len(data) >= constants.MULTIPART_PART_SIZE
+        return initiate.call_args[0][0], [c[4] for c in calls]
+
+    assert upload() == (constants.MULTIPART_PART_SIZE, [None] * 3)
+    # The configured part size is used, with planning's digests of it.
+    assert upload(6 * 1048576) == (6 * 1048576, ['e', 'f', 'g'])
+    tmp.close()
+
+def test_key_resume_multipart_upload_changed_file():
+    conn = ConnMock()
+    journal = UploadJournal(os.path.join(mkdtemp(), 'uploads.journal'))
+    journal.start('test', 'test', 'id', 5242880, ('path', 10, 1.5))
+    key = Key(conn, 'test', 'test', journal=journal)
+    assert key._resume_multipart_upload(('path', 11, 2.5)) is None
+    conn.make_request.assert_called_once_with(
+        'DELETE',
+        'test',
+        'test',
+        params={'uploadId': 'id'}
+    )
+    assert journal.get('test', 'test') is None
+    shutil.rmtree(os.path.dirname(journal.path))
+
+def test_key_upload_from_stream():
+    conn = ConnMock()
+    key = Key(conn, 'test', 'test')
+    key.upload_from_stream(iter(['te', 'st']))
+    conn.make_request.assert_called_once_with(
+        'PUT',
+        'test',
+        'test',
+        data='test'
+    )
+
+def test_key_upload_from_file_descriptor():
+    conn = ConnMock()
+    key = Key(conn, 'test', 'test')
+    tmp = NamedTemporaryFile()
+    tmp.write('test')
+    tmp.flush()
+    tmp.seek(0)
+    descriptor = UploadDescriptor.from_file(tmp)
+    descriptor.md5 = '098f6bcd4621d373cade4e832627b4f6'
+    key.upload_from_file(tmp, descriptor)
+    conn.make_request.assert_called_once_with(
+        'PUT',
+        'test',
+        'test',
+        data='test',
+        descriptor=descriptor
+    )
+    tmp.close()
+
+def test_key_headers_compress():
+    k = Key(None, 'bucket', 'key', compress='gzip')
+    assert k.get_headers()['content-encoding'] == 'gzip'
+    k.content_encoding = 'identity'
+    assert k.get_headers()['content-encoding'] == 'identity'
+
+class ObjectConnMock(object):
+    """Serves a single object, honoring Range headers."""
+
+    def __init__(self, data, headers=None):
+        self.data = data
+        self.headers = headers or {}
+        self.ranges = []
+
+    def make_request(self, method, bucket, key, headers=None, **kwargs):
+        data = self.data
+        if headers is not None and 'Range' in headers:
+            start, end = headers['Range'][len('bytes='):].split('-')
+            data = data[int(start):int(end)+1]
+            self.ranges.append((int(start), int(end)))
+        resp = MagicMock()
+        resp.iter_content = lambda size: (data[i:i+size]
+                                          for i in range(0, len(data), size))
+        resp.headers = self.headers
+        return resp
+
+    def join(self, functions):
+        return [f[0](*f[1:]) for f in functions]
+
+def test_key_download_to_path():
+    tmp = mkdtemp()
+    part_size = constants.DOWNLOAD_PART_SIZE
+    constants.DOWNLOAD_PART_SIZE = 4
+    try:
+        conn = ObjectConnMock('0123456789')
+        key = Key(conn, 'test', 'test')
+        path = os.path.join(tmp, 'dir', 'file')
+        key.download_to_path(path, 10, hashlib.md5('0123456789').hexdigest())
+        with open(path, 'rb') as f:
+            assert f.read() == '0123456789'
+        assert conn.ranges == [(0, 3), (4, 7), (8, 9)]
+        assert os.listdir(os.path.join(tmp, 'dir')) == ['file']
+    finally:
+        constants.DOWNLOAD_PART_SIZE = part_size
+        shutil.rmtree(tmp)
+
+def test_key_download_to_path_multipart():
+    tmp = mkdtemp()
+    try:
+        data = 'x' * (5242880 + 10)
+        etag = multipart_etag([hashlib.md5(data[:5242880]).hexdigest(),
+                               hashlib.md5(data[5242880:]).hexdigest()])
+        conn = ObjectConnMock(data)
+        key = Key(conn, 'test', 'test')
+        path = os.path.join(tmp, 'file')
+        key.download_to_path(path, len(data), etag)
+        assert conn.ranges == [(0, 5242879), (5242880, 5242889)]
+        assert os.path.getsize(path) == len(data)
+    finally:
+        shutil.rmtree(tmp)
+
+def test_key_download_to_path_mismatch():
+    tmp = mkdtemp()
+    try:
+        conn = ObjectConnMock('corrupted')
+        key = Key(conn, 'test', 'test')
+        path = os.path.join(tmp, 'file')
+        try:
+            key.download_to_path(path, 9, hashlib.md5('original').hexdigest())
+            assert False
+        except ETagMismatch:
+            pass
+        assert os.listdir(tmp) == []
+    finally:
+        shutil.rmtree(tmp)
+
+def test_key_download_to_path_chunked():
+    tmp = mkdtemp()
+    chunk_size = constants.DOWNLOAD_CHUNK_SIZE
+    constants.DOWNLOAD_CHUNK_SIZE = 3
+    try:
+        conn = ObjectConnMock('0123456789')
+        key = Key(conn, 'test', 'test')
+        path = os.path.join(tmp, 'file')
+        key.download_to_path(path, 10, hashlib.md5('0123456789').hexdigest())
+        with open(path, 'rb') as f:
+            assert f.read() == '0123456789'
+    finally:
+        constants.DOWNLOAD_CHUNK_SIZE = chunk_size
+        shutil.rmtree(tmp)
+
+def test_key_download_to_path_unverifiable():
+    tmp = mkdtemp()
+    try:
+        # Two parts of sizes no part size could give.
+        data = 'x' * (5242880 * 3)
+        etag = multipart_etag([hashlib.md5(data[:5242880]).hexdigest(),
+                               hashlib.md5(data[5242880:]).hexdigest()])
+        conn = ObjectConnMock(data)
+        key = Key(conn, 'test', 'test')
+        path = os.path.join(tmp, 'file')
+        try:
+            key.download_to_path(path, len(data), etag)
+            assert False
+        except UnverifiableDownload:
+            pass
+        assert os.listdir(tmp) == []
+        key.download_to_path(path, len(data), etag, unverified=True)
+        assert os.path.getsize(path) == len(data)
+    finally:
+        shutil.rmtree(tmp)
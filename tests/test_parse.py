@@ -1,3 +1,8 @@
+from tempfile import mkdtemp
+import copy
+import os
+import shutil
+
 from nose.tools import raises
 
 from s3tup import parse
@@ -17,6 +22,69 @@ def test_parse_config_success():
     assert len(buckets) == 10
     assert buckets[0].name == 'test'
 
+def test_parse_config_does_not_mutate_input():
+    config = [{'bucket': 'test', 'region': 'test',
+               'rsync': [{'src': 'test', 'patterns': ['*.html']}],
+               'key_config': [{'patterns': ['*.py'],
+                               'metadata': {'a': 'b'}}],
+               'redirects': [['old', '/new']]}]
+    before = copy.deepcopy(config)
+    parse.parse_config(config)
+    assert config == before
+
+# load_buckets
+
+CONFIG = """
+- bucket: test
+  rsync: {src: test, patterns: ['*.html']}
+  key_config:
+    - patterns: ['*.py']
+      content_type: text/plain
+"""
+
+def test_load_buckets_cache():
+    tmp = mkdtemp()
+    os.environ['AWS_ACCESS_KEY_ID'] = 'access_key_id'
+    os.environ['AWS_SECRET_ACCESS_KEY'] = 'secret_access_key'
+    try:
+        path = os.path.join(tmp, 'config.yml')
+        with open(path, 'w') as f:
+            f.write(CONFIG)
+        cache_dir = os.path.join(tmp, 'cache')
+        parse.load_buckets(path, cache_dir)
+        cached = os.listdir(cache_dir)
+        assert len(cached) == 1
+        with open(os.path.join(cache_dir, cached[0]), 'rb') as f:
+            assert 'secret_access_key' not in f.read()
+
+        parse_config = parse.parse_config
+        parse.parse_config = None
+        try:
+            bucket = parse.load_buckets(path, cache_dir)[0]
+        finally:
+            parse.parse_config = parse_config
+        assert bucket.name == 'test'
+        assert bucket.conn.secret_access_key == 'secret_access_key'
+        assert bucket.rsync_planner.configs[0].matcher.matches('a.html')
+        assert not bucket.rsync_planner.configs[0].matcher.matches('a.py')
+        key = bucket.key_factory.make_key(None, 'test', 'a.py')
+        assert key.content_type == 'text/plain'
+    finally:
+        shutil.rmtree(tmp)
+
+def test_load_buckets_cache_skips_credentials():
+    tmp = mkdtemp()
+    try:
+        path = os.path.join(tmp, 'config.yml')
+        with open(path, 'w') as f:
+            f.write(CONFIG + '  access_key_id: a\n  secret_access_key: b\n')
+        cache_dir = os.path.join(tmp, 'cache')
+        bucket = parse.load_buckets(path, cache_dir)[0]
+        assert bucket.conn.secret_access_key == 'b'
+        assert not os.path.exists(cache_dir)
+    finally:
+        shutil.rmtree(tmp)
+
 # parse_bucket
 
 @raises(ConfigParseError)
@@ -66,11 +134,29 @@ def test_parse_rsync_object_invalid_kwarg():
     d = {'src': 'test', 'invalid': True}
     parse.parse_rsync_object(d)
 
+def test_parse_rsync_object_runtime_kwargs():
+    # Set by s3tup while running, not by configs.
+    for k in ('hash_cache', 'digests', 'matcher'):
+        try:
+            parse.parse_rsync_object({'src': 'test', k: True})
+        except ConfigParseError as e:
+            assert k in str(e)
+        else:
+            assert False
+
+@raises(ConfigParseError)
+def test_parse_rsync_object_invalid_compare():
+    d = {'src': 'test', 'compare': 'invalid'}
+    parse.parse_rsync_object(d)
+
 def test_parse_rsync_object_success():
-    d = {'src': 'test', 'delete': True, 'patterns': ['test',]}
+    d = {'src': 'test', 'delete': True, 'patterns': ['test',],
+         'hash_pool': 'process', 'hash_workers': 2, 'symlinks': 'skip'}
     rs = parse.parse_rsync_object(d)
     assert rs.src == 'test'
     assert rs.delete
+    assert rs.hash_pool == 'process'
+    assert rs.hash_workers == 2
     assert 'test' in rs.matcher.patterns
 
 # parse_key_config
@@ -0,0 +1,139 @@
+from StringIO import StringIO
+from tempfile import mkdtemp
+import os
+import shutil
+
+from mock import MagicMock
+from nose.tools import raises
+
+from s3tup.bucket import Bucket
+from s3tup.connection import Connection
+from s3tup.exception import StalePlan
+from s3tup.key import KeyConfigurator, KeyFactory
+from s3tup.planfile import PlanApplier, PlanWriter, apply_plan, open_plan, \
+                           read_plan
+from s3tup.rsync import ActionPlan
+from s3tup.shard import Shard
+from s3tup.utils import Matcher, UploadDescriptor
+
+def request(call):
+    """Return (method, key, subresource) of a make_request call."""
+    args, kwargs = call
+    names = ('method', 'bucket', 'key')
+    kwargs = dict(zip(names, args), **kwargs)
+    return kwargs['method'], kwargs['key'], kwargs.get('subresource')
+
+class TestPlanFile:
+
+    def setup(self):
+        self.tmp = mkdtemp()
+        self.path = os.path.join(self.tmp, 'file.html')
+        with open(self.path, 'wb') as f:
+            f.write('data')
+        conn = Connection('access_key_id', 'secret_access_key',
+                          concurrency=0)
+        conn.make_request = MagicMock()
+        factory = KeyFactory([
+            KeyConfigurator(canned_acl='public-read'),
+            KeyConfigurator(Matcher(['*.html']), acl='<acl/>',
+                            cache_control='max-age=60'),
+        ])
+        self.bucket = Bucket(conn, 'bucket', factory)
+
+        self.plan = ActionPlan()
+        st = os.stat(self.path)
+        descriptor = UploadDescriptor(self.path, st.st_size, st.st_mtime,
+                                      '8d777f385d3dfec8815d20f7496026dc',
+                                      {5242880: ['a' * 32]})
+        self.plan.add_upload('file.html', self.path, descriptor)
+        self.plan.add_redirect('old', 'http://example.com/')
+        self.plan.add_sync('synced')
+        self.plan.add_delete('deleted')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self):
+        f = StringIO()
+        PlanWriter(f).write_plan(self.bucket, self.plan)
+        f.seek(0)
+        return f
+
+    def test_write_read(self):
+        records = list(read_plan(self.write()))
+        assert records[0] == {'bucket': 'bucket',
+                              'hostname': 's3.amazonaws.com', 'format': 1}
+        assert [r['type'] for r in records[1:]] == \
+            ['upload', 'redirect', 'sync', 'delete']
+        upload = records[1]
+        assert upload['key'] == 'file.html'
+        assert upload['path'] == self.path
+        assert upload['size'] == 4
+        assert upload['mtime'] == os.stat(self.path).st_mtime
+        assert upload['md5'] == '8d777f385d3dfec8815d20f7496026dc'
+        assert upload['part_md5s'] == {5242880: ['a' * 32]}
+        assert upload['headers'] == {'x-amz-acl': 'public-read',
+                                     'cache-control': 'max-age=60',
+                                     'content-type': 'text/html'}
+        assert upload['attrs'] == {'acl': '<acl/>'}
+        assert records[2]['url'] == 'http://example.com/'
+        assert 'attrs' not in records[3]
+        assert records[4] == {'type': 'delete', 'key': 'deleted'}
+
+    def test_gzip(self):
+        path = os.path.join(self.tmp, 'plan.jsonl.gz')
+        with open_plan(path, 'w') as f:
+            PlanWriter(f).write_plan(self.bucket, self.plan)
+        with open_plan(path) as f:
+            assert len(list(read_plan(f))) == 5
+
+    def apply(self, f):
+        applier = PlanApplier(self.bucket)
+        for record in read_plan(f):
+            if 'type' in record:
+                applier.add(record)
+        return applier.finish()
+
+    def test_apply(self):
+        assert self.apply(self.write()) == 0
+        calls = self.bucket.conn.make_request.call_args_list
+        requests = sorted(request(c) for c in calls)
+        assert requests == [
+            ('POST', None, 'delete'),
+            ('PUT', 'file.html', None),
+            ('PUT', 'old', None),
+            ('PUT', 'synced', None),
+        ]
+        upload = [c for c in calls
+                  if request(c) == ('PUT', 'file.html', None)][0]
+        assert upload[1]['headers']['cache-control'] == 'max-age=60'
+        descriptor = upload[1]['descriptor']
+        assert descriptor.md5 == '8d777f385d3dfec8815d20f7496026dc'
+
+    def test_apply_stale(self):
+        f = self.write()
+        os.utime(self.path, (0, 0))
+        assert self.apply(f) == 1
+        calls = self.bucket.conn.make_request.call_args_list
+        assert 'file.html' not in [request(c)[1] for c in calls]
+
+    def test_apply_sharded(self):
+        requests = []
+        for index in (1, 0):
+            self.bucket.conn.make_request.reset_mock()
+            shard = Shard(index, 2, barrier_dir=self.tmp, run_id='run')
+            applier = PlanApplier(self.bucket, shard=shard, barrier_id='id')
+            for record in read_plan(self.write()):
+                if 'type' in record:
+                    applier.add(record)
+            applier.finish()
+            calls = self.bucket.conn.make_request.call_args_list
+            requests.append([request(c) for c in calls])
+        assert ('POST', None, 'delete') == requests[1][-1]
+        keys = sorted(r[1] for r in requests[0] + requests[1][:-1])
+        assert keys == ['file.html', 'old', 'synced']
+        assert sorted(os.listdir(self.tmp)) == ['file.html']
+
+    @raises(StalePlan)
+    def test_apply_plan_without_bucket(self):
+        apply_plan(StringIO('{"type":"delete","key":"k"}\n'))
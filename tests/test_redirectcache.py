@@ -0,0 +1,75 @@
+from tempfile import mkdtemp
+import os
+import shutil
+import sqlite3
+
+from s3tup.redirectcache import RedirectCache, fingerprint
+from s3tup.utils import parse_timestamp
+
+THEN = '2026-10-19T12:00:00.500Z'
+SOON_AFTER = '2026-10-19T12:00:01.000Z'
+LATER = '2026-10-19T12:01:00.000Z'
+PUT_TIME = parse_timestamp(THEN) + 1
+
+class TestRedirectCache:
+
+    def setup(self):
+        self.tmp = mkdtemp()
+        self.path = os.path.join(self.tmp, 'state', 'redirects.sqlite')
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_miss(self):
+        cache = RedirectCache(self.path)
+        assert not cache.matches('host/bucket', 'key', 'fp', THEN)
+
+    def test_store_and_match(self):
+        cache = RedirectCache(self.path)
+        cache.store('host/bucket', 'key', 'fp', PUT_TIME)
+        cache.flush()
+        cache = RedirectCache(self.path)
+        # The first listing after the redirect was put is checked against
+        # the time of the put...
+        assert not cache.matches('host/bucket', 'key', 'fp', LATER)
+        assert cache.matches('host/bucket', 'key', 'fp', THEN)
+        assert not cache.matches('host/bucket', 'key', 'other', THEN)
+        assert not cache.matches('host/other', 'key', 'fp', THEN)
+        # ...and then anything else writing the key changes it.
+        assert cache.matches('host/bucket', 'key', 'fp', THEN)
+        assert not cache.matches('host/bucket', 'key', 'fp', SOON_AFTER)
+
+    def test_store_without_put_time(self):
+        cache = RedirectCache(self.path)
+        cache.store('host/bucket', 'key', 'fp')
+        assert not cache.matches('host/bucket', 'key', 'fp', THEN)
+
+    def test_store_resets_modified(self):
+        cache = RedirectCache(self.path)
+        cache.store('host/bucket', 'key', 'fp', PUT_TIME)
+        assert cache.matches('host/bucket', 'key', 'fp', THEN)
+        cache.store('host/bucket', 'key', 'fp', PUT_TIME + 60)
+        assert cache.matches('host/bucket', 'key', 'fp', LATER)
+
+    def test_old_cache(self):
+        os.mkdir(os.path.dirname(self.path))
+        db = sqlite3.connect(self.path)
+        db.execute('CREATE TABLE redirects (bucket TEXT NOT NULL, '
+                   'key TEXT NOT NULL, fingerprint TEXT NOT NULL, '
+                   'modified TEXT, PRIMARY KEY (bucket, key))')
+        db.execute("INSERT INTO redirects VALUES "
+                   "('host/bucket', 'listed', 'fp', ?)", (THEN,))
+        db.execute("INSERT INTO redirects VALUES "
+                   "('host/bucket', 'unlisted', 'fp', NULL)")
+        db.commit()
+        db.close()
+        cache = RedirectCache(self.path)
+        assert cache.matches('host/bucket', 'listed', 'fp', THEN)
+        assert not cache.matches('host/bucket', 'unlisted', 'fp', THEN)
+
+def test_fingerprint():
+    headers = {'x-amz-acl': 'public-read', 'cache-control': 'max-age=60'}
+    fp = fingerprint('/new', headers)
+    assert fp == fingerprint('/new', dict(headers))
+    assert fp != fingerprint('/other', headers)
+    assert fp != fingerprint('/new', {'x-amz-acl': 'private'})
@@ -1,7 +1,21 @@
+from collections import namedtuple
+from StringIO import StringIO
+from tempfile import mkdtemp
+import hashlib
+import os
+import shutil
+import time
+
 from nose.tools import raises
 
-from s3tup.rsync import ActionPlan, RsyncConfig
+from s3tup.hashcache import HashCache
+from s3tup.key import Key
+from s3tup.rsync import ActionPlan, RsyncConfig, RsyncPlanner
 from s3tup.exception import ActionConflict
+import s3tup.constants as constants
+import s3tup.utils as utils
+
+KeyTuple = namedtuple('KeyTuple', ['name', 'md5', 'size', 'modified'])
 
 class TestActionPlan:
 
@@ -38,12 +52,28 @@ class TestActionPlan:
         assert len(list(ap.affected_keys)) == 1
         assert len(list(ap.to_upload)) == 1
 
+    def test_download_after_local_delete(self):
+        ap = ActionPlan()
+        ap.add_local_delete('test', 'path')
+        ap.add_download('test', 'path')
+        assert list(ap.to_download) == [('test', 'path')]
+        assert len(list(ap.to_local_delete)) == 0
+
     @raises(ActionConflict)
     def test_action_plan_upload_after_upload_different(self):
         ap = ActionPlan()
         ap.add_upload('test', 'path')
         ap.add_upload('test', 'different_path')
 
+    def test_upload_descriptor(self):
+        ap = ActionPlan()
+        ap.add_upload('test', 'path', 'descriptor')
+        ap.add_upload('test', 'path')
+        assert ap.get_descriptor('test') == 'descriptor'
+        assert (ap + ActionPlan()).get_descriptor('test') == 'descriptor'
+        ap.remove_actions('upload')
+        assert ap.get_descriptor('test') is None
+
     def test_merge(self):
         ap1 = ActionPlan()
         ap2 = ActionPlan()
@@ -62,6 +92,59 @@ class TestActionPlan:
         ap2.add_upload('test1', 'path')
         ap1 + ap2
 
+    def test_merge_in_place(self):
+        ap1 = ActionPlan()
+        ap2 = ActionPlan()
+        ap1.add_delete('test1')
+        ap2.add_upload('test1', 'path', 'descriptor')
+        ap2.add_delete('test2')
+        ap = ap1
+        ap1 += ap2
+        assert ap1 is ap
+        assert list(ap1.to_upload) == [('test1', 'path')]
+        assert list(ap1.to_delete) == ['test2']
+        assert ap1.get_descriptor('test1') == 'descriptor'
+
+    @raises(ActionConflict)
+    def test_merge_in_place_conflict(self):
+        ap1 = ActionPlan()
+        ap2 = ActionPlan()
+        ap1.add_upload('test1', 'path')
+        ap2.add_upload('test1', 'different_path')
+        ap1.merge(ap2)
+
+    def test_counts(self):
+        ap = ActionPlan()
+        ap.add_upload('test1', 'path')
+        ap.add_upload('test2', 'path')
+        ap.add_delete('test3')
+        ap.add_delete('test1')
+        assert ap.count('upload') == 2
+        assert ap.count('delete') == 1
+        assert ap.count('sync') == 0
+        assert len(ap) == 3
+        assert 'test3' in ap
+        assert 'test4' not in ap
+        ap.remove_actions('upload')
+        assert len(ap) == 1
+
+    def test_dump_load(self):
+        ap = ActionPlan()
+        ap.add_upload('test1', 'path', 'descriptor')
+        ap.add_redirect('test2', 'http://example.com/')
+        ap.add_delete('caf\xc3\xa9')
+        ap.add_sync('test3')
+        f = StringIO()
+        ap.dump(f)
+        assert '["delete","caf\\u00e9"]\n' in f.getvalue()
+        f.seek(0)
+        loaded = ActionPlan.load(f)
+        assert sorted(loaded.to_upload) == [('test1', 'path')]
+        assert sorted(loaded.to_redirect) == [('test2', 'http://example.com/')]
+        assert list(loaded.to_delete) == ['caf\xc3\xa9']
+        assert list(loaded.to_sync) == ['test3']
+        assert loaded.get_descriptor('test1') is None
+
 # RSYNC CONFIG
 
 def test_rsync_config_get_local_path_from_key():
@@ -72,4 +155,281 @@ def test_rsync_config_get_local_path_from_key():
     r.dest = 'dest'
     assert r._get_local_path_from_key('dest/key') == 'src/key'
     r.src = None
-    assert r._get_local_path_from_key('dest/key') == 'key'
\ No newline at end of file
+    assert r._get_local_path_from_key('dest/key') == 'key'
+
+def test_rsync_config_is_unmodified_multipart_part_size():
+    tmp = mkdtemp()
+    try:
+        with open(os.path.join(tmp, 'key'), 'wb') as f:
+            f.write('x' * (12 * 1048576 + 10))
+        with open(os.path.join(tmp, 'key'), 'rb') as f:
+            etag = utils.f_multipart_etag(f, 6 * 1048576)
+        r = RsyncConfig(tmp)
+        remote = KeyTuple('key', etag, 12 * 1048576 + 10, None)
+        assert r._is_unmodified(remote)
+        remote = KeyTuple('key', etag.replace('-3', '-2'), remote.size, None)
+        assert not r._is_unmodified(remote)
+    finally:
+        shutil.rmtree(tmp)
+
+def test_rsync_config_plan_carries_descriptor():
+    tmp = mkdtemp()
+    try:
+        with open(os.path.join(tmp, 'key'), 'wb') as f:
+            f.write('modified')
+        r = RsyncConfig(tmp)
+        remote = {'key': KeyTuple('key', 'd41d8cd98f00b204e9800998ecf8427e',
+                                  8, None)}
+        plan = r.plan(remote)
+        assert list(plan.to_upload) == [('key', os.path.join(tmp, 'key'))]
+        descriptor = plan.get_descriptor('key')
+        assert descriptor.size == 8
+        assert descriptor.md5 == hashlib.md5('modified').hexdigest()
+    finally:
+        shutil.rmtree(tmp)
+
+def test_rsync_config_compare_compressed():
+    tmp = mkdtemp()
+    cache_dir = constants.COMPRESSION_CACHE_DIR
+    constants.COMPRESSION_CACHE_DIR = os.path.join(tmp, 'cache')
+
+    class BucketStub(object):
+        def make_key(self, name):
+            return Key(None, 'bucket', name, compress='gzip')
+
+    try:
+        os.mkdir(os.path.join(tmp, 'src'))
+        with open(os.path.join(tmp, 'src', 'key'), 'wb') as f:
+            f.write('data' * 100)
+        r = RsyncConfig(os.path.join(tmp, 'src'))
+        d = BucketStub().make_key('key').get_compressed(
+            os.path.join(tmp, 'src', 'key'))
+        remote = KeyTuple('key', d.md5, d.size, None)
+        assert r._is_unmodified(remote, BucketStub())
+        assert not r._is_unmodified(remote)
+    finally:
+        constants.COMPRESSION_CACHE_DIR = cache_dir
+        shutil.rmtree(tmp)
+
+def test_rsync_config_plan_download():
+    tmp = mkdtemp()
+    try:
+        for name, data in (('same', 'same'), ('changed', 'old'),
+                           ('local_only', 'x')):
+            with open(os.path.join(tmp, name), 'wb') as f:
+                f.write(data)
+        remote = {}
+        for name, data in (('dest/same', 'same'), ('dest/changed', 'new'),
+                           ('dest/new', 'new'), ('dest/dir/', ''),
+                           ('dest/../evil', 'x'), ('other/key', 'x')):
+            remote[name] = KeyTuple(name, hashlib.md5(data).hexdigest(),
+                                    len(data), None)
+        r = RsyncConfig(tmp, 'dest', delete=True)
+        plan = r.plan_download(remote)
+        assert sorted(plan.to_download) == [
+            ('dest/changed', os.path.join(tmp, 'changed')),
+            ('dest/new', os.path.join(tmp, 'new')),
+        ]
+        assert list(plan.to_local_delete) == [
+            ('dest/local_only', os.path.join(tmp, 'local_only'))]
+    finally:
+        shutil.rmtree(tmp)
+
+def test_rsync_config_hash_cache():
+    tmp = mkdtemp()
+    try:
+        path = os.path.join(tmp, 'src', 'key')
+        os.mkdir(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write('data')
+        os.utime(path, (time.time() - 10, time.time() - 10))
+        cache = HashCache(os.path.join(tmp, 'hashes.sqlite'))
+        r = RsyncConfig(os.path.dirname(path), hash_cache=cache)
+        remote = KeyTuple('key', hashlib.md5('data').hexdigest(), 4, None)
+        assert r._is_unmodified(remote)
+        f_md5 = utils.f_md5
+        utils.f_md5 = None
+        try:
+            assert r._is_unmodified(remote)
+        finally:
+            utils.f_md5 = f_md5
+    finally:
+        shutil.rmtree(tmp)
+
+def test_rsync_config_compare_modes():
+    tmp = mkdtemp()
+    try:
+        path = os.path.join(tmp, 'key')
+        with open(path, 'wb') as f:
+            f.write('data')
+        mtime = utils.parse_timestamp('2013-06-01T12:00:00.000Z')
+        os.utime(path, (mtime, mtime))
+        stale = hashlib.md5('atad').hexdigest()
+
+        def remote(modified, md5=stale, size=4):
+            return KeyTuple('key', md5, size, modified)
+
+        r = RsyncConfig(tmp, compare='size-only')
+        assert r._is_unmodified(remote(None))
+        assert not r._is_unmodified(remote(None, size=5))
+
+        r = RsyncConfig(tmp, compare='size-mtime')
+        assert r._is_unmodified(remote('2013-06-01T12:00:05.000Z'))
+        # Newer locally, so checksummed.
+        assert not r._is_unmodified(remote('2013-06-01T11:59:58.000Z'))
+        assert r._is_unmodified(remote('2013-06-01T11:59:58.000Z',
+                                       hashlib.md5('data').hexdigest()))
+        r.mtime_tolerance = 5
+        assert r._is_unmodified(remote('2013-06-01T11:59:58.000Z'))
+    finally:
+        shutil.rmtree(tmp)
+
+@raises(ValueError)
+def test_rsync_config_invalid_compare():
+    RsyncConfig(compare='md5')
+
+def test_rsync_config_plan_hash_pools():
+    tmp = mkdtemp()
+    try:
+        remote = {}
+        for i in range(20):
+            data = str(i) * (i * 1000)
+            with open(os.path.join(tmp, 'key{}'.format(i)), 'wb') as f:
+                f.write(data)
+            if i % 3:
+                data += 'modified'
+            remote['key{}'.format(i)] = KeyTuple(
+                'key{}'.format(i), hashlib.md5(data).hexdigest(),
+                i * len(str(i)) * 1000, None)
+
+        def summary(plan):
+            return sorted(plan.to_upload), sorted(plan.to_sync)
+
+        serial = summary(RsyncConfig(tmp, hash_workers=1).plan(remote))
+        assert len(serial[1]) == 7
+        for pool in ('thread', 'process'):
+            r = RsyncConfig(tmp, hash_workers=4, hash_pool=pool)
+            assert summary(r.plan(remote)) == serial
+    finally:
+        shutil.rmtree(tmp)
+
+def test_rsync_planner_walks_shared_src_once():
+    tmp = mkdtemp()
+    try:
+        for name in ('a.html', 'b.css', 'c.txt'):
+            with open(os.path.join(tmp, name), 'wb') as f:
+                f.write(name)
+        remote = {'c.txt': KeyTuple('c.txt', hashlib.md5('c.txt').hexdigest(),
+                                    5, None),
+                  'gone': KeyTuple('gone', '', 0, None)}
+        configs = [RsyncConfig(tmp, matcher=utils.Matcher(['*.html'])),
+                   RsyncConfig(tmp, matcher=utils.Matcher(['*.css'])),
+                   RsyncConfig(tmp, delete=True,
+                               matcher=utils.Matcher(['*.txt']))]
+        expected = ActionPlan()
+        for config in configs:
+            expected.merge(config.plan(remote))
+
+        scans = []
+        scan_dir = utils._scan_dir
+        def counting_scan_dir(path):
+            scans.append(path)
+            return scan_dir(path)
+        utils._scan_dir = counting_scan_dir
+        try:
+            plan = RsyncPlanner(configs).plan(remote)
+        finally:
+            utils._scan_dir = scan_dir
+        assert scans == [tmp]
+        assert sorted(plan.to_upload) == sorted(expected.to_upload)
+        assert list(plan.to_delete) == ['gone']
+        assert list(plan.to_sync) == list(expected.to_sync)
+    finally:
+        shutil.rmtree(tmp)
+
+def test_rsync_config_plan_paths():
+    tmp = mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmp, 'dir'))
+        for name in ('same', 'changed', 'dir/file', 'dir/skip.tmp'):
+            with open(os.path.join(tmp, name), 'wb') as f:
+                f.write(name)
+        remote = {}
+        for name, data in (('dest/same', 'same'), ('dest/changed', 'old'),
+                           ('dest/gone', 'x'), ('dest/gonedir/a', 'x'),
+                           ('dest/untouched', 'x')):
+            remote[name] = KeyTuple(name, hashlib.md5(data).hexdigest(),
+                                    len(data), None)
+        remote['dest/unknown'] = KeyTuple('dest/unknown', None, None, None)
+        with open(os.path.join(tmp, 'unknown'), 'wb') as f:
+            f.write('unknown')
+        r = RsyncConfig(tmp, 'dest', delete=True,
+                        matcher=utils.Matcher(ignore_patterns=['*.tmp']))
+        plan = r.plan_paths(['same', 'changed', 'dir', 'gone', 'gonedir',
+                             'unknown'], remote)
+        assert sorted(k for k, _ in plan.to_upload) == [
+            'dest/changed', 'dest/dir/file', 'dest/unknown']
+        assert sorted(plan.to_delete) == ['dest/gone', 'dest/gonedir/a']
+        assert list(plan.to_sync) == []
+    finally:
+        shutil.rmtree(tmp)
+
+def test_rsync_config_hashes_linked_files_once():
+    tmp = mkdtemp()
+    try:
+        with open(os.path.join(tmp, 'file'), 'wb') as f:
+            f.write('data')
+        os.link(os.path.join(tmp, 'file'), os.path.join(tmp, 'hardlink'))
+        os.symlink('file', os.path.join(tmp, 'symlink'))
+        with open(os.path.join(tmp, 'other'), 'wb') as f:
+            f.write('atad')
+        remote = {}
+        for name in ('file', 'hardlink', 'symlink', 'other'):
+            remote[name] = KeyTuple(name, hashlib.md5('data').hexdigest(),
+                                    4, None)
+
+        hashed = []
+        digests = utils.f_digests
+        def counting_digests(f, *args, **kwargs):
+            hashed.append(os.path.basename(f.name))
+            return digests(f, *args, **kwargs)
+        utils.f_digests = counting_digests
+        try:
+            plan = RsyncConfig(tmp, hash_workers=1).plan(remote)
+        finally:
+            utils.f_digests = digests
+        assert len(hashed) == 2
+        assert sorted(plan.to_sync) == ['file', 'hardlink', 'symlink']
+        assert [k for k, _ in plan.to_upload] == ['other']
+    finally:
+        shutil.rmtree(tmp)
+
+def test_rsync_config_symlink_policies():
+    tmp = mkdtemp()
+    try:
+        os.mkdir(os.path.join(tmp, 'src'))
+        for name in ('src/file', 'outside'):
+            with open(os.path.join(tmp, name), 'wb') as f:
+                f.write(name)
+        os.symlink('file', os.path.join(tmp, 'src', 'link'))
+        os.symlink('../outside', os.path.join(tmp, 'src', 'out'))
+        src = os.path.join(tmp, 'src')
+
+        def summary(plan):
+            return (sorted(k for k, _ in plan.to_upload),
+                    sorted(plan.to_redirect))
+
+        r = RsyncConfig(src, 'dest')
+        assert summary(r.plan({})) == (
+            ['dest/file', 'dest/link', 'dest/out'], [])
+        r = RsyncConfig(src, 'dest', symlinks='skip')
+        assert summary(r.plan({})) == (['dest/file'], [])
+        r = RsyncConfig(src, 'dest', symlinks='redirect')
+        assert summary(r.plan({})) == (['dest/file', 'dest/out'],
+                                       [('dest/link', '/dest/file')])
+    finally:
+        shutil.rmtree(tmp)
+
+@raises(ValueError)
+def test_rsync_config_invalid_symlinks():
+    RsyncConfig(symlinks='copy')
@@ -0,0 +1,38 @@
+from s3tup.schedule import CostModel, lpt_order, predict_makespan
+import s3tup.constants as constants
+
+
+def test_cost_model_defaults():
+    model = CostModel()
+    assert model.latency == constants.SCHEDULE_LATENCY
+    assert model.bandwidth == constants.SCHEDULE_BANDWIDTH
+
+def test_cost_model_upload():
+    model = CostModel(latency=1, bandwidth=1048576)
+    assert model.upload(1048576) == [2]
+
+    costs = model.upload(3 * constants.MULTIPART_PART_SIZE + 1048576)
+    assert costs == [2, 6, 6, 6, 2]
+
+def test_lpt_order():
+    jobs = [([1], 'small'), ([2, 5, 5], 'multipart'), ([4], 'big')]
+    assert [a for c, a in lpt_order(jobs)] == ['multipart', 'big', 'small']
+
+def test_predict_makespan():
+    jobs = [([4], 'a'), ([3], 'b'), ([3], 'c'), ([2], 'd')]
+    assert predict_makespan(jobs, 1) == 12
+    assert predict_makespan(jobs, 2) == 6
+    assert predict_makespan(jobs, 10) == 4
+    assert predict_makespan([], 2) == 0
+
+def test_predict_makespan_parts_first():
+    # Once ready, parts of the started upload go ahead of later jobs.
+    jobs = [([1, 2, 2], 'multipart'), ([3], 'next'), ([3], 'last')]
+    # 0-1 initiate, 1-3 part 1 | 0-3 next
+    # 3-5 part 2                | 3-6 last
+    assert predict_makespan(jobs, 2) == 6
+
+def test_lpt_beats_shortest_first():
+    jobs = [([1], 'small')] * 8 + [([8], 'big')]
+    assert predict_makespan(lpt_order(jobs), 2) == 8
+    assert predict_makespan(jobs, 2) == 12
@@ -0,0 +1,205 @@
+from tempfile import mkdtemp
+import multiprocessing
+import os
+import shutil
+
+from nose.tools import raises
+
+from s3tup.bench import StandIn
+from s3tup.bucket import Bucket
+from s3tup.cli import run
+from s3tup.connection import Connection
+from s3tup.exception import ShardBarrierTimeout
+from s3tup.rsync import ActionPlan
+from s3tup.shard import Shard, ShardBarrier, shard_of
+import s3tup.constants as constants
+
+def test_shard_of_is_stable():
+    assert shard_of('index.html', 4) == shard_of('index.html', 4)
+    assert shard_of('index.html', 1) == 0
+    keys = ['key{}'.format(i) for i in range(1000)]
+    shards = [Shard(i, 4) for i in range(4)]
+    owners = [[s.index for s in shards if s.owns(k)] for k in keys]
+    assert all(len(o) == 1 for o in owners)
+    assert set(o[0] for o in owners) == set(range(4))
+
+def test_shard_parse():
+    shard = Shard.parse('1/3')
+    assert (shard.index, shard.count) == (1, 3)
+    assert not shard.deletes
+
+def test_shard_barrier_id():
+    shard = Shard(0, 2, run_id='deploy-7')
+    assert shard.barrier(None, 'config').barrier_id == 'config-deploy-7'
+    shard.barrier_id = 'other'
+    assert shard.barrier(None).barrier_id == 'other-deploy-7'
+
+@raises(ValueError)
+def test_shard_barrier_id_required():
+    Shard(0, 2, run_id='deploy-7').barrier(None)
+
+@raises(ValueError)
+def test_shard_run_id_required():
+    Shard(0, 2).barrier(None, 'config')
+
+@raises(ValueError)
+def test_shard_parse_out_of_range():
+    Shard.parse('3/3')
+
+@raises(ValueError)
+def test_shard_parse_invalid():
+    Shard.parse('1')
+
+class TestShardedExecution:
+
+    def setup(self):
+        self.tmp = mkdtemp()
+        self.log = os.path.join(self.tmp, 'requests.log')
+        self.interval = constants.SHARD_BARRIER_INTERVAL
+        constants.SHARD_BARRIER_INTERVAL = 0.01
+
+    def teardown(self):
+        constants.SHARD_BARRIER_INTERVAL = self.interval
+        shutil.rmtree(self.tmp)
+
+    def make_bucket(self):
+        log = self.log
+
+        def make_request(method, bucket, key=None, subresource=None,
+                         data=None, **kwargs):
+            line = '{} {} {}\n'.format(method, key, subresource)
+            fd = os.open(log, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+            try:
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+        conn = Connection('access_key_id', 'secret_access_key',
+                          concurrency=0)
+        conn.make_request = make_request
+        return Bucket(conn, 'bucket')
+
+    def requests(self):
+        with open(self.log) as f:
+            return [tuple(l.split()) for l in f]
+
+    def test_barrier_timeout(self):
+        barrier = ShardBarrier(self.make_bucket(), 'plan', 2, self.tmp)
+        barrier.arrive(1)
+        assert barrier.arrived() == set([1])
+        try:
+            barrier.wait(timeout=0.05)
+        except ShardBarrierTimeout as e:
+            assert 'Shards 0 never' in str(e)
+        else:
+            assert False
+        barrier.clear()
+        assert barrier.arrived() == set()
+
+    def test_stale_markers(self):
+        # Both shards of a failed run arrived, but its shard 0 never got
+        # to clear their markers.
+        bucket = self.make_bucket()
+        failed = Shard(0, 2, barrier_dir=self.tmp, run_id='run-1')
+        failed.barrier(bucket, 'plan').arrive(0)
+        failed.barrier(bucket, 'plan').arrive(1)
+        plan = ActionPlan()
+        plan.add_delete('deleted')
+        shard = Shard(0, 2, barrier_dir=self.tmp, run_id='run-2')
+        shard.barrier_id = 'plan'
+        self.timeout = constants.SHARD_BARRIER_TIMEOUT
+        constants.SHARD_BARRIER_TIMEOUT = 0.05
+        try:
+            bucket._execute_action_plan(plan, shard)
+        except ShardBarrierTimeout:
+            pass
+        else:
+            assert False
+        finally:
+            constants.SHARD_BARRIER_TIMEOUT = self.timeout
+        # Nothing was deleted, and shard 0 cleared its own marker.
+        assert not os.path.exists(self.log)
+        assert sorted(os.listdir(self.tmp)) == \
+            ['bucket-plan-run-1-0', 'bucket-plan-run-1-1']
+        # Markers older than the timeout are pruned.
+        for name in os.listdir(self.tmp):
+            os.utime(os.path.join(self.tmp, name), (0, 0))
+        shard.barrier(bucket).prune()
+        assert os.listdir(self.tmp) == []
+
+    def test_processes(self):
+        plan = ActionPlan()
+        for i in range(30):
+            plan.add_redirect('key{}'.format(i), 'http://example.com/')
+        plan.add_delete('deleted')
+        bucket = self.make_bucket()
+
+        def execute(index):
+            shard = Shard(index, 3, barrier_dir=self.tmp, run_id='run')
+            shard.barrier_id = 'plan'
+            bucket._execute_action_plan(plan, shard)
+
+        # Shard 0 starts first and has to wait for the others.
+        processes = [multiprocessing.Process(target=execute, args=(i,))
+                     for i in range(3)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+            assert p.exitcode == 0
+
+        requests = self.requests()
+        puts = sorted(key for method, key, _ in requests if method == 'PUT')
+        assert puts == sorted('key{}'.format(i) for i in range(30))
+        assert requests[-1] == ('POST', 'None', 'delete')
+        assert len([r for r in requests if r[0] == 'POST']) == 1
+        assert os.listdir(self.tmp) == ['requests.log']
+
+CONFIG = """
+- bucket: s3tup-bench
+  hostname: {hostname}
+  access_key_id: access_key_id
+  secret_access_key: secret_access_key
+  rsync:
+    src: {src}
+    delete: true
+"""
+
+class TestIndependentPlans:
+
+    """Shards that each list and plan for themselves, at different times."""
+
+    def setup(self):
+        self.tmp = mkdtemp()
+        self.barrier = os.path.join(self.tmp, 'barrier')
+        os.mkdir(self.barrier)
+        src = os.path.join(self.tmp, 'src')
+        os.mkdir(src)
+        for i in range(20):
+            with open(os.path.join(src, 'key{}'.format(i)), 'w') as f:
+                f.write('data {}'.format(i))
+        self.stand_in = StandIn()
+        self.stand_in.start()
+        self.stand_in.keys['stale'] = {'etag': 'etag', 'size': 1,
+                                       'modified': '2000-01-01T00:00:00.000Z',
+                                       'headers': {}}
+        self.config = os.path.join(self.tmp, 's3tup.yml')
+        with open(self.config, 'w') as f:
+            f.write(CONFIG.format(hostname=self.stand_in.hostname, src=src))
+        self.timeout = constants.SHARD_BARRIER_TIMEOUT
+        constants.SHARD_BARRIER_TIMEOUT = 1
+
+    def teardown(self):
+        constants.SHARD_BARRIER_TIMEOUT = self.timeout
+        self.stand_in.stop()
+        shutil.rmtree(self.tmp)
+
+    def test_later_shard_sees_earlier_uploads(self):
+        # Shard 1 is done before shard 0 even lists the bucket, so their
+        # plans differ, but they still share a barrier.
+        for index in (1, 0):
+            shard = Shard(index, 2, barrier_dir=self.barrier, run_id='run')
+            run(self.config, rsync=True, concurrency=0, shard=shard)
+        assert sorted(self.stand_in.keys) == \
+            sorted('key{}'.format(i) for i in range(20))
+        assert os.listdir(self.barrier) == []
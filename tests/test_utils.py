@@ -1,6 +1,12 @@
 from StringIO import StringIO
 from binascii import hexlify
-from tempfile import NamedTemporaryFile
+from fnmatch import fnmatch
+from tempfile import NamedTemporaryFile, mkdtemp
+import gzip
+import hashlib
+import os
+import re
+import shutil
 
 import s3tup.utils as utils
 
@@ -59,6 +65,66 @@ class TestMatcher:
         assert m3.matches('test.md')
         assert not m3.matches('test')
 
+    def test_compiled_same_as_fnmatch(self):
+        patterns = ['static/*', '*.png', 'a?c', 'exact', '*/img/*.jpg',
+                    '[ab]*', 'x[', '*']
+        regexes = [r'^docs/', r'(\w)\1', r'(?i)readme', r'\.py$']
+        paths = ['static/a.css', 'b.png', 'abc', 'exact', 'x/img/y.jpg',
+                 'bz', 'x[', 'docs/a', 'aab', 'README', 'a.py', 'a.pyc',
+                 'static\n.png', '']
+        for p in patterns:
+            m = utils.Matcher([p])
+            for path in paths:
+                assert m.matches(path) == fnmatch(path, p), (p, path)
+        for r in regexes:
+            m = utils.Matcher(regexes=[r])
+            for path in paths:
+                expected = re.search(r, path) is not None
+                assert m.matches(path) == expected, (r, path)
+        m = utils.Matcher(patterns[:-1], regexes=regexes)
+        for path in paths:
+            expected = any(fnmatch(path, p) for p in patterns[:-1]) or \
+                any(re.search(r, path) for r in regexes)
+            assert m.matches(path) == expected, path
+
+    def test_recompiles_when_changed(self):
+        m = utils.Matcher(['*.py'])
+        assert not m.matches('test.md')
+        m.patterns.add('*.md')
+        assert m.matches('test.md')
+        m.ignore_patterns |= set(['test*'])
+        assert not m.matches('test.md')
+        m.ignore_patterns = None
+        assert m.matches('test.md')
+
+    def test_cache(self):
+        m = utils.Matcher(['*.py'], cache_size=2)
+        for s in ('a.py', 'b.md', 'c.py', 'a.py'):
+            assert m.matches(s) == s.endswith('.py')
+        assert len(m._cache) == 2
+        m.patterns.add('*.md')
+        assert m.matches('b.md')
+        assert (m + utils.Matcher()).cache_size == 2
+
+    def test_excludes_dir(self):
+        m = utils.Matcher(ignore_patterns=['node_modules/*', '*/.git/*'],
+                          ignore_regexes=[r'^build/', r'\.tmp$'])
+        assert m.excludes_dir('node_modules')
+        assert m.excludes_dir('src/.git')
+        assert m.excludes_dir('build')
+        assert not m.excludes_dir('src')
+        assert not m.excludes_dir('a.tmp')
+        assert not m.excludes_dir('node_modules_old')
+
+    def test_excludes_dir_patterns(self):
+        m = utils.Matcher(patterns=['static/*.css', 'index.html'])
+        assert not m.excludes_dir('static')
+        assert m.excludes_dir('media')
+        m = utils.Matcher(patterns=['*.css'])
+        assert not m.excludes_dir('media')
+        m = utils.Matcher(patterns=['static/*'], regexes=['x'])
+        assert not m.excludes_dir('media')
+
 class TestFchunk:
 
     def setup(self):
@@ -120,4 +186,213 @@ def test_f_md5():
     s.seek(2, 0) 
     expected = '5d41402abc4b2a76b9719d911017c592'
     assert hexlify(utils.f_md5(s)) == expected
-    assert s.tell() == 2
\ No newline at end of file
+    assert s.tell() == 2
+
+def test_choose_part_size_small_file_uses_default():
+    assert utils.choose_part_size(6000000) == 5242880
+
+def test_choose_part_size_large_file_bounds_part_count():
+    size = 50 * 1024 ** 3
+    part_size = utils.choose_part_size(size)
+    assert part_size % 1048576 == 0
+    assert size / part_size <= 1000
+
+def test_choose_part_size_explicit():
+    assert utils.choose_part_size(100000000, 8 * 1048576) == 8 * 1048576
+    # Never smaller than what s3 allows
+    assert utils.choose_part_size(100000000, 1) == 5242880
+
+def test_choose_part_size_bandwidth():
+    size = 1024 ** 3
+    part_size = utils.choose_part_size(size, bandwidth=4 * 1048576)
+    assert part_size == 40 * 1048576
+
+def test_multipart_part_sizes():
+    size = 3 * 5242880 + 10
+    assert utils.multipart_part_sizes(size, 4)[0] == 5242880
+    size = 50 * 1048576
+    assert len(utils.multipart_part_sizes(size, 5)) == 3
+    # Parts smaller than s3 allows are never candidates.
+    assert utils.multipart_part_sizes(size, 50) == []
+    assert utils.multipart_part_sizes(12 * 1048576, 3) == [5242880]
+    assert utils.multipart_part_sizes(size, 1) == [size]
+
+def test_f_multipart_etag():
+    tmp = NamedTemporaryFile()
+    tmp.write('0123456789')
+    tmp.flush()
+    etag = utils.f_multipart_etag(tmp, 4)
+    m = hashlib.md5()
+    for part in ('0123', '4567', '89'):
+        m.update(hashlib.md5(part).digest())
+    assert etag == '{}-3'.format(m.hexdigest())
+    tmp.close()
+
+def test_f_digests():
+    data = ''.join(chr(i % 251) for i in range(10000))
+    tmp = NamedTemporaryFile()
+    tmp.write(data)
+    tmp.flush()
+    tmp.seek(5)
+    read_size = utils.constants.HASH_READ_SIZE
+    utils.constants.HASH_READ_SIZE = 1024
+    try:
+        for f in (tmp, StringIO(data)):
+            md5, part_md5s = utils.f_digests(f, [1000, 3000, 4096])
+            assert md5 == hashlib.md5(data).hexdigest()
+            for part_size in (1000, 3000, 4096):
+                expected = [hashlib.md5(data[i:i+part_size]).hexdigest()
+                            for i in range(0, len(data), part_size)]
+                assert part_md5s[part_size] == expected
+        assert tmp.tell() == 5
+    finally:
+        utils.constants.HASH_READ_SIZE = read_size
+        tmp.close()
+
+def test_f_digests_empty():
+    tmp = NamedTemporaryFile()
+    md5, part_md5s = utils.f_digests(tmp, [4], md5=False)
+    assert md5 is None
+    assert part_md5s == {4: []}
+    assert utils.f_digests(tmp)[0] == hashlib.md5('').hexdigest()
+    tmp.close()
+
+def test_f_parts_file():
+    tmp = NamedTemporaryFile()
+    tmp.write('0123456789')
+    tmp.flush()
+    parts = utils.f_parts(tmp, 4)
+    assert [str(p) for p in parts] == ['0123', '4567', '89']
+    tmp.close()
+
+def test_f_parts_file_like():
+    s = StringIO('0123456789')
+    s.seek(3)
+    parts = utils.f_parts(s, 5)
+    assert [str(p) for p in parts] == ['01234', '56789']
+    assert s.tell() == 3
+
+def test_stream_reader_iterable():
+    r = utils.StreamReader(iter(['ab', 'cde', '', 'f']))
+    assert r.read(4) == 'abcd'
+    assert r.read(1) == 'e'
+    assert r.read(5) == 'f'
+    assert r.read(5) == ''
+
+def test_stream_reader_file_like():
+    r = utils.StreamReader(StringIO('abcdef'))
+    assert r.read(4) == 'abcd'
+    assert r.read(4) == 'ef'
+
+def test_stream_reader_pipe():
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, 'abcdef')
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        assert not utils.f_seekable(f)
+        r = utils.StreamReader(f)
+        assert r.read(4) == 'abcd'
+        assert r.read(4) == 'ef'
+
+def test_stream_reader_pipe_after_readline():
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, 'line\nabcdef')
+    os.close(write_fd)
+    with os.fdopen(read_fd, 'rb') as f:
+        assert f.readline() == 'line\n'
+        r = utils.StreamReader(f)
+        assert r.read(10) == 'abcdef'
+
+def test_stream_reader_wrapped_file():
+    tmp = NamedTemporaryFile(suffix='.gz')
+    with gzip.GzipFile(fileobj=tmp, mode='wb') as g:
+        g.write('abcdef')
+    tmp.flush()
+    with gzip.open(tmp.name, 'rb') as g:
+        r = utils.StreamReader(g)
+        assert r.read(10) == 'abcdef'
+    tmp.close()
+
+def test_stream_parts():
+    r = utils.StreamReader(iter(['abc', 'defg', 'h']))
+    assert list(utils.stream_parts(r, 3, 'xyzw')) == \
+        ['xyz', 'wab', 'cde', 'fgh']
+    r = utils.StreamReader(iter(['abc', 'de']))
+    assert list(utils.stream_parts(r, 3)) == ['abc', 'de']
+    assert list(utils.stream_parts(r, 3)) == []
+
+def test_f_seekable():
+    assert utils.f_seekable(StringIO('test'))
+    assert not utils.f_seekable(iter(['test']))
+
+class TestUploadDescriptor:
+
+    def setup(self):
+        self.tmp = NamedTemporaryFile()
+        self.tmp.write('0123456789')
+        self.tmp.flush()
+
+    def teardown(self):
+        self.tmp.close()
+
+    def test_from_file_matches(self):
+        d = utils.UploadDescriptor.from_file(self.tmp)
+        assert d.size == 10
+        assert d.matches(self.tmp)
+        d.mtime -= 1
+        assert not d.matches(self.tmp)
+        assert not d.matches(StringIO('0123456789'))
+
+    def test_etag(self):
+        d = utils.UploadDescriptor.from_file(self.tmp)
+        assert d.etag() is None
+        assert d.etag(4) is None
+        d.md5 = hexlify(utils.f_md5(self.tmp))
+        d.part_md5s[4] = utils.f_part_md5s(self.tmp, 4)
+        assert d.etag() == d.md5
+        assert d.etag(4) == utils.f_multipart_etag(self.tmp, 4)
+
+class TestWalkFiles:
+
+    def setup(self):
+        self.tmp = mkdtemp()
+        for path in ('a', 'src/b', 'src/lib/c', 'node_modules/d/e',
+                     'static/f'):
+            path = os.path.join(self.tmp, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'wb') as f:
+                f.write(path)
+        os.symlink(os.path.join(self.tmp, 'src'),
+                   os.path.join(self.tmp, 'link'))
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def walk(self, matcher=None, workers=1):
+        return sorted(utils.walk_files(self.tmp, matcher, workers))
+
+    def test_walk(self):
+        files = self.walk()
+        expected = sorted(utils.os_walk_relative(self.tmp))
+        assert [p for p, _ in files] == expected
+        for path, st in files:
+            assert st.st_size == len(os.path.join(self.tmp, path))
+
+    def test_walk_parallel(self):
+        assert self.walk(workers=4) == self.walk()
+
+    def test_walk_prunes(self):
+        scanned = []
+        scan_dir = utils._scan_dir
+        def record(path):
+            scanned.append(os.path.relpath(path, self.tmp))
+            return scan_dir(path)
+        utils._scan_dir = record
+        try:
+            m = utils.Matcher(ignore_patterns=['node_modules/*'])
+            files = [p for p, _ in self.walk(m)]
+        finally:
+            utils._scan_dir = scan_dir
+        assert files == ['a', 'src/b', 'src/lib/c', 'static/f']
+        assert 'node_modules' not in scanned
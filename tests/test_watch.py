@@ -0,0 +1,114 @@
+from tempfile import mkdtemp
+import hashlib
+import os
+import shutil
+import sys
+
+from nose.plugins.skip import SkipTest
+
+from s3tup.bucket import Bucket
+from s3tup.connection import Connection
+from s3tup.rsync import RsyncConfig, RsyncPlanner
+from s3tup.watch import KeyTuple, Watcher
+import s3tup.utils as utils
+
+class BucketMock(Bucket):
+
+    def __init__(self, configs, remote_keys=None):
+        conn = Connection('access_key_id', 'secret_access_key',
+                          concurrency=0)
+        super(BucketMock, self).__init__(conn, 'bucket',
+                                         rsync_planner=RsyncPlanner(configs))
+        self.remote_keys = remote_keys or {}
+        self.plans = []
+
+    def get_remote_keys(self):
+        return dict(self.remote_keys)
+
+    def execute_action_plan(self, plan, dryrun=False):
+        self.plans.append(plan)
+
+class TestWatcher:
+
+    def setup(self):
+        if not sys.platform.startswith('linux'):
+            raise SkipTest('inotify is linux only')
+        self.tmp = mkdtemp()
+        self.src = os.path.join(self.tmp, 'src')
+        os.mkdir(self.src)
+        self.write('same', 'same')
+        self.write('gone', 'gone')
+        os.mkdir(os.path.join(self.src, 'ignored'))
+        remote = {}
+        for name in ('same', 'gone', 'old'):
+            remote[name] = KeyTuple(name, hashlib.md5(name).hexdigest(),
+                                    len(name), None)
+        matcher = utils.Matcher(ignore_patterns=['ignored/*'])
+        config = RsyncConfig(self.src, delete=True, matcher=matcher)
+        self.bucket = BucketMock([config], remote)
+        self.watcher = Watcher(self.bucket, debounce=0.05)
+
+    def teardown(self):
+        self.watcher.close()
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        with open(os.path.join(self.src, name), 'wb') as f:
+            f.write(data)
+
+    def test_start_reconciles(self):
+        self.watcher.start()
+        plan, = self.bucket.plans
+        assert list(plan.to_delete) == ['old']
+        assert list(plan.to_upload) == []
+        assert list(plan.to_sync) == []
+        assert 'old' not in self.watcher.remote_keys
+        assert sorted(self.watcher.local_files[self.src]) == ['gone', 'same']
+
+    def test_sync_changes(self):
+        self.watcher.start()
+        self.write('new', 'new')
+        os.remove(os.path.join(self.src, 'gone'))
+        os.mkdir(os.path.join(self.src, 'dir'))
+        self.write('dir/file', 'file')
+        self.write('ignored/file', 'file')
+        os.utime(os.path.join(self.src, 'same'), None)
+        changes = self.watcher.wait_for_changes(1)
+        assert changes[self.src] >= set(['new', 'gone', 'dir', 'same'])
+        assert 'ignored/file' not in changes[self.src]
+
+        self.watcher.sync_changes(changes)
+        plan = self.bucket.plans[-1]
+        assert sorted(k for k, _ in plan.to_upload) == ['dir/file', 'new']
+        assert list(plan.to_delete) == ['gone']
+        assert self.watcher.remote_keys['new'].md5 is None
+        assert 'gone' not in self.watcher.remote_keys
+
+        # Events that leave files as they were don't plan anything.
+        plans = len(self.bucket.plans)
+        os.chmod(os.path.join(self.src, 'new'), 0o600)
+        self.watcher.sync_changes(self.watcher.wait_for_changes(1))
+        assert len(self.bucket.plans) == plans
+
+        # Files uploaded since the last listing are uploaded again.
+        self.write('new', 'new')
+        self.watcher.sync_changes(self.watcher.wait_for_changes(1))
+        assert [k for k, _ in self.bucket.plans[-1].to_upload] == ['new']
+
+    def test_moved_out_folder(self):
+        os.mkdir(os.path.join(self.src, 'dir'))
+        self.write('dir/file', 'file')
+        self.bucket.remote_keys['dir/file'] = KeyTuple(
+            'dir/file', hashlib.md5('file').hexdigest(), 4, None)
+        self.watcher.start()
+        os.rename(os.path.join(self.src, 'dir'),
+                  os.path.join(self.tmp, 'dir'))
+        changes = self.watcher.wait_for_changes(1)
+        assert changes == {self.src: set(['dir'])}
+        self.watcher.sync_changes(changes)
+        assert list(self.bucket.plans[-1].to_delete) == ['dir/file']
+
+        # The folder isn't watched anymore once it's moved out of src.
+        with open(os.path.join(self.tmp, 'dir', 'file'), 'wb') as f:
+            f.write('changed')
+        assert self.watcher.wait_for_changes(0.1) == {}
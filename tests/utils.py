@@ -13,7 +13,7 @@ class ConnMock(object):
 class MakeRequestMock(MagicMock):
     def __call__(self, *args, **kwargs):
         kwargs = self.clean_kwargs(kwargs)
-        super(MakeRequestMock, self).__call__(*args, **kwargs)
+        return super(MakeRequestMock, self).__call__(*args, **kwargs)
 
     def assert_called_once_with(self, *args, **kwargs):
         kwargs = self.clean_kwargs(kwargs)